@@ -1,9 +1,15 @@
 import os
+import json
 import argparse
 import shutil
 from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import instrumentation
+from cache_utils import hash_file
+from file_utils import link_or_copy
+
 
 def parse_arguments() -> Namespace:
     """
@@ -34,9 +40,104 @@ def parse_arguments() -> Namespace:
         action="store_true",
         help="[OPTION] 同名のファイルがある場合に強制的に上書きします。",
     )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="[OPTION] ファイルの内容のハッシュで重複を判定し、取り込み済みのファイルをスキップします。"
+        "同じファイルシステム上ではコピーの代わりにハードリンクを作成します。",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=4,
+        help="[OPTION] --dedup でハッシュの計算とコピーを並列に行う数",
+    )
+    instrumentation.add_arguments(parser)
     return parser.parse_args()
 
 
+def load_manifest(manifest_path: str) -> dict[str, str]:
+    """
+    取り込み済みのファイルのハッシュと取り込み先のパスの対応を読み込みます。
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_path: str, manifest: dict[str, str]) -> None:
+    """
+    取り込み済みのファイルの一覧を保存します。
+    """
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def timed_link_or_copy(src: str, dest: str) -> str:
+    """
+    link_or_copy を実行し、処理時間を記録します。
+    """
+    with instrumentation.measure():
+        return link_or_copy(src, dest)
+
+
+def ingest_files(
+    source_dir: str, raw_dir: str, manifest_path: str, force: bool, jobs: int
+) -> None:
+    """
+    音声ファイルを内容のハッシュで重複を除いて取り込みます。
+    取り込み済みの内容と同じファイルはスキップし、それ以外はハードリンクかコピーで取り込みます。
+    """
+    source_files = [
+        os.path.join(source_dir, file)
+        for file in sorted(os.listdir(source_dir))
+        if file.endswith((".mp3", ".wav"))
+    ]
+    manifest = load_manifest(manifest_path)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        hashes = list(executor.map(hash_file, source_files))
+
+        pending: list[tuple[str, str, str]] = []
+        seen: set[str] = set()
+        for source_file, digest in zip(source_files, hashes):
+            ingested = manifest.get(digest)
+            if digest in seen or (ingested and os.path.exists(ingested) and not force):
+                print(
+                    f"スキップされたファイル: {source_file}（取り込み済み: {ingested or '同じ内容のファイル'}）"
+                )
+                continue
+            seen.add(digest)
+            pending.append(
+                (
+                    source_file,
+                    os.path.join(raw_dir, os.path.basename(source_file)),
+                    digest,
+                )
+            )
+
+        if not pending:
+            print("新しく取り込むファイルはありません。")
+            return
+
+        os.makedirs(raw_dir, exist_ok=True)
+        methods = executor.map(
+            lambda item: timed_link_or_copy(item[0], item[1]), pending
+        )
+        for (_, dest_file, digest), method in zip(pending, methods):
+            manifest[digest] = dest_file
+            label = (
+                "リンクされたファイル" if method == "link" else "コピーされたファイル"
+            )
+            print(f"{label}: {dest_file}")
+
+    save_manifest(manifest_path, manifest)
+
+
 def main(args=None):
     """
     メイン関数。音声ファイルを指定のディレクトリにコピーします。
@@ -47,15 +148,27 @@ def main(args=None):
     if args.directory:
         timestamp = datetime.now().strftime("%y%m%d_%H%M%S")
         raw_dir = os.path.join(f"./data/{args.model_name}", "raw", timestamp)
-        os.makedirs(raw_dir, exist_ok=True)
-        for file in os.listdir(args.directory):
-            if file.endswith((".mp3", ".wav")):
-                dest_file = os.path.join(raw_dir, file)
-                if os.path.exists(dest_file) and not args.force:
-                    print(f"スキップされたファイル: {dest_file}（既に存在します）")
-                else:
-                    shutil.copy(os.path.join(args.directory, file), dest_file)
-                    print(f"コピーされたファイル: {dest_file}")
+        report_file = instrumentation.report_path(args.model_name, timestamp)
+        with instrumentation.Recorder("01_file_copy", report_file, args.profile):
+            if args.dedup:
+                manifest_path = os.path.join(
+                    f"./data/{args.model_name}", "ingest_manifest.json"
+                )
+                ingest_files(
+                    args.directory, raw_dir, manifest_path, args.force, args.jobs
+                )
+                return
+
+            os.makedirs(raw_dir, exist_ok=True)
+            for file in os.listdir(args.directory):
+                if file.endswith((".mp3", ".wav")):
+                    dest_file = os.path.join(raw_dir, file)
+                    if os.path.exists(dest_file) and not args.force:
+                        print(f"スキップされたファイル: {dest_file}（既に存在します）")
+                    else:
+                        with instrumentation.measure():
+                            shutil.copy(os.path.join(args.directory, file), dest_file)
+                        print(f"コピーされたファイル: {dest_file}")
 
 
 if __name__ == "__main__":
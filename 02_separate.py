@@ -1,10 +1,27 @@
 import os
 import argparse
+import math
 import subprocess
+import time
 from argparse import Namespace
-from typing import Optional
+from typing import Callable, Iterator, Optional
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta
 
+import numpy as np
+
+import audio_utils
+import instrumentation
+from metadata_index import STAGE_DIRS, MetadataIndex, index_path
+
+# 1 回の ffmpeg 実行で書き出すセグメント数の上限（Windows のコマンドライン長の制限対策）
+SEGMENTS_PER_PROCESS = 64
+# VAD モードで音量を解析するフレームの長さ（秒）
+VAD_FRAME_SECONDS = 0.02
+
+Planner = Callable[[str], list[tuple[int, float, float]]]
+
 
 def parse_arguments() -> Namespace:
     """
@@ -28,6 +45,37 @@ def parse_arguments() -> Namespace:
     parser.add_argument(
         "--overlay", type=int, default=5, help="[OPTION] 分割の重なり（秒）"
     )
+    parser.add_argument(
+        "--mode",
+        choices=["fixed", "vad"],
+        default="fixed",
+        help="[OPTION] 分割方法。fixed は --interval / --overlay の固定長、"
+        "vad は無音の位置で重なりなしに分割します。",
+    )
+    parser.add_argument(
+        "--min-length",
+        type=float,
+        default=5.0,
+        help="[OPTION] vad モードのセグメントの最小長（秒）",
+    )
+    parser.add_argument(
+        "--max-length",
+        type=float,
+        default=30.0,
+        help="[OPTION] vad モードのセグメントの最大長（秒）",
+    )
+    parser.add_argument(
+        "--silence-threshold",
+        type=float,
+        default=-40.0,
+        help="[OPTION] vad モードで無音とみなす音量（dBFS）",
+    )
+    parser.add_argument(
+        "--min-silence",
+        type=float,
+        default=0.3,
+        help="[OPTION] vad モードで区切りに使う無音の最小長（秒）",
+    )
     parser.add_argument(
         "--force",
         "-F",
@@ -35,6 +83,14 @@ def parse_arguments() -> Namespace:
         help="[OPTION] 既存ファイルを強制的に上書きします。",
     )
     parser.add_argument("--output-dir", help="[OPTION] 出力ディレクトリのパス")
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="[OPTION] 並列に処理するジョブ数（同時に起動する ffmpeg / ffprobe の上限）",
+    )
+    instrumentation.add_arguments(parser)
     return parser.parse_args()
 
 
@@ -82,40 +138,326 @@ def get_audio_duration(input_file: str) -> int:
     return int(float(result.stdout))
 
 
-def split_audio_file(
+def plan_segments(
+    start_time: int, total_duration: int, interval: int, overlay: int
+) -> list[tuple[int, int, int]]:
+    """
+    分割するセグメントの (セグメント番号, 開始時間, 終了時間) の一覧を作成します。
+    """
+    segments: list[tuple[int, int, int]] = []
+    segment_number: int = 1
+    current_time: int = start_time
+    while current_time < total_duration:
+        segments.append(
+            (
+                segment_number,
+                current_time,
+                min(current_time + interval, total_duration),
+            )
+        )
+        segment_number += 1
+        current_time += interval - overlay
+    return segments
+
+
+def plan_vad_bounds(
+    rms_db: np.ndarray,
+    zcr: np.ndarray,
+    min_frames: int,
+    max_frames: int,
+    silence_threshold: float,
+    min_silence_frames: int,
+    segment_start: int = 0,
+    final: bool = True,
+) -> list[tuple[int, int]]:
+    """
+    フレームごとの音量とゼロ交差率から、無音の位置を区切りにしたセグメントの
+    (開始フレーム, 終了フレーム) の一覧を作成します。
+    final が False の場合は、後続のフレームによって変わらない区切りだけを返し、末尾は含めません。
+    """
+    n_frames = len(rms_db)
+    if n_frames <= segment_start:
+        return []
+
+    # 無声子音（ゼロ交差率が高い）はやや小さな音量でも発話として扱う
+    voiced = (rms_db >= silence_threshold) | (
+        (rms_db >= silence_threshold - 10.0) & (zcr > 0.25)
+    )
+    run_starts, run_ends = audio_utils.silence_runs(~voiced)
+    run_lengths = run_ends - run_starts
+    keep = run_lengths >= max(min_silence_frames, 1)
+    cut_points = (run_starts[keep] + run_ends[keep]) // 2
+    cut_weights = run_lengths[keep]
+
+    bounds: list[tuple[int, int]] = []
+    while n_frames - segment_start > max_frames:
+        low, high = segment_start + min_frames, segment_start + max_frames
+        first, last = np.searchsorted(cut_points, [low, high + 1])
+        if last > first:
+            # 最も長い無音の中央で区切る（同じ長さなら後ろを優先）
+            weights = cut_weights[first:last][::-1]
+            cut = int(cut_points[last - 1 - int(np.argmax(weights))])
+        else:
+            # 無音が見つからない場合は最も音量の小さいフレームで区切る
+            cut = low + int(np.argmin(rms_db[low:high]))
+        bounds.append((segment_start, cut))
+        segment_start = cut
+
+    if not final:
+        return bounds
+
+    # 短すぎる末尾は、最大長を超えない範囲で直前のセグメントにまとめる
+    if bounds and n_frames - segment_start < min_frames:
+        previous_start = bounds[-1][0]
+        if n_frames - previous_start <= max_frames:
+            segment_start = bounds.pop()[0]
+    bounds.append((segment_start, n_frames))
+    return bounds
+
+
+def plan_vad_segments(
+    input_file: str,
+    start_time: int = 0,
+    min_length: float = 5.0,
+    max_length: float = 30.0,
+    silence_threshold: float = -40.0,
+    min_silence: float = 0.3,
+) -> list[tuple[int, float, float]]:
+    """
+    無音区間を検出し、min_length〜max_length 秒の範囲で無音の位置を区切りにした
+    セグメントの (セグメント番号, 開始時間, 終了時間) の一覧を作成します。
+    セグメント同士は重なりません。
+    """
+    rms_db, zcr = audio_utils.analyze_frames(
+        input_file, VAD_FRAME_SECONDS, start_time=start_time
+    )
+    bounds = plan_vad_bounds(
+        rms_db,
+        zcr,
+        int(min_length / VAD_FRAME_SECONDS),
+        int(max_length / VAD_FRAME_SECONDS),
+        silence_threshold,
+        int(min_silence / VAD_FRAME_SECONDS),
+    )
+    return [
+        (
+            segment_number,
+            round(start_time + begin * VAD_FRAME_SECONDS, 2),
+            round(start_time + end * VAD_FRAME_SECONDS, 2),
+        )
+        for segment_number, (begin, end) in enumerate(bounds, start=1)
+    ]
+
+
+def split_options_error(
+    mode: str, interval: int, overlay: int, min_length: float, max_length: float
+) -> Optional[str]:
+    """
+    分割の引数が正しくない場合はエラーメッセージを返します。正しい場合は None を返します。
+    """
+    if mode == "vad":
+        if min_length >= max_length:
+            return "エラー: --min-length は --max-length より小さくしてください。"
+    elif interval <= overlay:
+        return f"エラー: 分割間隔（{interval}）は重なり（{overlay}）より大きくしてください。"
+    return None
+
+
+def iter_fixed_windows(
+    blocks: Iterator[np.ndarray], sample_rate: int, interval: int, overlay: int
+) -> Iterator[tuple[int, int, int, np.ndarray]]:
+    """
+    デコード済みの PCM ブロックから、固定長で重なりのある窓を順に切り出します。
+    (セグメント番号, 開始サンプル, 終了サンプル, 音声配列) を返します。
+    """
+    if interval <= overlay:
+        # 窓が進まず、同じ位置を切り出し続けるため
+        raise ValueError(
+            f"分割間隔（{interval}）は重なり（{overlay}）より大きくしてください。"
+        )
+    window, step = interval * sample_rate, (interval - overlay) * sample_rate
+    buffer = np.zeros(0, dtype=np.float32)
+    buffer_start = 0
+    next_start = 0
+    segment_number = 1
+    for block in blocks:
+        buffer = np.concatenate([buffer, block])
+        while next_start + window <= buffer_start + len(buffer):
+            offset = next_start - buffer_start
+            yield segment_number, next_start, next_start + window, buffer[
+                offset : offset + window
+            ]
+            segment_number += 1
+            next_start += step
+        # 次の窓より前のサンプルは不要なので捨てる
+        drop = min(next_start - buffer_start, len(buffer))
+        buffer = buffer[drop:]
+        buffer_start += drop
+
+    total = buffer_start + len(buffer)
+    while next_start < total:
+        end = min(next_start + window, total)
+        yield segment_number, next_start, end, buffer[
+            next_start - buffer_start : end - buffer_start
+        ]
+        segment_number += 1
+        next_start += step
+
+
+def iter_vad_windows(
+    blocks: Iterator[np.ndarray],
+    sample_rate: int,
+    min_length: float = 5.0,
+    max_length: float = 30.0,
+    silence_threshold: float = -40.0,
+    min_silence: float = 0.3,
+) -> Iterator[tuple[int, int, int, np.ndarray]]:
+    """
+    デコード済みの PCM ブロックを解析しながら、無音の位置を区切りにした窓を順に切り出します。
+    区切りが確定したセグメントから返すため、ファイル全体をメモリに保持しません。
+    (セグメント番号, 開始サンプル, 終了サンプル, 音声配列) を返します。
+    """
+    if min_length >= max_length:
+        raise ValueError(
+            f"最小の長さ（{min_length}）は最大の長さ（{max_length}）より小さくしてください。"
+        )
+    frame_length = int(sample_rate * VAD_FRAME_SECONDS)
+    options = dict(
+        min_frames=int(min_length / VAD_FRAME_SECONDS),
+        max_frames=int(max_length / VAD_FRAME_SECONDS),
+        silence_threshold=silence_threshold,
+        min_silence_frames=int(min_silence / VAD_FRAME_SECONDS),
+    )
+    buffer = np.zeros(0, dtype=np.float32)
+    buffer_start = 0
+    analyzed = 0
+    rms_parts: list[np.ndarray] = []
+    zcr_parts: list[np.ndarray] = []
+    segment_start = 0
+    segment_number = 1
+
+    def cut(begin: int, end: int) -> np.ndarray:
+        return buffer[begin - buffer_start : end - buffer_start]
+
+    for block in blocks:
+        buffer = np.concatenate([buffer, block])
+        usable = (buffer_start + len(buffer)) // frame_length * frame_length
+        if usable > analyzed:
+            rms_db, zcr = audio_utils.frame_features(
+                cut(analyzed, usable), frame_length
+            )
+            rms_parts.append(rms_db)
+            zcr_parts.append(zcr)
+            analyzed = usable
+
+        bounds = plan_vad_bounds(
+            np.concatenate(rms_parts),
+            np.concatenate(zcr_parts),
+            segment_start=segment_start,
+            final=False,
+            **options,
+        )
+        # 最後の区切りは末尾のまとめ方が確定するまで保留する
+        for begin, end in bounds[:-1]:
+            yield segment_number, begin * frame_length, end * frame_length, cut(
+                begin * frame_length, end * frame_length
+            )
+            segment_number += 1
+            segment_start = end
+        drop = segment_start * frame_length - buffer_start
+        buffer = buffer[drop:]
+        buffer_start += drop
+
+    if not rms_parts:
+        return
+    total = buffer_start + len(buffer)
+    bounds = plan_vad_bounds(
+        np.concatenate(rms_parts),
+        np.concatenate(zcr_parts),
+        segment_start=segment_start,
+        **options,
+    )
+    for index, (begin, end) in enumerate(bounds):
+        end_sample = total if index == len(bounds) - 1 else end * frame_length
+        yield segment_number, begin * frame_length, end_sample, cut(
+            begin * frame_length, end_sample
+        )
+        segment_number += 1
+
+
+def write_segments(input_file: str, segments: list[tuple[str, float, float]]) -> bool:
+    """
+    1 回の ffmpeg 実行で入力ファイルを一度だけ読み込み、複数のセグメントを書き出します。
+    segments には (出力ファイルパス, 開始時間, 終了時間) を指定します。
+    """
+    # グループの先頭まで入力側でシークし、各出力はそこからの相対時間で切り出す
+    group_start = min(start for _, start, _ in segments)
+    command: list[str] = ["ffmpeg", "-ss", str(group_start), "-i", input_file]
+    for output_filepath, start, end in segments:
+        command += [
+            "-ss",
+            str(start - group_start),
+            "-t",
+            str(end - start),
+            "-c",
+            "copy",
+            output_filepath,
+        ]
+    with instrumentation.measure("ffmpeg", len(segments)):
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        print(f"エラー: {result.stderr.decode('utf-8', errors='ignore')}")
+        return False
+    return True
+
+
+def prepare_segments(
     input_file: str,
     output_dir: str,
     start_time: int,
     interval: int,
     overlay: int,
     force: bool,
-) -> None:
+    planner: Optional[Planner] = None,
+    duration: Optional[float] = None,
+) -> list[tuple[str, float, float]]:
     """
-    音声ファイルを指定の間隔で分割し、出力ディレクトリに保存します。
+    書き出しが必要なセグメントの (出力ファイルパス, 開始時間, 終了時間) の一覧を作成します。
+    planner を指定しない場合は固定長（interval / overlay）で分割します。
+    duration を指定した場合は ffprobe で再生時間を取得しません。
     """
-    duration: int = interval
-    total_duration: int = get_audio_duration(input_file)
+    # 入力ファイルの存在確認
+    if not os.path.isfile(input_file):
+        print(f"入力ファイルが見つかりません: {input_file}")
+        return []
+
+    if planner is None:
+        if interval <= overlay:
+            print(
+                f"エラー: 分割間隔（{interval}）は重なり（{overlay}）より大きくしてください。"
+            )
+            return []
+        total_duration: int = (
+            int(duration) if duration is not None else get_audio_duration(input_file)
+        )
+        segments = plan_segments(start_time, total_duration, interval, overlay)
+    else:
+        segments = planner(input_file)
 
     # 出力ディレクトリの存在確認
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir, exist_ok=True)
 
-    # 入力ファイルの存在確認
-    if not os.path.isfile(input_file):
-        print(f"入力ファイルが見つかりません: {input_file}")
-        return
-
-    segment_number: int = 1
-    current_time: int = start_time
+    base_filename: str = os.path.splitext(os.path.basename(input_file))[0]
+    file_extension: str = os.path.splitext(input_file)[1]
 
-    while current_time < total_duration:
-        base_filename: str = os.path.splitext(os.path.basename(input_file))[0]
-        file_extension: str = os.path.splitext(input_file)[1]
+    pending: list[tuple[str, float, float]] = []
+    for segment_number, current_time, end_time in segments:
         output_filename: str = generate_output_filename(
             base_filename,
             segment_number,
-            current_time,
-            min(current_time + duration, total_duration),
+            int(current_time),
+            int(end_time),
             file_extension,
         )
         output_filepath: str = os.path.join(output_dir, output_filename)
@@ -125,28 +467,130 @@ def split_audio_file(
                 os.remove(output_filepath)
             else:
                 print(f"スキップされたファイル: {output_filepath}（既に存在します）")
-                segment_number += 1
-                current_time += interval - overlay
                 continue
+        pending.append((output_filepath, current_time, end_time))
+    return pending
 
-        command: list[str] = [
-            "ffmpeg",
-            "-i",
-            input_file,
-            "-ss",
-            str(current_time),
-            "-t",
-            str(min(duration, total_duration - current_time)),
-            "-c",
-            "copy",
-            output_filepath,
-        ]
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode != 0:
-            break
-        print(f"出力ファイル: {output_filepath}")
-        segment_number += 1
-        current_time += interval - overlay
+
+def group_segments(
+    segments: list[tuple[str, float, float]], jobs: int = 1
+) -> list[list[tuple[str, float, float]]]:
+    """
+    セグメントを ffmpeg 1 回分のグループに分けます。
+    jobs が 2 以上の場合は、長いファイルでも複数の ffmpeg で並列に処理できるように分割します。
+    """
+    if not segments:
+        return []
+    size = min(SEGMENTS_PER_PROCESS, math.ceil(len(segments) / max(jobs, 1)))
+    return [segments[i : i + size] for i in range(0, len(segments), size)]
+
+
+def split_audio_file(
+    input_file: str,
+    output_dir: str,
+    start_time: int,
+    interval: int,
+    overlay: int,
+    force: bool,
+    planner: Optional[Planner] = None,
+    index: Optional[MetadataIndex] = None,
+) -> int:
+    """
+    音声ファイルを指定の間隔で分割し、出力ディレクトリに保存します。
+    入力は SEGMENTS_PER_PROCESS 件ごとに 1 回だけ読み込まれます。
+    index を指定した場合は再生時間をインデックスから取得し、出力の元ファイルを記録します。
+    書き出したセグメント数を返します。ffmpeg が失敗した場合は RuntimeError を送出します。
+    """
+    pending = prepare_segments(
+        input_file,
+        output_dir,
+        start_time,
+        interval,
+        overlay,
+        force,
+        planner,
+        index.duration(input_file) if index is not None else None,
+    )
+    written: int = 0
+    for group in group_segments(pending):
+        if not write_segments(input_file, group):
+            raise RuntimeError(f"セグメントの書き出しに失敗しました: {input_file}")
+        for output_filepath, _, _ in group:
+            print(f"出力ファイル: {output_filepath}")
+        if index is not None:
+            index.set_sources([(path, input_file) for path, _, _ in group], "separate")
+        written += len(group)
+    return written
+
+
+def split_audio_files(
+    input_files: list[str],
+    output_dir: str,
+    start_time: int,
+    interval: int,
+    overlay: int,
+    force: bool,
+    jobs: int,
+    planner: Optional[Planner] = None,
+    index: Optional[MetadataIndex] = None,
+) -> tuple[int, list[str]]:
+    """
+    複数の音声ファイルを並列に分割します。
+    同時に起動する ffprobe / ffmpeg の数は jobs 個までに制限されます。
+    index を指定した場合は再生時間をインデックスから取得し、出力の元ファイルを記録します。
+    書き出したセグメント数と、失敗した入力ファイルの一覧を返します。
+    """
+    failed: set[str] = set()
+    written: int = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # ffprobe による再生時間の取得もワーカー上で実行する
+        plans = {
+            executor.submit(
+                prepare_segments,
+                input_file,
+                output_dir,
+                start_time,
+                interval,
+                overlay,
+                force,
+                planner,
+                index.duration(input_file) if index is not None else None,
+            ): input_file
+            for input_file in input_files
+        }
+        writes = {}
+        for future in as_completed(plans):
+            input_file = plans[future]
+            try:
+                pending = future.result()
+            except Exception as e:
+                print(f"エラー: {input_file} の解析に失敗しました: {e}")
+                failed.add(input_file)
+                continue
+            for group in group_segments(pending, jobs):
+                writes[executor.submit(write_segments, input_file, group)] = (
+                    input_file,
+                    group,
+                )
+
+        for future in as_completed(writes):
+            input_file, group = writes[future]
+            try:
+                ok = future.result()
+            except Exception as e:
+                print(f"エラー: {input_file} の分割に失敗しました: {e}")
+                ok = False
+            if not ok:
+                failed.add(input_file)
+                continue
+            for output_filepath, _, _ in group:
+                print(f"出力ファイル: {output_filepath}")
+            if index is not None:
+                index.set_sources(
+                    [(path, input_file) for path, _, _ in group], "separate"
+                )
+            written += len(group)
+    return written, sorted(failed)
 
 
 def main(args: Optional[Namespace] = None) -> None:
@@ -177,17 +621,72 @@ def main(args: Optional[Namespace] = None) -> None:
         print(f"入力ディレクトリが見つかりません: {input_dir}")
         return
 
-    for root, _, files in os.walk(input_dir):
-        for file in files:
-            input_file = os.path.join(root, file)
-            split_audio_file(
-                input_file,
+    error = split_options_error(
+        args.mode, args.interval, args.overlay, args.min_length, args.max_length
+    )
+    if error:
+        print(error)
+        return
+
+    planner: Optional[Planner] = None
+    if args.mode == "vad":
+        planner = partial(
+            plan_vad_segments,
+            start_time=args.start,
+            min_length=args.min_length,
+            max_length=args.max_length,
+            silence_threshold=args.silence_threshold,
+            min_silence=args.min_silence,
+        )
+
+    # raw/<ts> の下のフォルダも対象にするが、separate などの出力ディレクトリは除く
+    index = MetadataIndex(index_path(model_name, directory))
+    input_files = index.refresh(
+        input_dir, "raw", jobs=max(args.jobs, 4), recursive=True, exclude=STAGE_DIRS
+    )
+
+    report_file = instrumentation.report_path(model_name, directory)
+    with instrumentation.Recorder("02_separate", report_file, args.profile):
+        started_at = time.perf_counter()
+        failed: list[str] = []
+        if args.jobs > 1:
+            total_segments, failed = split_audio_files(
+                input_files,
                 output_dir,
                 args.start,
                 args.interval,
                 args.overlay,
                 args.force,
+                args.jobs,
+                planner,
+                index,
             )
+        else:
+            total_segments = 0
+            for input_file in input_files:
+                try:
+                    total_segments += split_audio_file(
+                        input_file,
+                        output_dir,
+                        args.start,
+                        args.interval,
+                        args.overlay,
+                        args.force,
+                        planner,
+                        index,
+                    )
+                except Exception as e:
+                    print(f"エラー: {input_file} の分割に失敗しました: {e}")
+                    failed.append(input_file)
+
+        elapsed = time.perf_counter() - started_at
+        print(
+            f"分割が完了しました: {total_segments} セグメント / {elapsed:.1f} 秒"
+            f"（{total_segments / elapsed if elapsed > 0 else 0:.2f} セグメント/秒）"
+        )
+        for input_file in failed:
+            print(f"分割に失敗したファイル: {input_file}")
+    index.close()
 
 
 if __name__ == "__main__":
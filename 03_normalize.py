@@ -1,10 +1,24 @@
 import sys
+import json
 import argparse
 import subprocess
 import os
+import shutil
+import time
 from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Optional
 
+import instrumentation
+from metadata_index import MetadataIndex, index_path
+
+AUDIO_EXTENSIONS = (".mp3", ".wav")
+# native エンジンで正規化済みのファイルを記録するマニフェスト
+MANIFEST_NAME = ".normalize_manifest.json"
+# 中断しても正規化済みのファイルをやり直さないよう、この件数か秒数ごとにマニフェストを保存する
+MANIFEST_SAVE_FILES = 100
+MANIFEST_SAVE_SECONDS = 30.0
+
 
 def parse_arguments() -> argparse.ArgumentParser:
     """
@@ -28,6 +42,21 @@ def parse_arguments() -> argparse.ArgumentParser:
         action="store_true",
         help="[OPTION] ラウドネス正規化を強制します。",
     )
+    parser.add_argument(
+        "--engine",
+        choices=["fap", "native"],
+        default="fap",
+        help="[OPTION] 正規化の方法。fap は fap loudness-norm でディレクトリ全体を処理し、"
+        "native はファイルごとに並列に処理して、新しいファイルや変更されたファイルだけを正規化します。",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count(),
+        help="[OPTION] native エンジンで並列に処理するプロセス数。デフォルトは CPU コア数です。",
+    )
+    instrumentation.add_arguments(parser)
     return parser
 
 
@@ -47,15 +76,139 @@ def normalize_loudness(input_dir: str, output_dir: str, loudness_target: float)
     subprocess.run(command, check=True)
 
 
+def normalize_file(input_file: str, output_file: str, loudness_target: float) -> str:
+    """
+    音声ファイル 1 つにラウドネス正規化を適用します。
+    一時ファイルに書き込んでから置き換えるため、途中で中断しても不完全なファイルは残りません。
+    """
+    import soundfile as sf
+
+    from audio_utils import loudness_normalize, write_audio
+
+    audio, rate = sf.read(input_file, dtype="float32")
+    write_audio(output_file, loudness_normalize(audio, rate, loudness_target), rate)
+    return output_file
+
+
+def save_manifest(manifest_path: str, manifest: dict) -> None:
+    """
+    マニフェストを一時ファイルに書き込んでから置き換えます。
+    """
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def normalize_loudness_incremental(
+    input_dir: str,
+    output_dir: str,
+    loudness_target: float,
+    force: bool,
+    jobs: int,
+    index: Optional[MetadataIndex] = None,
+) -> int:
+    """
+    新しいファイルと変更されたファイルだけにラウドネス正規化を適用します。
+    処理したファイルの一覧はファイルごとに出力ディレクトリのマニフェストに記録され、
+    中断しても正規化済みのファイルをやり直さないよう処理中も定期的に保存されます。
+    入力がなくなったファイルはマニフェストから取り除きます。
+    index を指定した場合は入力をインデックスから取得し、出力の元ファイルを記録します。
+    正規化したファイル数を返します。
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest: dict = {}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    if index is not None:
+        files = [os.path.basename(p) for p in index.refresh(input_dir, "separate")]
+    else:
+        files = sorted(f for f in os.listdir(input_dir) if f.endswith(AUDIO_EXTENSIONS))
+
+    # 入力がなくなったファイルの記録を残さない
+    manifest = {file: manifest[file] for file in files if file in manifest}
+
+    pending: dict[str, dict] = {}
+    for file in files:
+        stat = os.stat(os.path.join(input_dir, file))
+        entry = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "loudness_target": loudness_target,
+        }
+        if manifest.get(file) != entry or not os.path.exists(
+            os.path.join(output_dir, file)
+        ):
+            pending[file] = entry
+
+    print(f"正規化するファイル: {len(pending)} 件")
+    unsaved = 0
+    saved_at = time.monotonic()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                instrumentation.timed_call,
+                normalize_file,
+                os.path.join(input_dir, file),
+                os.path.join(output_dir, file),
+                loudness_target,
+            ): file
+            for file in pending
+        }
+        for future in as_completed(futures):
+            file = futures[future]
+            try:
+                elapsed, output_file = future.result()
+            except Exception as e:
+                print(f"エラー: {file} の正規化に失敗しました: {e}")
+                continue
+            instrumentation.record(elapsed)
+            print(f"正規化されたファイル: {output_file}")
+            if index is not None:
+                source = os.path.join(input_dir, file)
+                index.set_sources([(output_file, source)], "normalize_loudness")
+            manifest[file] = pending[file]
+            unsaved += 1
+            if (
+                unsaved >= MANIFEST_SAVE_FILES
+                or time.monotonic() - saved_at >= MANIFEST_SAVE_SECONDS
+            ):
+                save_manifest(manifest_path, manifest)
+                unsaved = 0
+                saved_at = time.monotonic()
+
+    save_manifest(manifest_path, manifest)
+    return len(pending)
+
+
+def copy_sidecars(input_dir: str, output_dir: str, extension: str = ".lab") -> int:
+    """
+    正規化した音声ファイルと同名のテキストファイル（05 --long-form で作成した lab など）を
+    出力ディレクトリにコピーします。コピーしたファイル数を返します。
+    """
+    copied = 0
+    for file in sorted(os.listdir(input_dir)):
+        if not file.endswith(extension):
+            continue
+        base = os.path.splitext(file)[0]
+        if not any(
+            os.path.exists(os.path.join(output_dir, base + audio_extension))
+            for audio_extension in AUDIO_EXTENSIONS
+        ):
+            continue
+        shutil.copy2(os.path.join(input_dir, file), os.path.join(output_dir, file))
+        copied += 1
+    return copied
+
+
 def main(args: Optional[Namespace] = None) -> None:
     """
     メイン関数。コマンドライン引数を解析し、音声ファイルのコピーと分割を実行します。
     """
-    parser = parse_arguments()
-    if len(sys.argv) == 1:
-        parser.print_help()
-        sys.exit(1)
-    args = parser.parse_args()
+    if args is None:
+        args = parse_arguments().parse_args()
 
     model_name = os.getenv("MODEL_NAME") or args.model_name
     if not model_name:
@@ -74,14 +227,33 @@ def main(args: Optional[Namespace] = None) -> None:
     os.makedirs(normalize_dir, exist_ok=True)
     normalize_flag_file = os.path.join(normalize_dir, ".normalized")
 
-    # ラウドネス正規化を適用
-    if os.path.exists(normalize_flag_file) and not args.force:
-        print("ラウドネス正規化は既に適用されています。")
-    else:
-        normalize_loudness(input_dir, normalize_dir, args.loudness_target)
-        with open(normalize_flag_file, "w") as f:
-            f.write("normalized")
-        print("ラウドネス正規化を適用しました。")
+    report_file = instrumentation.report_path(model_name, directory)
+    with instrumentation.Recorder("03_normalize", report_file, args.profile):
+        if args.engine == "native":
+            index = MetadataIndex(index_path(model_name, directory))
+            normalize_loudness_incremental(
+                input_dir,
+                normalize_dir,
+                args.loudness_target,
+                args.force,
+                args.jobs,
+                index,
+            )
+            index.close()
+            copy_sidecars(input_dir, normalize_dir)
+            return
+
+        # ラウドネス正規化を適用
+        if os.path.exists(normalize_flag_file) and not args.force:
+            print("ラウドネス正規化は既に適用されています。")
+        else:
+            files = [f for f in os.listdir(input_dir) if f.endswith(AUDIO_EXTENSIONS)]
+            with instrumentation.measure("directory", len(files)):
+                normalize_loudness(input_dir, normalize_dir, args.loudness_target)
+            with open(normalize_flag_file, "w") as f:
+                f.write("normalized")
+            print("ラウドネス正規化を適用しました。")
+        copy_sidecars(input_dir, normalize_dir)
 
 
 if __name__ == "__main__":
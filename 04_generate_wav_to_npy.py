@@ -1,6 +1,15 @@
 import argparse
 import os
 import subprocess
+from typing import Optional
+
+import instrumentation
+import work_queue
+from metadata_index import MetadataIndex, index_path, list_audio_files
+from pcm_cache import DEFAULT_PCM_CACHE_DIR, DEFAULT_PCM_CACHE_MB, PCMCache
+from quality_filter import skip_rejected
+from vq_cache import VQTokenCache, add_vq_cache_arguments, open_vq_cache
+from work_queue import LeaseQueue, lease_dir
 
 
 def parse_arguments():
@@ -24,16 +33,66 @@ def parse_arguments():
         type=str,
         help="チェックポイントファイルのパス (環境変数 FS_CHECKPOINT_PATH が優先されます)",
     )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="[OPTION] ファイルごとに inference.py を起動せず、モデルを一度だけ読み込んで"
+        "このプロセス内でまとめてエンコードします。",
+    )
+    parser.add_argument(
+        "--config-name",
+        type=str,
+        default="firefly_gan_vq",
+        help="[OPTION] --in-process で使う設定ファイルの名前",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        help="[OPTION] --in-process で使うデバイス（cuda / cpu）。省略時は GPU があれば cuda を使います。",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=8,
+        help="[OPTION] --in-process でまとめてエンコードするファイル数",
+    )
+    parser.add_argument(
+        "--pcm-cache-dir",
+        default=DEFAULT_PCM_CACHE_DIR,
+        help=f"[OPTION] --in-process で使うデコード済み音声のキャッシュのディレクトリ。デフォルトは {DEFAULT_PCM_CACHE_DIR} です。",
+    )
+    parser.add_argument(
+        "--pcm-cache-max-mb",
+        type=int,
+        default=DEFAULT_PCM_CACHE_MB,
+        help=f"[OPTION] デコード済み音声のキャッシュの最大サイズ（MB）。デフォルトは {DEFAULT_PCM_CACHE_MB} です。",
+    )
+    parser.add_argument(
+        "--no-pcm-cache",
+        action="store_true",
+        help="[OPTION] --in-process でデコード済み音声のキャッシュを使用しません。",
+    )
+    add_vq_cache_arguments(parser)
+    work_queue.add_arguments(parser)
+    instrumentation.add_arguments(parser)
     return parser.parse_args()
 
 
-def generate_npy(input_file: str, output_dir: str, checkpoint_path: str):
+def npy_output_path(input_file: str, output_dir: str) -> str:
     """
-    npy ファイルを生成します。
+    入力ファイルに対応する npy ファイルのパスを返します。
+    ファイル名は Shift-JIS で表現できない文字を取り除いたものになります。
     """
     base_name = os.path.splitext(os.path.basename(input_file))[0]
     encoded_name = base_name.encode("shift_jis", errors="ignore").decode("shift_jis")
-    output_file = os.path.join(output_dir, encoded_name + ".npy")
+    return os.path.join(output_dir, encoded_name + ".npy")
+
+
+def generate_npy(input_file: str, output_dir: str, checkpoint_path: str) -> bool:
+    """
+    npy ファイルを生成します。生成できた場合は True を返します。
+    """
+    output_file = npy_output_path(input_file, output_dir)
     command = [
         ".venv\\Scripts\\python",
         "tools/vqgan/inference.py",
@@ -48,8 +107,79 @@ def generate_npy(input_file: str, output_dir: str, checkpoint_path: str):
     result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if result.returncode != 0:
         print(f"Error: {result.stderr.decode('utf-8', errors='ignore')}")
+        return False
+    print(f"Generated npy file: {output_file}")
+    return True
+
+
+def generate_npy_files(
+    input_files: list[str],
+    output_dir: str,
+    checkpoint_path: str,
+    vq_cache: Optional[VQTokenCache] = None,
+) -> list[str]:
+    """
+    ファイルごとに inference.py を実行して npy ファイルを生成します。
+    vq_cache を指定した場合、エンコード済みの音声はキャッシュから書き出し、生成した結果をキャッシュに保存します。
+    npy ファイルを書き出せた音声ファイルを返します。
+    """
+    output_files = [npy_output_path(f, output_dir) for f in input_files]
+    pending = list(zip(input_files, output_files))
+    if vq_cache is not None:
+        pending = vq_cache.restore(input_files, output_files)
+    failed = set()
+    for input_file, _ in pending:
+        with instrumentation.measure():
+            if not generate_npy(input_file, output_dir, checkpoint_path):
+                failed.add(input_file)
+    if vq_cache is not None:
+        vq_cache.store(
+            [input_file for input_file, _ in pending if input_file not in failed],
+            [
+                output_file
+                for input_file, output_file in pending
+                if input_file not in failed
+            ],
+        )
+    return [input_file for input_file in input_files if input_file not in failed]
+
+
+def generate_npy_in_process(
+    input_files: list[str],
+    output_dir: str,
+    checkpoint_path: str,
+    config_name: str,
+    device: Optional[str],
+    batch_size: int,
+    pcm_cache: Optional[PCMCache] = None,
+    vq_cache: Optional[VQTokenCache] = None,
+) -> int:
+    """
+    モデルを一度だけ読み込み、すべての音声ファイルの npy ファイルを生成します。
+    pcm_cache を指定した場合、デコード済みの音声をキャッシュから読み込みます。
+    vq_cache を指定した場合、エンコード済みの音声はキャッシュから書き出します。
+    生成したファイル数を返します。
+    """
+    import vq_encoder
+
+    output_files = [npy_output_path(f, output_dir) for f in input_files]
+    if vq_cache is not None:
+        missing = vq_cache.restore(input_files, output_files)
+        restored = len(input_files) - len(missing)
+        print(f"VQ トークンのキャッシュから書き出しました: {restored} ファイル")
+        if not missing:
+            return restored
+        input_files = [input_file for input_file, _ in missing]
+        output_files = [output_file for _, output_file in missing]
     else:
-        print(f"Generated npy file: {output_file}")
+        restored = 0
+
+    model = vq_encoder.load_vq_model(
+        checkpoint_path, config_name, device or vq_encoder.default_device()
+    )
+    return restored + vq_encoder.encode_files(
+        model, input_files, output_files, batch_size, pcm_cache, vq_cache=vq_cache
+    )
 
 
 def main():
@@ -75,11 +205,67 @@ def main():
     output_dir = os.path.join(f"./data/{model_name}/raw/{directory}/npy")
     os.makedirs(output_dir, exist_ok=True)
 
-    for root, _, files in os.walk(input_dir):
-        for file in files:
-            if file.endswith((".wav", ".mp3")):
-                input_file = os.path.join(root, file)
-                generate_npy(input_file, output_dir, checkpoint_path)
+    queue: Optional[LeaseQueue] = None
+    stage = "04_generate_wav_to_npy"
+    if args.distributed:
+        if not work_queue.check_local_caches(
+            {
+                "--vq-cache-path": None if args.no_vq_cache else args.vq_cache_path,
+                "--pcm-cache-dir": (
+                    args.pcm_cache_dir
+                    if args.in_process and not args.no_pcm_cache
+                    else None
+                ),
+            }
+        ):
+            return
+        # 共有のインデックスには複数のマシンから書き込まない
+        input_files = list_audio_files(input_dir, recursive=True)
+        queue = LeaseQueue(
+            lease_dir(model_name, directory, stage), args.worker_id, args.lease_seconds
+        )
+        stage = f"{stage}@{queue.worker_id}"
+    else:
+        index = MetadataIndex(index_path(model_name, directory))
+        input_files = index.refresh(input_dir, "normalize_loudness", recursive=True)
+        index.close()
+    input_files = skip_rejected(input_files, f"./data/{model_name}/raw/{directory}")
+
+    report_file = instrumentation.report_path(model_name, directory)
+    with instrumentation.Recorder(stage, report_file, args.profile):
+        vq_cache = open_vq_cache(args, checkpoint_path, args.config_name)
+        pcm_cache: Optional[PCMCache] = None
+        if args.in_process and not args.no_pcm_cache:
+            pcm_cache = PCMCache(
+                args.pcm_cache_dir, args.pcm_cache_max_mb * 1024 * 1024
+            )
+
+        def process(files: list[str]) -> list[str]:
+            if args.in_process:
+                # 失敗した場合は例外が送出される
+                generate_npy_in_process(
+                    files,
+                    output_dir,
+                    checkpoint_path,
+                    args.config_name,
+                    args.device,
+                    args.batch_size,
+                    pcm_cache,
+                    vq_cache,
+                )
+                return files
+            return generate_npy_files(files, output_dir, checkpoint_path, vq_cache)
+
+        if queue is not None:
+            queue.run(input_files, process, args.claim_size)
+        else:
+            process(input_files)
+
+        if pcm_cache is not None:
+            pcm_cache.close()
+        if vq_cache is not None:
+            vq_cache.print_stats()
+            vq_cache.close()
 
 
 if __name__ == "__main__":
@@ -1,8 +1,32 @@
 import os
+import sys
 import argparse
+import importlib
+import time
 from argparse import Namespace
-from typing import Optional
-import whisper
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional
+import numpy as np
+
+import instrumentation
+import work_queue
+from metadata_index import STAGE_DIRS, MetadataIndex, index_path, list_audio_files
+from pcm_cache import DEFAULT_PCM_CACHE_DIR, DEFAULT_PCM_CACHE_MB, PCMCache
+from quality_filter import skip_rejected
+from cache_utils import BlobCache, content_hash
+from work_queue import LeaseQueue, lease_dir
+
+# torch と Whisper の読み込みには数秒かかるため、--help などでは読み込まず、使う関数の中で読み込む
+if TYPE_CHECKING:
+    import whisper
+
+# Whisper の入力は 16kHz・30 秒の窓
+WHISPER_SAMPLE_RATE = 16000
+# 文字起こし結果のキャッシュ（音声の内容・Whisper モデル・言語をキーにする）
+DEFAULT_CACHE_PATH = "./data/cache/transcripts.sqlite3"
+# 長尺モードでクリップの前後に加える余白（秒）。単語のタイムスタンプの誤差を吸収する
+CLIP_PADDING = 0.1
 
 
 def parse_arguments() -> Namespace:
@@ -33,18 +57,385 @@ def parse_arguments() -> Namespace:
         default="lab",
         help="[OPTION] 出力ファイルの拡張子。デフォルトは 'lab' です。",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=8,
+        help="[OPTION] まとめて文字起こしするファイル数。デフォルトは 8 です。",
+    )
+    parser.add_argument(
+        "--cache-path",
+        default=DEFAULT_CACHE_PATH,
+        help=f"[OPTION] 文字起こし結果のキャッシュのパス。デフォルトは {DEFAULT_CACHE_PATH} です。",
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=512,
+        help="[OPTION] キャッシュの最大サイズ（MB）。デフォルトは 512 です。",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="[OPTION] 文字起こし結果のキャッシュを使用しません。",
+    )
+    parser.add_argument(
+        "--pcm-cache-dir",
+        default=DEFAULT_PCM_CACHE_DIR,
+        help=f"[OPTION] デコード済み音声のキャッシュのディレクトリ。デフォルトは {DEFAULT_PCM_CACHE_DIR} です。",
+    )
+    parser.add_argument(
+        "--pcm-cache-max-mb",
+        type=int,
+        default=DEFAULT_PCM_CACHE_MB,
+        help=f"[OPTION] デコード済み音声のキャッシュの最大サイズ（MB）。デフォルトは {DEFAULT_PCM_CACHE_MB} です。",
+    )
+    parser.add_argument(
+        "--no-pcm-cache",
+        action="store_true",
+        help="[OPTION] デコード済み音声のキャッシュを使用せず、毎回 ffmpeg でデコードします。",
+    )
+    parser.add_argument(
+        "--long-form",
+        action="store_true",
+        help="[OPTION] 02 で分割する代わりに raw の元の音声ファイルを 1 回ずつ文字起こしし、"
+        "単語のタイムスタンプで区切ったクリップと lab ファイルを separate に書き出します。",
+    )
+    parser.add_argument(
+        "--min-length",
+        type=float,
+        default=3.0,
+        help="[OPTION] --long-form: クリップの最小の長さ（秒）。これより短いクリップは書き出しません。",
+    )
+    parser.add_argument(
+        "--max-length",
+        type=float,
+        default=30.0,
+        help="[OPTION] --long-form: クリップの最大の長さ（秒）",
+    )
+    parser.add_argument(
+        "--force",
+        "-F",
+        action="store_true",
+        help="[OPTION] --long-form: 既存のクリップを上書きします。",
+    )
+    work_queue.add_arguments(parser)
+    instrumentation.add_arguments(parser)
     return parser.parse_args()
 
 
-def speech_to_text(input_file: str, model_name: str) -> str:
+@lru_cache(maxsize=None)
+def load_whisper_model(model_name: str) -> "whisper.Whisper":
+    """
+    Whisper モデルを読み込みます。同じプロセス内では一度だけ読み込まれます。
+    """
+    import whisper
+
+    return whisper.load_model(model_name)
+
+
+def load_audio(input_file: str, pcm_cache: Optional[PCMCache] = None) -> np.ndarray:
+    """
+    音声ファイルを 16kHz の配列として読み込みます。
+    pcm_cache を指定した場合はデコード済みの配列をキャッシュから読み込みます。
+    """
+    if pcm_cache is not None:
+        return pcm_cache.load(input_file, WHISPER_SAMPLE_RATE)
+    import whisper
+
+    return whisper.load_audio(input_file)
+
+
+def speech_to_text(
+    input_file: str, model_name: str, pcm_cache: Optional[PCMCache] = None
+) -> str:
     """
     音声ファイルからテキストデータを抽出します。
     """
-    model = whisper.load_model(model_name)
-    result = model.transcribe(input_file, language="ja")
+    model = load_whisper_model(model_name)
+    result = model.transcribe(load_audio(input_file, pcm_cache), language="ja")
     return result["text"]
 
 
+def transcribe_batch(
+    model: "whisper.Whisper", audios: list[np.ndarray], language: str = "ja"
+) -> list[str]:
+    """
+    16kHz の音声配列をまとめて文字起こしします。
+    30 秒以内の音声は 30 秒の mel 窓にパディングして 1 回のデコードで処理し、
+    30 秒を超える音声は transcribe で個別に処理します。
+    """
+    import torch
+    import whisper
+
+    texts: list[str] = [""] * len(audios)
+    short: list[int] = []
+    for i, audio in enumerate(audios):
+        if len(audio) <= whisper.audio.N_SAMPLES:
+            short.append(i)
+        else:
+            texts[i] = model.transcribe(audio, language=language)["text"]
+
+    if short:
+        mel = torch.stack(
+            [
+                whisper.log_mel_spectrogram(
+                    whisper.pad_or_trim(audios[i]), n_mels=model.dims.n_mels
+                )
+                for i in short
+            ]
+        ).to(model.device)
+        options = whisper.DecodingOptions(
+            language=language,
+            without_timestamps=True,
+            fp16=model.device.type == "cuda",
+        )
+        for i, result in zip(short, whisper.decode(model, mel, options)):
+            texts[i] = result.text
+    return texts
+
+
+def load_audios(
+    input_files: list[str], pcm_cache: Optional[PCMCache] = None
+) -> list[np.ndarray]:
+    """
+    複数の音声ファイルを 16kHz の配列として読み込みます。
+    """
+    return [load_audio(input_file, pcm_cache) for input_file in input_files]
+
+
+def write_text(output_file: str, text: str) -> None:
+    """
+    テキストデータをファイルに保存します。
+    """
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(text)
+    print(f"テキストデータを保存しました: {output_file}")
+    print(f"テキストの内容: {text}")
+
+
+def transcript_cache_key(input_file: str, model_name: str, language: str) -> str:
+    """
+    音声ファイルの内容のハッシュ、Whisper モデル名、言語からキャッシュのキーを作成します。
+    """
+    return f"{content_hash(input_file)}:{model_name}:{language}"
+
+
+def transcribe_files(
+    input_files: list[str],
+    model_name: str,
+    extension: str,
+    batch_size: int,
+    cache: Optional[BlobCache] = None,
+    language: str = "ja",
+    pcm_cache: Optional[PCMCache] = None,
+) -> float:
+    """
+    音声ファイルをバッチ単位で文字起こしし、同名のテキストファイルに保存します。
+    次のバッチの読み込みとテキストの書き込みは、文字起こしと並行して行います。
+    cache を指定した場合、同じ内容の音声はキャッシュの結果を再利用します。
+    pcm_cache を指定した場合、デコード済みの音声をキャッシュから読み込みます。
+    文字起こしした音声の合計秒数を返します。
+    """
+    keys: dict[str, str] = {}
+    if cache is not None:
+        remaining: list[str] = []
+        for input_file in input_files:
+            key = transcript_cache_key(input_file, model_name, language)
+            cached = cache.get(key)
+            if cached is None:
+                keys[input_file] = key
+                remaining.append(input_file)
+            else:
+                output_file = os.path.splitext(input_file)[0] + f".{extension}"
+                write_text(output_file, cached.decode("utf-8"))
+        input_files = remaining
+    if not input_files:
+        return 0.0
+
+    model = load_whisper_model(model_name)
+    batches = [
+        input_files[i : i + batch_size] for i in range(0, len(input_files), batch_size)
+    ]
+    audio_seconds = 0.0
+    writes = []
+    with ThreadPoolExecutor(max_workers=1) as loader, ThreadPoolExecutor(
+        max_workers=1
+    ) as writer:
+        next_audios = (
+            loader.submit(load_audios, batches[0], pcm_cache) if batches else None
+        )
+        for index, batch in enumerate(batches):
+            audios = next_audios.result()
+            if index + 1 < len(batches):
+                next_audios = loader.submit(load_audios, batches[index + 1], pcm_cache)
+            with instrumentation.measure("batch", len(batch)):
+                texts = transcribe_batch(model, audios, language)
+            for input_file, audio, text in zip(batch, audios, texts):
+                audio_seconds += len(audio) / WHISPER_SAMPLE_RATE
+                if cache is not None:
+                    cache.put(keys[input_file], text.encode("utf-8"))
+                output_file = os.path.splitext(input_file)[0] + f".{extension}"
+                writes.append(writer.submit(write_text, output_file, text))
+    # 書き込み中の例外をここで送出する
+    for write in writes:
+        write.result()
+    return audio_seconds
+
+
+def split_long_segments(segments: list[dict], max_length: float) -> list[dict]:
+    """
+    Whisper のセグメントのうち max_length 秒を超えるものを、単語の境界で max_length 秒以内に分けます。
+    各要素は start / end / text を持つ辞書です。
+    """
+    units: list[dict] = []
+    for segment in segments:
+        words = segment.get("words") or []
+        if segment["end"] - segment["start"] <= max_length or not words:
+            units.append(
+                {
+                    "start": segment["start"],
+                    "end": segment["end"],
+                    "text": segment["text"],
+                }
+            )
+            continue
+        chunk: list[dict] = []
+        for word in words:
+            if chunk and word["end"] - chunk[0]["start"] > max_length:
+                units.append(
+                    {
+                        "start": chunk[0]["start"],
+                        "end": chunk[-1]["end"],
+                        "text": "".join(w["word"] for w in chunk),
+                    }
+                )
+                chunk = []
+            chunk.append(word)
+        if chunk:
+            units.append(
+                {
+                    "start": chunk[0]["start"],
+                    "end": chunk[-1]["end"],
+                    "text": "".join(w["word"] for w in chunk),
+                }
+            )
+    return units
+
+
+def plan_clips(
+    segments: list[dict],
+    duration: float,
+    min_length: float = 3.0,
+    max_length: float = 30.0,
+    padding: float = CLIP_PADDING,
+) -> list[tuple[float, float, str]]:
+    """
+    Whisper のセグメント（と単語）のタイムスタンプから、クリップの (開始時間, 終了時間, テキスト) の一覧を作成します。
+    連続するセグメントを max_length 秒を超えない範囲でまとめ、区切りは必ずセグメントか単語の境界になります。
+    前後に padding 秒の余白を加えますが、隣のクリップとは重なりません。
+    min_length 秒より短いクリップは含みません。
+    """
+    max_length = max(max_length - 2 * padding, padding)
+    clips: list[dict] = []
+    for unit in split_long_segments(segments, max_length):
+        if not unit["text"].strip() or unit["end"] <= unit["start"]:
+            continue
+        if clips and unit["end"] - clips[-1]["start"] <= max_length:
+            clips[-1]["end"] = unit["end"]
+            clips[-1]["text"] += unit["text"]
+        else:
+            clips.append(dict(unit))
+
+    planned: list[tuple[float, float, str]] = []
+    for i, clip in enumerate(clips):
+        # 余白は隣のクリップとの中間までに制限する
+        lower = (clips[i - 1]["end"] + clip["start"]) / 2 if i > 0 else 0.0
+        upper = (
+            (clip["end"] + clips[i + 1]["start"]) / 2
+            if i + 1 < len(clips)
+            else duration
+        )
+        start = max(lower, clip["start"] - padding)
+        end = min(upper, clip["end"] + padding)
+        if end - start >= min_length:
+            planned.append((round(start, 2), round(end, 2), clip["text"].strip()))
+    return planned
+
+
+def transcribe_long_form(
+    input_files: list[str],
+    output_dir: str,
+    model_name: str,
+    extension: str,
+    min_length: float,
+    max_length: float,
+    force: bool,
+    language: str = "ja",
+    pcm_cache: Optional[PCMCache] = None,
+    index: Optional[MetadataIndex] = None,
+) -> tuple[int, float, list[str]]:
+    """
+    元の音声ファイルを 1 回ずつ単語のタイムスタンプ付きで文字起こしし、
+    タイムスタンプで区切ったクリップと、そのテキストの lab ファイルを出力ディレクトリに書き出します。
+    クリップの書き出しには 02 と同じ ffmpeg の処理を使います。
+    書き出したクリップの数、文字起こしした音声の合計秒数と、クリップの書き出しに失敗したファイルを返します。
+    """
+    separate = importlib.import_module("02_separate")
+    model = load_whisper_model(model_name)
+    os.makedirs(output_dir, exist_ok=True)
+    written = 0
+    audio_seconds = 0.0
+    failed: list[str] = []
+    for input_file in input_files:
+        base_filename, file_extension = os.path.splitext(os.path.basename(input_file))
+        with instrumentation.measure("source"):
+            audio = load_audio(input_file, pcm_cache)
+            duration = len(audio) / WHISPER_SAMPLE_RATE
+            result = model.transcribe(audio, language=language, word_timestamps=True)
+        audio_seconds += duration
+        clips = plan_clips(result["segments"], duration, min_length, max_length)
+
+        pending: list[tuple[str, float, float]] = []
+        texts: dict[str, str] = {}
+        for segment_number, (start, end, text) in enumerate(clips, start=1):
+            output_filepath = os.path.join(
+                output_dir,
+                separate.generate_output_filename(
+                    base_filename,
+                    segment_number,
+                    int(start),
+                    int(end),
+                    file_extension,
+                ),
+            )
+            if os.path.exists(output_filepath) and not force:
+                print(f"スキップされたファイル: {output_filepath}（既に存在します）")
+                continue
+            pending.append((output_filepath, start, end))
+            texts[output_filepath] = text
+
+        for group in separate.group_segments(pending):
+            # ffmpeg は既存のファイルを上書きしないため、先に削除しておく
+            for output_filepath, _, _ in group:
+                if os.path.exists(output_filepath):
+                    os.remove(output_filepath)
+            if not separate.write_segments(input_file, group):
+                print(f"エラー: {input_file} のクリップの書き出しに失敗しました")
+                if input_file not in failed:
+                    failed.append(input_file)
+                continue
+            for output_filepath, _, _ in group:
+                lab_file = os.path.splitext(output_filepath)[0] + f".{extension}"
+                write_text(lab_file, texts[output_filepath])
+            if index is not None:
+                index.set_sources(
+                    [(path, input_file) for path, _, _ in group], "separate"
+                )
+            written += len(group)
+    return written, audio_seconds, failed
+
+
 def main(args: Optional[Namespace] = None) -> None:
     """
     メイン関数。音声ファイルからテキストデータを抽出し、同名のファイルに保存します。
@@ -69,17 +460,138 @@ def main(args: Optional[Namespace] = None) -> None:
         print("ディレクトリが指定されていません。")
         return
 
-    input_dir = f"./data/{model_name}/raw/{directory}/normalize_loudness"
-
-    for file in sorted(os.listdir(input_dir)):
-        if file.endswith((".mp3", ".wav")):
-            input_file: str = os.path.join(input_dir, file)
-            output_file: str = os.path.splitext(input_file)[0] + f".{args.extension}"
-            text: str = speech_to_text(input_file, whisper_model)
-            with open(output_file, "w", encoding="utf-8") as f:
-                f.write(text)
-            print(f"テキストデータを保存しました: {output_file}")
-            print(f"テキストの内容: {text}")
+    raw_dir = f"./data/{model_name}/raw/{directory}"
+    input_dir = os.path.join(raw_dir, "normalize_loudness")
+
+    if args.long_form and args.min_length >= args.max_length:
+        print("エラー: --min-length は --max-length より小さくしてください。")
+        return
+
+    stage = "05_speech_to_text"
+    queue: Optional[LeaseQueue] = None
+    # 共有のインデックスには複数のマシンから書き込まないため、--distributed では使わない
+    index: Optional[MetadataIndex] = None
+    if args.distributed:
+        if not work_queue.check_local_caches(
+            {
+                "--cache-path": (
+                    None if args.no_cache or args.long_form else args.cache_path
+                ),
+                "--pcm-cache-dir": None if args.no_pcm_cache else args.pcm_cache_dir,
+            }
+        ):
+            return
+        queue = LeaseQueue(
+            lease_dir(model_name, directory, stage), args.worker_id, args.lease_seconds
+        )
+        stage = f"{stage}@{queue.worker_id}"
+    else:
+        index = MetadataIndex(index_path(model_name, directory))
+
+    pcm_cache: Optional[PCMCache] = None
+    if not args.no_pcm_cache:
+        pcm_cache = PCMCache(args.pcm_cache_dir, args.pcm_cache_max_mb * 1024 * 1024)
+
+    report_file = instrumentation.report_path(model_name, directory)
+    if args.long_form:
+        # 02 の代わりに、raw の下の元の音声ファイルから separate にクリップを書き出す
+        input_files = (
+            index.refresh(raw_dir, "raw", recursive=True, exclude=STAGE_DIRS)
+            if index is not None
+            else list_audio_files(raw_dir, recursive=True, exclude=STAGE_DIRS)
+        )
+        with instrumentation.Recorder(stage, report_file, args.profile):
+            started_at = time.perf_counter()
+            clips, audio_seconds = 0, 0.0
+            failed: list[str] = []
+
+            def process_long_form(files: list[str]) -> list[str]:
+                nonlocal clips, audio_seconds
+                written, seconds, errors = transcribe_long_form(
+                    files,
+                    os.path.join(raw_dir, "separate"),
+                    whisper_model,
+                    args.extension,
+                    args.min_length,
+                    args.max_length,
+                    args.force,
+                    pcm_cache=pcm_cache,
+                    index=index,
+                )
+                clips += written
+                audio_seconds += seconds
+                failed.extend(errors)
+                # 失敗したファイルは完了として記録せず、次の実行か他のワーカーが処理し直す
+                return [path for path in files if path not in errors]
+
+            if queue is not None:
+                queue.run(input_files, process_long_form, args.claim_size)
+            else:
+                process_long_form(input_files)
+            elapsed = time.perf_counter() - started_at
+            print(
+                f"長尺の文字起こしが完了しました: {len(input_files)} ファイル / {clips} クリップ / "
+                f"音声 {audio_seconds:.1f} 秒 / {elapsed:.1f} 秒"
+            )
+            for input_file in failed:
+                print(f"クリップの書き出しに失敗したファイル: {input_file}")
+        if index is not None:
+            index.close()
+        if pcm_cache is not None:
+            pcm_cache.close()
+        if failed:
+            sys.exit(1)
+        return
+
+    if index is not None:
+        input_files = index.refresh(input_dir, "normalize_loudness")
+        index.close()
+    else:
+        input_files = list_audio_files(input_dir)
+    input_files = skip_rejected(input_files, raw_dir)
+
+    cache: Optional[BlobCache] = None
+    if not args.no_cache:
+        cache = BlobCache(args.cache_path, args.cache_max_mb * 1024 * 1024)
+
+    with instrumentation.Recorder(stage, report_file, args.profile):
+        started_at = time.perf_counter()
+        audio_seconds = 0.0
+
+        def process(files: list[str]) -> None:
+            nonlocal audio_seconds
+            audio_seconds += transcribe_files(
+                files,
+                whisper_model,
+                args.extension,
+                args.batch_size,
+                cache,
+                pcm_cache=pcm_cache,
+            )
+
+        if queue is not None:
+            queue.run(input_files, process, args.claim_size)
+        else:
+            process(input_files)
+        elapsed = time.perf_counter() - started_at
+        print(
+            f"文字起こしが完了しました: {len(input_files)} ファイル / 音声 {audio_seconds:.1f} 秒 / "
+            f"{elapsed:.1f} 秒（{audio_seconds / elapsed if elapsed > 0 else 0:.2f} 音声秒/秒）"
+        )
+        if cache is not None:
+            stats = cache.stats()
+            print(
+                f"キャッシュ: ヒット {stats['hits']} 件 / ミス {stats['misses']} 件 / "
+                f"保存 {stats['entries']} 件（{stats['bytes'] / 1024 / 1024:.1f} MB）"
+            )
+            cache.close()
+        if pcm_cache is not None:
+            stats = pcm_cache.stats()
+            print(
+                f"デコード済み音声のキャッシュ: ヒット {stats['hits']} 件 / ミス {stats['misses']} 件 / "
+                f"保存 {stats['entries']} 件（{stats['bytes'] / 1024 / 1024:.1f} MB）"
+            )
+            pcm_cache.close()
 
 
 if __name__ == "__main__":
@@ -4,6 +4,16 @@ import argparse
 from argparse import Namespace
 from typing import Optional
 
+import instrumentation
+import work_queue
+from pcm_cache import DEFAULT_PCM_CACHE_DIR, DEFAULT_PCM_CACHE_MB, PCMCache
+from quality_filter import load_rejected, skip_rejected
+from vq_cache import VQTokenCache, add_vq_cache_arguments, open_vq_cache
+from work_queue import LeaseQueue, lease_dir
+
+AUDIO_EXTENSIONS = (".mp3", ".wav")
+EXTRACT_VQ_BATCH_SIZE = 16
+
 
 def parse_arguments() -> argparse.Namespace:
     """
@@ -40,9 +50,46 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument(
         "--batch-size",
         type=int,
-        default=16,
-        help="バッチサイズを指定します。",
+        help=f"[OPTION] extract_vq.py のバッチサイズ。デフォルトは {EXTRACT_VQ_BATCH_SIZE} です。"
+        "--in-process では 1 バッチにまとめるクリップ数の上限で、デフォルトは制限なしです"
+        "（バッチの大きさは --max-batch-seconds で決まります）。",
+    )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="[OPTION] extract_vq.py を起動せず、このプロセス内で長さの近いクリップをまとめてエンコードします。",
+    )
+    parser.add_argument(
+        "--max-batch-seconds",
+        type=float,
+        default=240.0,
+        help="[OPTION] --in-process: 1 バッチのパディング後の音声の長さの合計（秒）。"
+        "短いクリップほど 1 バッチに多くまとめます。",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        help="[OPTION] --in-process で使うデバイス（cuda / cpu）。省略時は GPU があれば cuda を使います。",
+    )
+    parser.add_argument(
+        "--pcm-cache-dir",
+        default=DEFAULT_PCM_CACHE_DIR,
+        help=f"[OPTION] --in-process で使うデコード済み音声のキャッシュのディレクトリ。デフォルトは {DEFAULT_PCM_CACHE_DIR} です。",
+    )
+    parser.add_argument(
+        "--pcm-cache-max-mb",
+        type=int,
+        default=DEFAULT_PCM_CACHE_MB,
+        help=f"[OPTION] デコード済み音声のキャッシュの最大サイズ（MB）。デフォルトは {DEFAULT_PCM_CACHE_MB} です。",
     )
+    parser.add_argument(
+        "--no-pcm-cache",
+        action="store_true",
+        help="[OPTION] --in-process でデコード済み音声のキャッシュを使用しません。",
+    )
+    add_vq_cache_arguments(parser)
+    work_queue.add_arguments(parser)
+    instrumentation.add_arguments(parser)
     return parser.parse_args()
 
 
@@ -50,6 +97,11 @@ def run_extract_vq(target_dir: str, args: Namespace) -> None:
     """
     extract_vq.py スクリプトを実行します。
     """
+    if load_rejected(os.path.dirname(os.path.normpath(target_dir))):
+        print(
+            "extract_vq.py は品質フィルタで除外したクリップもエンコードします。"
+            "除外する場合は --in-process を指定してください。"
+        )
     command = [
         ".venv/Scripts/python",
         "tools/vqgan/extract_vq.py",
@@ -57,7 +109,7 @@ def run_extract_vq(target_dir: str, args: Namespace) -> None:
         "--num-workers",
         str(args.num_workers),
         "--batch-size",
-        str(args.batch_size),
+        str(args.batch_size or EXTRACT_VQ_BATCH_SIZE),
         "--config-name",
         args.config_name,
         "--checkpoint-path",
@@ -66,6 +118,108 @@ def run_extract_vq(target_dir: str, args: Namespace) -> None:
     subprocess.run(command, check=True)
 
 
+def list_pending(target_dir: str) -> list[str]:
+    """
+    extract_vq.py と同様に、npy ファイルがない音声ファイルを返します。
+    品質フィルタで除外したクリップは含めません。
+    """
+    input_files: list[str] = []
+    for root, _, files in os.walk(target_dir):
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            if file.endswith(AUDIO_EXTENSIONS) and not os.path.exists(
+                os.path.splitext(path)[0] + ".npy"
+            ):
+                input_files.append(path)
+    return skip_rejected(input_files, os.path.dirname(os.path.normpath(target_dir)))
+
+
+def restore_from_cache(input_files: list[str], vq_cache: VQTokenCache) -> list[str]:
+    """
+    04 などでエンコード済みの音声のトークンをキャッシュから npy ファイルに書き出し、
+    キャッシュになかった音声ファイルを返します。
+    """
+    missing = vq_cache.restore(
+        input_files, [os.path.splitext(path)[0] + ".npy" for path in input_files]
+    )
+    print(
+        f"VQ トークンのキャッシュから書き出しました: {len(input_files) - len(missing)} ファイル"
+    )
+    return [input_file for input_file, _ in missing]
+
+
+def encode_in_process(
+    target_dir: str,
+    args: Namespace,
+    vq_cache: Optional[VQTokenCache] = None,
+    queue: Optional[LeaseQueue] = None,
+    pcm_cache: Optional[PCMCache] = None,
+) -> int:
+    """
+    extract_vq.py と同様に、npy ファイルがない音声ファイルだけをエンコードして同じ場所に npy を保存します。
+    クリップは長さの近いものを 1 バッチのサンプル数の上限までまとめ、次のバッチの読み込みはエンコードと並行して行います。
+    vq_cache を指定した場合、キャッシュにある音声はエンコードせずに書き出し、エンコード結果をキャッシュに保存します。
+    queue を指定した場合、リースを取得したクリップだけを書き出し・エンコードし、他のワーカーと分担します。
+    pcm_cache を指定した場合、デコード済みの音声をキャッシュから読み込みます。
+    エンコードしたファイル数を返します。
+    """
+    import vq_encoder
+
+    input_files = list_pending(target_dir)
+    if not input_files:
+        print("エンコードするファイルはありません。")
+        return 0
+
+    model = None
+    written = 0
+
+    def process(files: list[str]) -> None:
+        nonlocal model, written
+        # キャッシュからの書き出しもリースを取得したクリップだけに行う
+        if vq_cache is not None:
+            files = restore_from_cache(files, vq_cache)
+        if not files:
+            return
+        if model is None:
+            model = vq_encoder.load_vq_model(
+                args.checkpoint_path,
+                args.config_name,
+                args.device or vq_encoder.default_device(),
+            )
+        written += vq_encoder.encode_files(
+            model,
+            files,
+            [os.path.splitext(path)[0] + ".npy" for path in files],
+            args.batch_size,
+            pcm_cache,
+            args.max_batch_seconds,
+            vq_cache,
+        )
+
+    if queue is not None:
+        queue.run(input_files, process, args.claim_size)
+    else:
+        process(input_files)
+    return written
+
+
+def run_extract_vq_cached(
+    target_dir: str, args: Namespace, vq_cache: VQTokenCache
+) -> None:
+    """
+    キャッシュにある音声のトークンを書き出してから extract_vq.py を実行し、
+    extract_vq.py がエンコードした結果をキャッシュに保存します。
+    """
+    input_files = restore_from_cache(list_pending(target_dir), vq_cache)
+    if not input_files:
+        print("エンコードするファイルはありません。")
+        return
+    run_extract_vq(target_dir, args)
+    vq_cache.store(
+        input_files, [os.path.splitext(path)[0] + ".npy" for path in input_files]
+    )
+
+
 def main(args: Optional[Namespace] = None) -> None:
     """
     メイン関数。extract_vq.py スクリプトを実行します。
@@ -85,7 +239,41 @@ def main(args: Optional[Namespace] = None) -> None:
 
     target_dir = f"./data/{model_name}/raw/{directory}/dataset"
 
-    run_extract_vq(target_dir, args)
+    stage = "06_generate_wav_and_lab_to_npy"
+    queue: Optional[LeaseQueue] = None
+    if args.distributed:
+        if not work_queue.check_local_caches(
+            {
+                "--vq-cache-path": None if args.no_vq_cache else args.vq_cache_path,
+                "--pcm-cache-dir": None if args.no_pcm_cache else args.pcm_cache_dir,
+            }
+        ):
+            return
+        # extract_vq.py はディレクトリ全体を処理するため、分担する場合はこのプロセス内でエンコードする
+        queue = LeaseQueue(
+            lease_dir(model_name, directory, stage), args.worker_id, args.lease_seconds
+        )
+        stage = f"{stage}@{queue.worker_id}"
+
+    report_file = instrumentation.report_path(model_name, directory)
+    with instrumentation.Recorder(stage, report_file, args.profile):
+        vq_cache = open_vq_cache(args, args.checkpoint_path, args.config_name)
+        if args.in_process or queue is not None:
+            pcm_cache: Optional[PCMCache] = None
+            if not args.no_pcm_cache:
+                pcm_cache = PCMCache(
+                    args.pcm_cache_dir, args.pcm_cache_max_mb * 1024 * 1024
+                )
+            encode_in_process(target_dir, args, vq_cache, queue, pcm_cache)
+            if pcm_cache is not None:
+                pcm_cache.close()
+        elif vq_cache is not None:
+            run_extract_vq_cached(target_dir, args, vq_cache)
+        else:
+            run_extract_vq(target_dir, args)
+        if vq_cache is not None:
+            vq_cache.print_stats()
+            vq_cache.close()
 
 
 if __name__ == "__main__":
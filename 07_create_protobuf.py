@@ -1,9 +1,15 @@
 import subprocess
 import os
+import json
+import shutil
+import re
+import hashlib
 import argparse
 from argparse import Namespace
 from typing import Optional
 
+import instrumentation
+
 
 def parse_arguments() -> argparse.Namespace:
     """
@@ -29,10 +35,54 @@ def parse_arguments() -> argparse.Namespace:
         type=str,
         help="[OPTION] target_dir を指定します。",
     )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=os.cpu_count(),
+        help="[OPTION] build_dataset.py のワーカー数。デフォルトは CPU コア数です。",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="[OPTION] FS_DATA_TS ごとに別のシャードとして追加します。"
+        "追加済みで入力が変わっていないバッチはスキップします。",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=10,
+        help="[OPTION] 1 シャードの最大サイズ（MB）。デフォルトは 10 です。",
+    )
+    parser.add_argument(
+        "--packed",
+        type=str,
+        help="[OPTION] token_store.py で作成したトークンストアから protobuf ファイルを生成します。"
+        "npy / lab ファイルを個別に開かずに済みます。",
+    )
+    parser.add_argument(
+        "--pretokenize",
+        action="store_true",
+        help="[OPTION] lab ファイルのテキストをトークナイザーで変換し、protobuf ファイルと同じ場所に "
+        "text_tokens.npz として保存します。学習時はトークナイザーを実行せずにこの ID を使います。",
+    )
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        default="checkpoints/fish-speech-1.5",
+        help="[OPTION] --pretokenize で使うトークナイザーのパス。"
+        "学習設定の pretrained_ckpt_path と同じものを指定します。",
+    )
+    instrumentation.add_arguments(parser)
     return parser.parse_args()
 
 
-def create_protobuf(input_dir: str, output_dir: str, force: bool) -> None:
+def create_protobuf(
+    input_dir: str,
+    output_dir: str,
+    force: bool,
+    num_workers: Optional[int] = None,
+    shard_size: Optional[int] = None,
+) -> None:
     """
     データセットを protobuf ファイルに変換します。
     """
@@ -53,11 +103,209 @@ def create_protobuf(input_dir: str, output_dir: str, force: bool) -> None:
         "--text-extension",
         ".lab",
         "--num-workers",
-        "16",
+        str(num_workers or os.cpu_count()),
     ]
+    if shard_size is not None:
+        command += ["--shard-size", str(shard_size)]
     subprocess.run(command, check=True)
 
 
+def clean_text(text: str) -> str:
+    """
+    build_dataset.py と同じ規則でテキストから注釈やタグを取り除きます。
+    """
+    text = re.sub(r"\{.*?\}", " ", text)
+    text = re.sub(r"<.*?>", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def create_protobuf_from_store(
+    store_path: str, output_dir: str, shard_size: int
+) -> int:
+    """
+    トークンストアから protobuf ファイルを生成します。
+    build_dataset.py と同様に話者（親ディレクトリ）ごとに 1 つの TextData にまとめ、
+    shard_size（MB）ごとにシャードを分けます。生成したシャード数を返します。
+    """
+    from fish_speech.datasets.protos.text_data_pb2 import Semantics, Sentence, TextData
+    from fish_speech.datasets.protos.text_data_stream import pack_pb_stream
+
+    from token_store import PackedTokenStore
+
+    store = PackedTokenStore(store_path)
+    # 親ディレクトリごとにまとめる
+    grouped: dict[str, list[int]] = {}
+    for i in range(len(store)):
+        if store.text(i) is None:
+            continue
+        grouped.setdefault(os.path.dirname(store.name(i)), []).append(i)
+
+    os.makedirs(output_dir, exist_ok=True)
+    file_index = 0
+    written_size = 0
+    dataset_fp = open(os.path.join(output_dir, f"{file_index:08d}.protos"), "wb")
+    try:
+        for indices in grouped.values():
+            sentences = [
+                Sentence(
+                    texts=[clean_text(store.text(i))],
+                    semantics=[
+                        Semantics(values=row) for row in store.codes(i).tolist()
+                    ],
+                )
+                for i in indices
+            ]
+            data = pack_pb_stream(
+                TextData(
+                    source="folder", name=store.speaker(indices[0]), sentences=sentences
+                )
+            )
+            dataset_fp.write(data)
+            written_size += len(data)
+            if written_size > shard_size * 1024 * 1024:
+                dataset_fp.close()
+                file_index += 1
+                written_size = 0
+                dataset_fp = open(
+                    os.path.join(output_dir, f"{file_index:08d}.protos"), "wb"
+                )
+    finally:
+        dataset_fp.close()
+    return file_index + 1
+
+
+def read_texts(input_dir: str) -> list[str]:
+    """
+    ディレクトリ以下の npy ファイルに対応する lab ファイルのテキストを、protobuf ファイルと同じ規則で整形して返します。
+    """
+    texts = []
+    for root, _, files in os.walk(input_dir):
+        for file in files:
+            if not file.endswith(".npy"):
+                continue
+            lab_path = os.path.join(root, os.path.splitext(file)[0] + ".lab")
+            if os.path.exists(lab_path):
+                with open(lab_path, encoding="utf-8") as f:
+                    texts.append(clean_text(f.read()))
+    return texts
+
+
+def pretokenize(texts: list[str], output_dir: str, tokenizer_path: str) -> None:
+    """
+    テキストをトークン化して output_dir/text_tokens.npz に保存します。
+    保存済みのファイルのトークナイザーとテキストが同じ場合は何もしません。
+    """
+    import numpy as np
+    from transformers import AutoTokenizer
+
+    from fish_speech.datasets.text_tokens import (
+        TEXT_TOKENS_FILE,
+        build_text_tokens,
+        tokenizer_fingerprint,
+    )
+
+    path = os.path.join(output_dir, TEXT_TOKENS_FILE)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+    if os.path.exists(path):
+        with np.load(path) as data:
+            if str(data["fingerprint"]) == tokenizer_fingerprint(tokenizer) and set(
+                data["texts"].tolist()
+            ) == set(texts):
+                print(f"トークン化済みです: {path}")
+                return
+    count = build_text_tokens(texts, tokenizer, path)
+    print(f"テキストをトークン化しました: {path}（{count} 件）")
+
+
+def dataset_fingerprint(input_dir: str) -> tuple[str, int]:
+    """
+    データセットのファイル名・サイズ・更新時刻からフィンガープリントを作成します。
+    フィンガープリントと対象ファイル数を返します。
+    """
+    digest = hashlib.sha256()
+    count = 0
+    for root, _, files in sorted(os.walk(input_dir)):
+        for file in sorted(files):
+            if not file.endswith((".npy", ".lab")):
+                continue
+            path = os.path.join(root, file)
+            stat = os.stat(path)
+            relpath = os.path.relpath(path, input_dir)
+            line = f"{relpath}\0{stat.st_size}\0{stat.st_mtime_ns}\n"
+            digest.update(line.encode("utf-8"))
+            count += 1
+    return digest.hexdigest(), count
+
+
+def create_protobuf_incremental(
+    input_dir: str,
+    output_dir: str,
+    batch_name: str,
+    force: bool,
+    num_workers: Optional[int] = None,
+    shard_size: Optional[int] = None,
+    tokenizer_path: Optional[str] = None,
+) -> None:
+    """
+    データセットのバッチを output_dir/<batch_name> に独立したシャードとして追加します。
+    各バッチのシャードは output_dir/manifest.json に記録し、
+    入力が変わっていないバッチは再生成しません。
+    tokenizer_path を指定した場合は、バッチのテキストのトークン列も同じディレクトリに保存します。
+    """
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    manifest: dict = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    fingerprint, count = dataset_fingerprint(input_dir)
+    batch_dir = os.path.join(output_dir, batch_name)
+    entry = manifest.get(batch_name)
+    if (
+        entry
+        and entry["fingerprint"] == fingerprint
+        and all(
+            os.path.exists(os.path.join(output_dir, shard["file"]))
+            for shard in entry["shards"]
+        )
+        and not force
+    ):
+        print(f"追加済みのバッチです: {batch_name}（{count} ファイル）")
+        if tokenizer_path:
+            pretokenize(read_texts(input_dir), batch_dir, tokenizer_path)
+        return
+
+    # このバッチのシャードだけを作り直す
+    if os.path.isdir(batch_dir):
+        shutil.rmtree(batch_dir)
+    os.makedirs(batch_dir)
+    create_protobuf(input_dir, batch_dir, False, num_workers, shard_size)
+
+    shards = [
+        {
+            "file": os.path.join(batch_name, file).replace(os.sep, "/"),
+            "size": os.path.getsize(os.path.join(batch_dir, file)),
+        }
+        for file in sorted(os.listdir(batch_dir))
+        if file.endswith(".protos")
+    ]
+    manifest[batch_name] = {
+        "input_dir": input_dir,
+        "fingerprint": fingerprint,
+        "files": count,
+        "shards": shards,
+    }
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+    print(
+        f"バッチを追加しました: {batch_name}（{count} ファイル / {len(shards)} シャード）"
+    )
+    if tokenizer_path:
+        pretokenize(read_texts(input_dir), batch_dir, tokenizer_path)
+
+
 def main(args: Optional[Namespace] = None) -> None:
     """
     メイン関数。コマンドライン引数を解析し、protobuf ファイルを生成します。
@@ -77,9 +325,45 @@ def main(args: Optional[Namespace] = None) -> None:
 
     target_dir = args.target_dir or f"./data/{model_name}/raw/{directory}/dataset"
     output_dir = "./data/protos"
+    tokenizer_path = args.tokenizer if args.pretokenize else None
 
-    os.makedirs(output_dir, exist_ok=True)
-    create_protobuf(target_dir, output_dir, args.force)
+    report_file = instrumentation.report_path(model_name, directory)
+    with instrumentation.Recorder("07_create_protobuf", report_file, args.profile):
+        os.makedirs(output_dir, exist_ok=True)
+        if args.packed:
+            if args.force:
+                for file in os.listdir(output_dir):
+                    if file.endswith(".protos"):
+                        os.remove(os.path.join(output_dir, file))
+            shards = create_protobuf_from_store(
+                args.packed, output_dir, args.shard_size
+            )
+            print(f"protobuf ファイルを生成しました: {output_dir}（{shards} シャード）")
+            if tokenizer_path:
+                from token_store import PackedTokenStore
+
+                store = PackedTokenStore(args.packed)
+                texts = [store.text(i) for i in range(len(store))]
+                pretokenize(
+                    [clean_text(text) for text in texts if text is not None],
+                    output_dir,
+                    tokenizer_path,
+                )
+            return
+        if args.incremental:
+            create_protobuf_incremental(
+                target_dir,
+                output_dir,
+                f"{model_name}_{directory}",
+                args.force,
+                args.num_workers,
+                args.shard_size,
+                tokenizer_path,
+            )
+            return
+        create_protobuf(target_dir, output_dir, args.force, args.num_workers)
+        if tokenizer_path:
+            pretokenize(read_texts(target_dir), output_dir, tokenizer_path)
 
 
 if __name__ == "__main__":
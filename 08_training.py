@@ -4,6 +4,8 @@ from typing import Optional
 import argparse
 from argparse import Namespace
 
+import instrumentation
+
 
 def parse_arguments() -> argparse.Namespace:
     """
@@ -22,6 +24,7 @@ def parse_arguments() -> argparse.Namespace:
         default="text2semantic_finetune_customize",
         help="Config name for training",
     )
+    instrumentation.add_arguments(parser)
     return parser.parse_args()
 
 
@@ -54,7 +57,9 @@ def main(args: Optional[Namespace] = None) -> None:
         print("モデル名が指定されていません。")
         return
 
-    training(model_name, args.config_name)
+    report_file = instrumentation.report_path(model_name, os.getenv("FS_DATA_TS"))
+    with instrumentation.Recorder("08_training", report_file, args.profile):
+        training(model_name, args.config_name)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,159 @@
+import os
+import subprocess
+from typing import Iterator, Optional
+
+import numpy as np
+
+
+def decode_pcm_blocks(
+    input_file: str,
+    sample_rate: int = 16000,
+    block_seconds: float = 60.0,
+    start_time: float = 0,
+) -> Iterator[np.ndarray]:
+    """
+    ffmpeg で音声ファイルをモノラルの PCM にデコードし、float32 の配列をブロック単位で返します。
+    """
+    command = [
+        "ffmpeg",
+        "-nostdin",
+        "-v",
+        "error",
+        "-ss",
+        str(start_time),
+        "-i",
+        input_file,
+        "-f",
+        "s16le",
+        "-ac",
+        "1",
+        "-ar",
+        str(sample_rate),
+        "-",
+    ]
+    block_bytes = int(sample_rate * block_seconds) * 2
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    try:
+        while True:
+            data = process.stdout.read(block_bytes)
+            if not data:
+                break
+            # 奇数バイトで途切れた場合は末尾を切り捨てる
+            data = data[: len(data) // 2 * 2]
+            yield np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768.0
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg によるデコードに失敗しました: {input_file}")
+
+
+def frame_features(
+    samples: np.ndarray, frame_length: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    フレームごとの RMS（dBFS）とゼロ交差率を計算します。
+    末尾の 1 フレームに満たないサンプルは無視されます。
+    """
+    n_frames = len(samples) // frame_length
+    frames = samples[: n_frames * frame_length].reshape(n_frames, frame_length)
+    rms = np.sqrt(np.mean(np.square(frames), axis=1))
+    rms_db = 20.0 * np.log10(np.maximum(rms, 1e-10))
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / frame_length
+    return rms_db, zcr
+
+
+def analyze_frames(
+    input_file: str,
+    frame_seconds: float = 0.02,
+    sample_rate: int = 16000,
+    start_time: float = 0,
+    block_seconds: float = 60.0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    音声ファイル全体をブロック単位でデコードし、フレームごとの RMS とゼロ交差率を返します。
+    """
+    frame_length = int(sample_rate * frame_seconds)
+    rms_blocks: list[np.ndarray] = []
+    zcr_blocks: list[np.ndarray] = []
+    remainder: Optional[np.ndarray] = None
+    for block in decode_pcm_blocks(input_file, sample_rate, block_seconds, start_time):
+        if remainder is not None and len(remainder):
+            block = np.concatenate([remainder, block])
+        usable = len(block) // frame_length * frame_length
+        rms_db, zcr = frame_features(block[:usable], frame_length)
+        rms_blocks.append(rms_db)
+        zcr_blocks.append(zcr)
+        remainder = block[usable:]
+    if not rms_blocks:
+        return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32)
+    return np.concatenate(rms_blocks), np.concatenate(zcr_blocks)
+
+
+def silence_runs(silent: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    無音フレームが連続する区間の (開始フレーム, 終了フレーム) を返します。終了は含みません。
+    """
+    padded = np.concatenate([[False], silent, [False]]).astype(np.int8)
+    edges = np.diff(padded)
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def loudness_normalize(
+    audio: np.ndarray,
+    sample_rate: int,
+    loudness_target: float = -23.0,
+    peak: float = -1.0,
+    block_size: float = 0.4,
+) -> np.ndarray:
+    """
+    fap loudness-norm と同じ手順（ピーク正規化の後に ITU-R BS.1770 の統合ラウドネスで正規化）で
+    音声配列の音量を揃えます。無音などでラウドネスを測定できない場合はピーク正規化のみ行います。
+    """
+    import pyloudnorm
+
+    max_amplitude = np.max(np.abs(audio)) if audio.size else 0.0
+    if max_amplitude <= 0:
+        return audio
+    audio = audio * (10.0 ** (peak / 20.0) / max_amplitude)
+    # 1 ブロックに満たない短い音声は測定できない
+    if audio.shape[0] < int(block_size * sample_rate):
+        return audio
+    loudness = pyloudnorm.Meter(sample_rate, block_size=block_size).integrated_loudness(
+        audio
+    )
+    if not np.isfinite(loudness):
+        return audio
+    return audio * (10.0 ** ((loudness_target - loudness) / 20.0))
+
+
+def resample(audio: np.ndarray, orig_sr: int, target_sr: int) -> np.ndarray:
+    """
+    ポリフェーズフィルタで音声配列のサンプリングレートを変換します。
+    """
+    if orig_sr == target_sr:
+        return audio
+    from math import gcd
+
+    from scipy.signal import resample_poly
+
+    factor = gcd(orig_sr, target_sr)
+    return resample_poly(audio, target_sr // factor, orig_sr // factor).astype(
+        np.float32
+    )
+
+
+def write_audio(output_file: str, audio: np.ndarray, sample_rate: int) -> None:
+    """
+    音声配列をファイルに書き込みます。
+    一時ファイルに書き込んでから置き換えるため、途中で中断しても不完全なファイルは残りません。
+    """
+    import soundfile as sf
+
+    output_format = os.path.splitext(output_file)[1].lstrip(".").upper()
+    tmp_file = output_file + ".part"
+    sf.write(tmp_file, audio, sample_rate, format=output_format)
+    os.replace(tmp_file, output_file)
@@ -0,0 +1,451 @@
+import os
+import sys
+import json
+import time
+import wave
+import shutil
+import argparse
+import platform
+import importlib
+import subprocess
+import tempfile
+import multiprocessing
+from argparse import Namespace
+from queue import Empty
+from typing import Callable, Optional
+
+import numpy as np
+
+STAGES = ["02", "03", "04", "05", "07"]
+
+
+def parse_arguments() -> Namespace:
+    """
+    コマンドライン引数を解析します。
+    """
+    parser = argparse.ArgumentParser(
+        description="合成音声のコーパスで各ステージの処理速度を計測します。"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="ベンチマークを実行します。")
+    run.add_argument(
+        "--count", type=int, default=8, help="[OPTION] 生成する音声ファイルの数"
+    )
+    run.add_argument(
+        "--duration",
+        type=float,
+        default=120.0,
+        help="[OPTION] 1 ファイルあたりの長さ（秒）",
+    )
+    run.add_argument(
+        "--sample-rate", type=int, default=44100, help="[OPTION] サンプリングレート"
+    )
+    run.add_argument("--seed", type=int, default=0, help="[OPTION] 乱数のシード")
+    run.add_argument(
+        "--stages",
+        default=",".join(STAGES),
+        help=f"[OPTION] 計測するステージ番号をカンマ区切りで指定します。デフォルトは {','.join(STAGES)} です。",
+    )
+    run.add_argument(
+        "--whisper-model",
+        "-W",
+        default=os.getenv("WHISPER_MODEL", "tiny"),
+        help="[OPTION] Whisper モデル名。重みがない場合はスタブを使います。",
+    )
+    run.add_argument(
+        "--checkpoint-path",
+        default=os.getenv(
+            "FS_CHECKPOINT_PATH",
+            "checkpoints/fish-speech-1.5/firefly-gan-vq-fsq-8x1024-21hz-generator.pth",
+        ),
+        help="[OPTION] VQ のチェックポイント。存在しない場合はスタブを使います。",
+    )
+    run.add_argument(
+        "--workdir", help="[OPTION] 作業ディレクトリ（省略時は一時ディレクトリ）"
+    )
+    run.add_argument("--output", "-o", help="[OPTION] 結果の JSON の出力先")
+
+    compare = subparsers.add_parser("compare", help="2 つの結果の JSON を比較します。")
+    compare.add_argument("baseline", help="比較元の JSON")
+    compare.add_argument("candidate", help="比較先の JSON")
+    return parser.parse_args()
+
+
+def synthesize(kind: str, duration: float, sample_rate: int, seed: int) -> np.ndarray:
+    """
+    決定的な合成音声を生成します。
+    sine は正弦波、noise はピンクノイズ風の雑音、speech は無音を挟んだ有声音風のバーストです。
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    if kind == "sine":
+        return 0.3 * np.sin(2 * np.pi * rng.uniform(110, 440) * t)
+    if kind == "noise":
+        white = rng.standard_normal(len(t))
+        return 0.1 * np.cumsum(white) / np.sqrt(np.arange(1, len(t) + 1))
+    # 基本周波数が揺らぐ倍音と、0.2〜2 秒のバースト・0.1〜0.8 秒の無音の繰り返し
+    f0 = rng.uniform(100, 250) * (1 + 0.05 * np.sin(2 * np.pi * 3 * t))
+    phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 6))
+    envelope = np.zeros(len(t))
+    position = 0
+    while position < len(t):
+        burst = int(rng.uniform(0.2, 2.0) * sample_rate)
+        envelope[position : position + burst] = np.hanning(burst)[
+            : len(envelope[position : position + burst])
+        ]
+        position += burst + int(rng.uniform(0.1, 0.8) * sample_rate)
+    return 0.3 * voiced * envelope + 0.005 * rng.standard_normal(len(t))
+
+
+def write_wav(path: str, audio: np.ndarray, sample_rate: int) -> None:
+    """
+    float の音声配列を 16bit の wav ファイルとして保存します。
+    """
+    pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype("<i2")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm.tobytes())
+
+
+def wav_duration(path: str) -> float:
+    """
+    wav ファイルの長さ（秒）を返します。
+    """
+    with wave.open(path, "rb") as f:
+        return f.getnframes() / f.getframerate()
+
+
+def generate_corpus(
+    raw_dir: str, count: int, duration: float, sample_rate: int, seed: int
+) -> list[str]:
+    """
+    合成音声のコーパスを生成します。
+    """
+    os.makedirs(raw_dir, exist_ok=True)
+    kinds = ["speech", "sine", "noise"]
+    files = []
+    for i in range(count):
+        kind = kinds[i % len(kinds)]
+        path = os.path.join(raw_dir, f"{kind}_{i:04d}.wav")
+        write_wav(path, synthesize(kind, duration, sample_rate, seed + i), sample_rate)
+        files.append(path)
+    return files
+
+
+def list_audio(directory: str) -> list[str]:
+    if not os.path.isdir(directory):
+        return []
+    return [
+        os.path.join(directory, file)
+        for file in sorted(os.listdir(directory))
+        if file.endswith(".wav")
+    ]
+
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    このプロセスと終了した子プロセスのピークメモリ使用量（MB）を返します。
+    """
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 1024 / 1024
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    usage = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return usage * 1024 / scale / 1024
+
+
+class StubWhisper:
+    """
+    Whisper の重みがない環境で、モデルの読み込みと推論を省略するスタブ。
+    """
+
+    def transcribe(self, audio, language=None):
+        return {"text": ""}
+
+
+class StubVQ:
+    """
+    VQ のチェックポイントがない環境で使うスタブ。ホップ長 2048・8 コードブックのトークンを返します。
+    """
+
+    class spec_transform:
+        sample_rate = 44100
+
+    def parameters(self):
+        import torch
+
+        yield torch.zeros(1)
+
+    def encode(self, audios, audio_lengths):
+        import torch
+
+        frames = audio_lengths // 2048
+        return (
+            torch.zeros((audios.shape[0], 8, int(frames.max())), dtype=torch.long),
+            frames,
+        )
+
+
+def whisper_weights_exist(model_name: str) -> bool:
+    root = os.path.join(
+        os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+        "whisper",
+    )
+    return os.path.exists(os.path.join(root, f"{model_name}.pt"))
+
+
+def bench_separate(workdir: str, options: dict) -> tuple[int, float, dict]:
+    separate = importlib.import_module("02_separate")
+    inputs = list_audio(os.path.join(workdir, "raw"))
+    output_dir = os.path.join(workdir, "separate")
+    for input_file in inputs:
+        separate.split_audio_file(input_file, output_dir, 0, 30, 5, True)
+    return len(inputs), sum(map(wav_duration, inputs)), {}
+
+
+def bench_normalize(workdir: str, options: dict) -> tuple[int, float, dict]:
+    normalize = importlib.import_module("03_normalize")
+    input_dir = os.path.join(workdir, "separate")
+    output_dir = os.path.join(workdir, "normalize_loudness")
+    inputs = list_audio(input_dir)
+    if shutil.which("fap"):
+        engine = "fap"
+        normalize.normalize_loudness(input_dir, output_dir, -23.0)
+    else:
+        engine = "native"
+        os.makedirs(output_dir, exist_ok=True)
+        normalize.normalize_loudness_incremental(
+            input_dir, output_dir, -23.0, True, os.cpu_count()
+        )
+    return len(inputs), sum(map(wav_duration, inputs)), {"engine": engine}
+
+
+def bench_generate_npy(workdir: str, options: dict) -> tuple[int, float, dict]:
+    generate = importlib.import_module("04_generate_wav_to_npy")
+    inputs = list_audio(os.path.join(workdir, "normalize_loudness"))
+    output_dir = os.path.join(workdir, "npy")
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint_path = options["checkpoint_path"]
+    stub = not os.path.exists(checkpoint_path)
+    if stub:
+        import vq_encoder
+
+        vq_encoder.load_vq_model = lambda *args, **kwargs: StubVQ()
+    generate.generate_npy_in_process(
+        inputs, output_dir, checkpoint_path, "firefly_gan_vq", None, 8
+    )
+    return len(inputs), sum(map(wav_duration, inputs)), {"stub": stub}
+
+
+def bench_speech_to_text(workdir: str, options: dict) -> tuple[int, float, dict]:
+    speech = importlib.import_module("05_speech_to_text")
+    inputs = list_audio(os.path.join(workdir, "normalize_loudness"))
+    model_name = options["whisper_model"]
+    stub = not whisper_weights_exist(model_name)
+    if stub:
+        speech.load_whisper_model = lambda name: StubWhisper()
+    for input_file in inputs:
+        text = speech.speech_to_text(input_file, model_name)
+        with open(os.path.splitext(input_file)[0] + ".lab", "w", encoding="utf-8") as f:
+            f.write(text)
+    return len(inputs), sum(map(wav_duration, inputs)), {"stub": stub}
+
+
+def bench_create_protobuf(workdir: str, options: dict) -> tuple[int, float, dict]:
+    protobuf = importlib.import_module("07_create_protobuf")
+    dataset_dir = os.path.join(workdir, "dataset")
+    os.makedirs(dataset_dir, exist_ok=True)
+    inputs = list_audio(os.path.join(workdir, "normalize_loudness"))
+    for input_file in inputs:
+        base = os.path.splitext(os.path.basename(input_file))[0]
+        npy_file = os.path.join(workdir, "npy", base + ".npy")
+        lab_file = os.path.splitext(input_file)[0] + ".lab"
+        if os.path.exists(npy_file) and os.path.exists(lab_file):
+            shutil.copy(npy_file, dataset_dir)
+            shutil.copy(lab_file, dataset_dir)
+    output_dir = os.path.join(workdir, "protos")
+    os.makedirs(output_dir, exist_ok=True)
+    if os.path.exists("tools/llama/build_dataset.py"):
+        protobuf.create_protobuf(dataset_dir, output_dir, True)
+        method = "build_dataset"
+    else:
+        import token_store
+
+        store_dir = os.path.join(workdir, "tokens")
+        token_store.pack_directory(dataset_dir, store_dir)
+        protobuf.create_protobuf_from_store(store_dir, output_dir, 10)
+        method = "packed"
+    return len(inputs), sum(map(wav_duration, inputs)), {"method": method}
+
+
+BENCHMARKS: dict[str, tuple[str, Callable[[str, dict], tuple[int, float, dict]]]] = {
+    "02": ("split_audio_file", bench_separate),
+    "03": ("normalize_loudness", bench_normalize),
+    "04": ("generate_npy", bench_generate_npy),
+    "05": ("speech_to_text", bench_speech_to_text),
+    "07": ("create_protobuf", bench_create_protobuf),
+}
+
+
+def run_benchmark(number: str, workdir: str, options: dict, queue) -> None:
+    """
+    子プロセスでステージを 1 つ計測し、結果をキューに入れます。
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    name, function = BENCHMARKS[number]
+    started_at = time.perf_counter()
+    try:
+        files, audio_seconds, extra = function(workdir, options)
+    except Exception as e:
+        queue.put({"name": name, "error": f"{type(e).__name__}: {e}"})
+        return
+    elapsed = time.perf_counter() - started_at
+    queue.put(
+        {
+            "name": name,
+            "files": files,
+            "audio_seconds": round(audio_seconds, 3),
+            "wall_seconds": round(elapsed, 3),
+            "files_per_second": round(files / elapsed, 3) if elapsed > 0 else None,
+            "audio_seconds_per_second": (
+                round(audio_seconds / elapsed, 3) if elapsed > 0 else None
+            ),
+            "peak_rss_mb": peak_rss_mb(),
+            **extra,
+        }
+    )
+
+
+def wait_result(name: str, process, queue, poll_seconds: float = 5.0) -> dict:
+    """
+    子プロセスの計測結果を待ちます。結果を入れずに終了した場合（クラッシュやメモリ不足など）はエラーを返します。
+    """
+    while True:
+        try:
+            return queue.get(timeout=poll_seconds)
+        except Empty:
+            if process.is_alive():
+                continue
+        # 終了する直前に入れた結果がまだ届いていない場合がある
+        try:
+            return queue.get(timeout=poll_seconds)
+        except Empty:
+            return {
+                "name": name,
+                "error": f"子プロセスが結果を返さずに終了しました（終了コード {process.exitcode}）",
+            }
+
+
+def git_commit() -> Optional[str]:
+    result = subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    return result.stdout.decode().strip() or None
+
+
+def run(args: Namespace) -> dict:
+    """
+    コーパスを生成し、各ステージを別々の子プロセスで順に計測します。
+    """
+    workdir = args.workdir or tempfile.mkdtemp(prefix="fs_benchmark_")
+    generate_corpus(
+        os.path.join(workdir, "raw"),
+        args.count,
+        args.duration,
+        args.sample_rate,
+        args.seed,
+    )
+    options = {
+        "whisper_model": args.whisper_model,
+        "checkpoint_path": args.checkpoint_path,
+    }
+    context = multiprocessing.get_context("spawn")
+    stages = {}
+    for number in [n.strip() for n in args.stages.split(",") if n.strip()]:
+        if number not in BENCHMARKS:
+            print(f"不明なステージです: {number}")
+            continue
+        queue = context.Queue()
+        process = context.Process(
+            target=run_benchmark, args=(number, workdir, options, queue)
+        )
+        process.start()
+        result = wait_result(BENCHMARKS[number][0], process, queue)
+        process.join()
+        stages[number] = result
+        print(f"[{number}] {json.dumps(result, ensure_ascii=False)}")
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus": {
+            "count": args.count,
+            "duration": args.duration,
+            "sample_rate": args.sample_rate,
+            "seed": args.seed,
+        },
+        "stages": stages,
+    }
+
+
+def compare(baseline: dict, candidate: dict) -> None:
+    """
+    2 つの結果のステージごとの処理速度を比較して表示します。
+    """
+    for number, result in candidate["stages"].items():
+        before = baseline["stages"].get(number, {})
+        old = before.get("audio_seconds_per_second")
+        new = result.get("audio_seconds_per_second")
+        if not old or not new:
+            print(f"[{number}] 比較できません")
+            continue
+        print(
+            f"[{number}] {result['name']}: {old:.2f} → {new:.2f} 音声秒/秒"
+            f"（{new / old:.2f} 倍）"
+        )
+
+
+def main(args: Optional[Namespace] = None) -> None:
+    """
+    メイン関数。ベンチマークの実行と比較を行います。
+    """
+    if args is None:
+        args = parse_arguments()
+
+    if args.command == "compare":
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.candidate, encoding="utf-8") as f:
+            candidate = json.load(f)
+        compare(baseline, candidate)
+        return
+
+    report = run(args)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"結果を保存しました: {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# 同じプロセス内で計算したファイルの内容のハッシュ。キーは (絶対パス, サイズ, 更新時刻)
+_content_hashes: OrderedDict[tuple[str, int, int], str] = OrderedDict()
+_content_hashes_lock = threading.Lock()
+CONTENT_HASH_MEMO_SIZE = 65536
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    ファイルの内容の SHA-256 ハッシュを返します。
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remember_content_hash(path: str, size: int, mtime_ns: int, digest: str) -> None:
+    """
+    メタデータインデックスなどに記録済みのファイルの内容のハッシュを、content_hash が再計算せずに使えるよう登録します。
+    """
+    key = (os.path.abspath(path), size, mtime_ns)
+    with _content_hashes_lock:
+        _content_hashes[key] = digest
+        _content_hashes.move_to_end(key)
+        while len(_content_hashes) > CONTENT_HASH_MEMO_SIZE:
+            _content_hashes.popitem(last=False)
+
+
+def content_hash(path: str) -> str:
+    """
+    ファイルの内容の SHA-256 ハッシュを返します。
+    同じプロセス内では、サイズと更新時刻が変わらない限り一度だけ計算します（remember_content_hash で登録したものも使います）。
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _content_hashes_lock:
+        digest = _content_hashes.get(key)
+        if digest is not None:
+            _content_hashes.move_to_end(key)
+            return digest
+    digest = hash_file(path)
+    remember_content_hash(path, stat.st_size, stat.st_mtime_ns, digest)
+    return digest
+
+
+class BlobCache:
+    """
+    SQLite に保存するキー・バリュー形式のキャッシュ。
+    合計サイズが max_bytes を超えると、最後に参照された時刻が古いものから削除します。
+    合計サイズは meta テーブルに保存と削除のたびに更新し、全体の集計は開くときだけ行います。
+    """
+
+    def __init__(self, path: str, max_bytes: int) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        # 合計サイズを記録していなかった以前のキャッシュでも正しい値から始める
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._conn.execute(
+            "INSERT OR REPLACE INTO meta (name, value) "
+            "SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM entries"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        キーに対応する値を返します。存在しない場合は None を返します。
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key: str, value: bytes) -> None:
+        """
+        値を保存し、上限を超えた分を古いものから削除します。
+        """
+        with self._lock:
+            # 同じキャッシュを使う他のプロセスと合計サイズの更新が競合しないようにする
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT size FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, last_access) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, value, len(value), time.time()),
+                )
+                self._add_total(len(value) - (row[0] if row else 0))
+                self._evict()
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+
+    def _total(self) -> int:
+        (total,) = self._conn.execute(
+            "SELECT value FROM meta WHERE name = 'total_bytes'"
+        ).fetchone()
+        return total
+
+    def _add_total(self, delta: int) -> None:
+        self._conn.execute(
+            "UPDATE meta SET value = value + ? WHERE name = 'total_bytes'", (delta,)
+        )
+
+    def _evict(self) -> None:
+        total = self._total()
+        while total > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM entries ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            freed = 0
+            for key, size in rows:
+                if total - freed <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                freed += size
+            self._add_total(-freed)
+            total -= freed
+
+    def stats(self) -> dict:
+        """
+        ヒット数・ミス数と、保存されている件数・合計サイズを返します。
+        """
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+            total = self._total()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": count,
+            "bytes": total,
+        }
+
+    def close(self) -> None:
+        self._conn.close()
@@ -0,0 +1,35 @@
+import os
+import shutil
+import socket
+import threading
+
+
+def link_or_copy(src: str, dest: str) -> str:
+    """
+    同じファイルシステム上ならハードリンクを作成し、できなければコピーします。
+    実際に行った方法（"link" または "copy"）を返します。
+    """
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+        return "link"
+    except OSError:
+        shutil.copy2(src, dest)
+        return "copy"
+
+
+def save_npy(path: str, array) -> None:
+    """
+    配列を npy ファイルに保存します。
+    一時ファイルに書き込んでから置き換えるため、複数のワーカーが同じファイルに書き込んでも
+    読み込む側が書きかけのファイルを見ることはありません。
+    """
+    import numpy as np
+
+    tmp_path = (
+        f"{path}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.part"
+    )
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
@@ -0,0 +1,176 @@
+import os
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+import numpy as np
+
+TEXT_TOKENS_FILE = "text_tokens.npz"
+
+log = logging.getLogger(__name__)
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    トークナイザーのクラス・語彙・特殊トークンからフィンガープリントを作成します。
+    トークナイザーが変わった場合に事前トークン化の結果を使わないために使います。
+    """
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        definition = backend.to_str()
+    else:
+        definition = json.dumps(sorted(tokenizer.get_vocab().items()))
+    digest = hashlib.sha256()
+    digest.update(type(tokenizer).__name__.encode("utf-8"))
+    digest.update(definition.encode("utf-8"))
+    digest.update(
+        json.dumps(getattr(tokenizer, "special_tokens_map", {}), sort_keys=True).encode(
+            "utf-8"
+        )
+    )
+    return digest.hexdigest()
+
+
+def build_text_tokens(texts: Iterable[str], tokenizer, path: str) -> int:
+    """
+    テキストを add_special_tokens=False でトークン化し、トークナイザーのフィンガープリントと合わせて保存します。
+    同じテキストは 1 度だけトークン化します。保存したテキストの数を返します。
+    """
+    unique = sorted(set(texts))
+    encoded = [tokenizer.encode(text, add_special_tokens=False) for text in unique]
+    lengths = np.array([len(ids) for ids in encoded], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    ids = (
+        np.concatenate([np.asarray(ids, dtype=np.int32) for ids in encoded])
+        if encoded
+        else np.zeros(0, dtype=np.int32)
+    )
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".part"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            fingerprint=np.array(tokenizer_fingerprint(tokenizer)),
+            texts=np.array(unique, dtype=np.str_),
+            offsets=offsets,
+            lengths=lengths,
+            ids=ids,
+        )
+    os.replace(tmp_path, path)
+    return len(unique)
+
+
+def find_text_tokens(paths: Iterable[str]) -> list[str]:
+    """
+    ファイルまたはディレクトリ以下にある事前トークン化のファイルを返します。
+    """
+    found = []
+    for path in paths:
+        if os.path.isfile(path):
+            found.append(path)
+            continue
+        for root, _, files in os.walk(path):
+            if TEXT_TOKENS_FILE in files:
+                found.append(os.path.join(root, TEXT_TOKENS_FILE))
+    return sorted(found)
+
+
+class CachedTokenizer:
+    """
+    07_create_protobuf.py --pretokenize で保存したトークン列を使うトークナイザーのラッパー。
+    encode(text, add_special_tokens=False) のテキストが保存済みであれば、トークナイザーを実行せずにその ID を返します。
+    保存されていないテキストはトークナイザーで変換し、直近の memo_size 件を記憶します。
+    フィンガープリントが一致しないファイルは使いません。それ以外の属性は元のトークナイザーのものを返します。
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        cache_files: Optional[list[str]] = None,
+        memo_size: int = 65536,
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.memo_size = memo_size
+        self.memo: OrderedDict[str, list[int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.ids = np.zeros(0, dtype=np.int32)
+        self.spans: dict[str, tuple[int, int]] = {}
+
+        fingerprint = tokenizer_fingerprint(tokenizer)
+        chunks = []
+        base = 0
+        for path in find_text_tokens(cache_files or []):
+            with np.load(path) as data:
+                if str(data["fingerprint"]) != fingerprint:
+                    log.warning(f"Tokenizer fingerprint mismatch, ignoring {path}")
+                    continue
+                for text, offset, length in zip(
+                    data["texts"].tolist(),
+                    data["offsets"].tolist(),
+                    data["lengths"].tolist(),
+                ):
+                    self.spans[text] = (base + offset, length)
+                chunks.append(data["ids"])
+                base += len(data["ids"])
+        if chunks:
+            self.ids = np.concatenate(chunks)
+        log.info(f"Loaded {len(self.spans)} pre-tokenized texts")
+
+    @classmethod
+    def from_pretrained(
+        cls,
+        pretrained_model_name_or_path: str,
+        cache_files: Optional[list[str]] = None,
+        memo_size: int = 65536,
+        **kwargs,
+    ) -> "CachedTokenizer":
+        from transformers import AutoTokenizer
+
+        return cls(
+            AutoTokenizer.from_pretrained(pretrained_model_name_or_path, **kwargs),
+            cache_files,
+            memo_size,
+        )
+
+    def encode(self, text, *args, **kwargs):
+        if (
+            args
+            or not isinstance(text, str)
+            or kwargs.get("add_special_tokens", True)
+            or kwargs.get("truncation")
+            or kwargs.get("return_tensors") is not None
+        ):
+            return self.tokenizer.encode(text, *args, **kwargs)
+
+        span = self.spans.get(text)
+        if span is not None:
+            self.hits += 1
+            offset, length = span
+            return self.ids[offset : offset + length].tolist()
+        memo = self.memo.get(text)
+        if memo is not None:
+            self.hits += 1
+            self.memo.move_to_end(text)
+            return list(memo)
+
+        self.misses += 1
+        ids = self.tokenizer.encode(text, add_special_tokens=False)
+        self.memo[text] = ids
+        if len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+        return list(ids)
+
+    def __call__(self, *args, **kwargs):
+        return self.tokenizer(*args, **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.tokenizer)
+
+    def __getattr__(self, name: str):
+        # 属性がまだない unpickle 中に再帰しないようにする
+        if name.startswith("__") or name == "tokenizer":
+            raise AttributeError(name)
+        return getattr(self.tokenizer, name)
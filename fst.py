@@ -0,0 +1,176 @@
+import os
+import sys
+import argparse
+import importlib
+import subprocess
+from argparse import Namespace
+from typing import Optional
+
+# サブコマンド名と (モジュール名, 説明)
+COMMANDS: dict[str, tuple[str, str]] = {
+    "copy": ("01_file_copy", "01: 元の音声ファイルを raw にコピーします。"),
+    "separate": ("02_separate", "02: 音声ファイルを分割します。"),
+    "normalize": ("03_normalize", "03: ラウドネスを正規化します。"),
+    "npy": (
+        "04_generate_wav_to_npy",
+        "04: 音声ファイルから npy ファイルを生成します。",
+    ),
+    "transcribe": ("05_speech_to_text", "05: 音声ファイルを文字起こしします。"),
+    "dataset": (
+        "06_generate_wav_and_lab_to_npy",
+        "06: wav と lab ファイルを npy ファイルに変換します。",
+    ),
+    "protobuf": ("07_create_protobuf", "07: protobuf ファイルを生成します。"),
+    "train": ("08_training", "08: 学習を実行します。"),
+    "quality": ("quality_filter", "品質の低いクリップを除外します。"),
+    "dedup": ("near_dedup", "ほぼ同じクリップを dataset から取り除きます。"),
+    "pipeline": ("pipeline", "01〜08 を 1 つのパイプラインとして実行します。"),
+    "index": ("metadata_index", "メタデータインデックスを作成・表示します。"),
+    "tokens": ("token_store", "トークンストアを作成・表示します。"),
+    "benchmark": ("benchmark", "各ステージのベンチマークを実行します。"),
+}
+# ステージ番号でも指定できるようにする
+ALIASES = {
+    module[:2]: name for name, (module, _) in COMMANDS.items() if module[0] == "0"
+}
+
+# import しただけで読み込まれてはいけない重いモジュール
+HEAVY_MODULES = ("torch", "torchaudio", "whisper", "transformers", "lightning")
+DEFAULT_BUDGET_MS = 300.0
+# fst コマンドとしてインストールした場合もリポジトリのスクリプトを import できるようにする
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_arguments(argv: list[str]) -> Namespace:
+    """
+    コマンドライン引数を解析します。サブコマンド以降の引数はそのままサブコマンドに渡します。
+    """
+    commands = "\n".join(
+        f"  {name:<14}{description}" for name, (_, description) in COMMANDS.items()
+    )
+    parser = argparse.ArgumentParser(
+        prog="fst",
+        description="fish-speech の学習データ作成の各ステージを実行します。",
+        epilog=f"サブコマンド:\n{commands}\n  {'check-startup':<14}"
+        "各サブコマンドの import にかかる時間と、重いモジュールを読み込んでいないかを確認します。\n\n"
+        "01〜08 はステージ番号でも指定できます（例: fst 05 --help）。",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--model-name",
+        "-M",
+        help="[OPTION] モデル名。環境変数 MODEL_NAME に設定してからサブコマンドを実行します。",
+    )
+    parser.add_argument(
+        "--directory",
+        "-D",
+        help="[OPTION] YYMMDD_HHMMSS フォーマットのディレクトリ名。環境変数 FS_DATA_TS に設定してからサブコマンドを実行します。",
+    )
+    parser.add_argument("command", help="[REQUIRED] サブコマンド")
+    parser.add_argument(
+        "args", nargs=argparse.REMAINDER, help="[OPTION] サブコマンドの引数"
+    )
+    return parser.parse_args(argv)
+
+
+def import_time(module: str) -> tuple[float, list[str]]:
+    """
+    新しいインタープリタでモジュールを import し、(import にかかった時間（ミリ秒）, 読み込まれた重いモジュール) を返します。
+    インタープリタ自体の起動時間は含みません。
+    """
+    code = (
+        "import sys, time, importlib\n"
+        "started_at = time.perf_counter()\n"
+        f"importlib.import_module({module!r})\n"
+        "elapsed = (time.perf_counter() - started_at) * 1000\n"
+        f"heavy = [name for name in {HEAVY_MODULES!r} if name in sys.modules]\n"
+        "print(elapsed, ','.join(heavy))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        cwd=SCRIPT_DIR,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    elapsed, _, heavy = result.stdout.strip().partition(" ")
+    return float(elapsed), [name for name in heavy.split(",") if name]
+
+
+def check_startup(argv: list[str]) -> int:
+    """
+    各サブコマンドのモジュールの import 時間が予算内で、重いモジュールを読み込んでいないことを確認します。
+    問題がなければ 0、あれば 1 を返します。
+    """
+    parser = argparse.ArgumentParser(
+        prog="fst check-startup",
+        description="各サブコマンドの import にかかる時間と、重いモジュールを読み込んでいないかを確認します。",
+    )
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=DEFAULT_BUDGET_MS,
+        help=f"[OPTION] 1 つのサブコマンドの import にかける時間の上限（ミリ秒）。デフォルトは {DEFAULT_BUDGET_MS:.0f} です。",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="[OPTION] 計測の回数。最も短い時間を使います。デフォルトは 3 です。",
+    )
+    args = parser.parse_args(argv)
+
+    failed = False
+    for name, (module, _) in COMMANDS.items():
+        try:
+            results = [import_time(module) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{name:<12} {module:<34} import に失敗しました: {e}")
+            failed = True
+            continue
+        elapsed = min(ms for ms, _ in results)
+        heavy = sorted({module for _, modules in results for module in modules})
+        problems = []
+        if elapsed > args.budget_ms:
+            problems.append(f"予算 {args.budget_ms:.0f} ms を超えています")
+        if heavy:
+            problems.append(f"重いモジュールを読み込んでいます: {', '.join(heavy)}")
+        failed = failed or bool(problems)
+        status = " / ".join(problems) if problems else "OK"
+        print(f"{name:<12} {module:<34} {elapsed:7.1f} ms  {status}")
+    return 1 if failed else 0
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    """
+    メイン関数。サブコマンドのモジュールを import し、その main を実行します。
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_arguments(argv)
+    if args.model_name:
+        os.environ["MODEL_NAME"] = args.model_name
+    if args.directory:
+        os.environ["FS_DATA_TS"] = args.directory
+
+    if args.command == "check-startup":
+        sys.exit(check_startup(args.args))
+
+    command = ALIASES.get(args.command, args.command)
+    if command not in COMMANDS:
+        print(
+            f"不明なサブコマンドです: {args.command}（fst --help で一覧を表示します）"
+        )
+        sys.exit(2)
+
+    module, _ = COMMANDS[command]
+    if SCRIPT_DIR not in sys.path:
+        sys.path.insert(0, SCRIPT_DIR)
+    # 各スクリプトは sys.argv から引数を読み込む
+    sys.argv = [f"fst {command}", *args.args]
+    importlib.import_module(module).main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import pstats
+import socket
+import argparse
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+PERCENTILES = (50, 90, 99)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    計測に関する引数を追加します。
+    """
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="[OPTION] 処理中の cProfile を取得し、実行レポートと同じディレクトリに .prof として保存します。",
+    )
+
+
+def report_path(model_name: str, directory: Optional[str] = None) -> str:
+    """
+    実行レポートのパスを返します。directory がない場合は現在時刻を使います。
+    """
+    directory = directory or datetime.now().strftime("%y%m%d_%H%M%S")
+    return os.path.join(f"./data/{model_name}", "reports", f"{directory}.json")
+
+
+def read_io() -> Optional[dict[str, int]]:
+    """
+    このプロセスがストレージに読み書きしたバイト数を返します。
+    Linux では終了を待った子プロセスの分も含まれます。取得できない環境では None を返します。
+    """
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            counters = psutil.Process().io_counters()
+            return {"read": counters.read_bytes, "write": counters.write_bytes}
+        except (AttributeError, psutil.Error):
+            pass
+    try:
+        with open("/proc/self/io", encoding="utf-8") as f:
+            values = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None
+    return {"read": int(values["read_bytes"]), "write": int(values["write_bytes"])}
+
+
+def _proc_rss(pid: str) -> int:
+    with open(f"/proc/{pid}/statm", encoding="utf-8") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _proc_children(pid: str) -> list[str]:
+    children = []
+    for tid in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{tid}/children", encoding="utf-8") as f:
+            children += f.read().split()
+    return children
+
+
+def _safe_children(pid: str) -> list[str]:
+    try:
+        return _proc_children(pid)
+    except OSError:
+        return []
+
+
+def read_rss() -> tuple[Optional[int], Optional[int]]:
+    """
+    このプロセスと、実行中の子孫プロセスの合計の常駐メモリ（バイト）を返します。
+    取得できない環境では None を返します。
+    """
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        process = psutil.Process()
+        children = 0
+        for child in process.children(recursive=True):
+            try:
+                children += child.memory_info().rss
+            except psutil.Error:
+                # 計測の途中で終了した子プロセスは数えない
+                pass
+        return process.memory_info().rss, children
+    try:
+        own = _proc_rss("self")
+    except OSError:
+        return None, None
+    children = 0
+    pending = _safe_children(str(os.getpid()))
+    while pending:
+        pid = pending.pop()
+        try:
+            children += _proc_rss(pid)
+        except OSError:
+            continue
+        pending += _safe_children(pid)
+    return own, children
+
+
+def max_rss() -> Optional[int]:
+    """
+    このプロセスの起動からのピークメモリ使用量（バイト）を返します。取得できない環境では None を返します。
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss は Linux では KB、macOS ではバイト単位
+    unit = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+
+
+class MemorySampler:
+    """
+    ステージの実行中に常駐メモリを interval 秒ごとに計測し、開始時の値と実行中のピークを求めます。
+    ru_maxrss はプロセスの起動からのピークなので、同じプロセスで続けて実行したステージを区別できません。
+    ru_maxrss がステージの実行中に増えた場合は、その値を正確なピークとして使います。
+    """
+
+    def __init__(self, interval: float = 0.1) -> None:
+        self.interval = interval
+        self.baseline: Optional[int] = None
+        self.peak: Optional[int] = None
+        self.children_peak: Optional[int] = None
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def _sample(self) -> None:
+        own, children = read_rss()
+        if own is not None:
+            self.peak = max(self.peak or 0, own)
+        if children is not None:
+            self.children_peak = max(self.children_peak or 0, children)
+
+    def _loop(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+    def start(self) -> None:
+        self.start_maxrss = max_rss()
+        self.baseline, _ = read_rss()
+        self._sample()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> dict[str, Optional[float]]:
+        """
+        計測を終了し、開始時・ピーク・増加分（MB）と子孫プロセスの合計のピーク（MB）を返します。
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self._sample()
+        # 子プロセスの ru_maxrss は fork した時点の親のピークを含むことがあるため使わない
+        start, end = self.start_maxrss, max_rss()
+        if start is not None and end is not None and end > start:
+            self.peak = max(self.peak or 0, end)
+
+        def mb(value: Optional[int]) -> Optional[float]:
+            return None if value is None else round(value / 2**20, 1)
+
+        return {
+            "baseline": mb(self.baseline),
+            "peak": mb(self.peak),
+            "increase": (
+                mb(self.peak - self.baseline)
+                if self.peak is not None and self.baseline is not None
+                else None
+            ),
+            "children": mb(self.children_peak),
+        }
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    """
+    処理時間の最近傍順位によるパーセンタイルと最大値を返します。
+    """
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    result = {
+        f"p{p}": ordered[min(len(ordered) - 1, max(0, -(-p * len(ordered) // 100) - 1))]
+        for p in PERCENTILES
+    }
+    result["max"] = ordered[-1]
+    return result
+
+
+@contextmanager
+def report_lock(path: str, timeout: float = 60.0) -> Iterator[None]:
+    """
+    実行レポートを読み書きする間、ロックファイルを排他的に作成して他のプロセスを待たせます。
+    timeout 秒より古いロックファイルは、書き込み中に停止したプロセスのものとみなして削除します。
+    """
+    lock_path = path + ".lock"
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > timeout:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.05)
+    os.close(fd)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+
+def write_report(path: str, stage: str, entry: dict) -> None:
+    """
+    実行レポートにステージの計測結果を追加します。同じステージの結果は上書きされます。
+    複数のワーカーが同じレポートに書き込んでも結果が失われないよう、読み込みから置き換えまでをロックします。
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with report_lock(path):
+        report: dict = {"stages": {}}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                report = json.load(f)
+        report["stages"][stage] = entry
+        tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+
+class Recorder:
+    """
+    1 つのステージの実行時間・CPU 時間・子プロセスの時間・読み書きしたバイト数・ピークメモリと、
+    処理単位ごとの処理時間を計測し、終了時に実行レポートへ書き込みます。
+    with 文の中では measure / record で計測した処理時間がこのレコーダーに記録されます。
+    処理時間のパーセンタイルは、処理単位の種類（ファイル・バッチ・ffmpeg の実行など）ごとに分けて求めます。
+    """
+
+    def __init__(self, stage: str, path: str, profile: bool = False) -> None:
+        self.stage = stage
+        self.path = path
+        self.profile = profile
+        self.latencies: dict[str, list[float]] = {}
+        self.files = 0
+        self.lock = threading.Lock()
+        self.profiler: Optional[cProfile.Profile] = None
+
+    def __enter__(self) -> "Recorder":
+        global _active
+        self.previous = _active
+        _active = self
+        self.started_at = datetime.now()
+        self.start_times = os.times()
+        self.start_io = read_io()
+        self.memory = MemorySampler()
+        self.memory.start()
+        if self.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start_wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        global _active
+        wall = time.perf_counter() - self.start_wall
+        if self.profiler is not None:
+            self.profiler.disable()
+        _active = self.previous
+        times = os.times()
+        end_io = read_io()
+        memory = self.memory.stop()
+
+        entry: dict[str, Any] = {
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "argv": sys.argv,
+            "status": "ok" if exc_type is None else f"error: {exc_type.__name__}",
+            "wall_seconds": round(wall, 3),
+            "cpu_seconds": round(
+                times.user
+                + times.system
+                - self.start_times.user
+                - self.start_times.system,
+                3,
+            ),
+            "children_seconds": round(
+                times.children_user
+                + times.children_system
+                - self.start_times.children_user
+                - self.start_times.children_system,
+                3,
+            ),
+            "io_bytes": (
+                {key: end_io[key] - self.start_io[key] for key in end_io}
+                if end_io and self.start_io
+                else None
+            ),
+            "peak_memory_mb": memory,
+            "items": self.files,
+            "latency_seconds": {
+                unit: {
+                    "count": len(samples),
+                    **{
+                        key: round(value, 4)
+                        for key, value in percentiles(samples).items()
+                    },
+                }
+                for unit, samples in sorted(self.latencies.items())
+            },
+        }
+        if self.profiler is not None:
+            profile_file = os.path.splitext(self.path)[0] + f".{self.stage}.prof"
+            os.makedirs(os.path.dirname(profile_file), exist_ok=True)
+            self.profiler.dump_stats(profile_file)
+            entry["profile"] = profile_file
+            pstats.Stats(self.profiler).sort_stats("cumulative").print_stats(20)
+        write_report(self.path, self.stage, entry)
+        print(
+            f"[{self.stage}] {wall:.1f} 秒（CPU {entry['cpu_seconds']:.1f} 秒 / "
+            f"子プロセス {entry['children_seconds']:.1f} 秒 / {entry['items']} 件）: {self.path}"
+        )
+
+    def record(self, elapsed: float, unit: str = "file", files: int = 1) -> None:
+        with self.lock:
+            self.latencies.setdefault(unit, []).append(elapsed)
+            self.files += files
+
+
+_active: Optional[Recorder] = None
+
+
+def record(elapsed: float, unit: str = "file", files: int = 1) -> None:
+    """
+    計測中のステージに処理単位 1 件分の処理時間を記録します。計測中でなければ何もしません。
+    unit は処理単位の種類（file / batch / ffmpeg など）、files はその処理単位で処理したファイル数です。
+    """
+    if _active is not None:
+        _active.record(elapsed, unit, files)
+
+
+@contextmanager
+def measure(unit: str = "file", files: int = 1) -> Iterator[None]:
+    """
+    with 文の中の処理時間を処理単位 1 件分として記録します。
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(time.perf_counter() - started_at, unit, files)
+
+
+def timed_call(function: Callable, *args: Any) -> tuple[float, Any]:
+    """
+    関数を実行し、(処理時間, 戻り値) を返します。
+    プロセスプールのワーカーで実行し、親プロセスで record に渡すために使います。
+    """
+    started_at = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - started_at, result
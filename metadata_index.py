@@ -0,0 +1,442 @@
+import os
+import json
+import sqlite3
+import argparse
+import subprocess
+import threading
+import time
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from cache_utils import content_hash, remember_content_hash
+
+AUDIO_EXTENSIONS = (".mp3", ".wav")
+# raw/<FS_DATA_TS> の下にある各ステージの出力ディレクトリ。元の音声ファイルを探すときは対象にしない
+STAGE_DIRS = ("separate", "normalize_loudness", "npy", "dataset", "duplicates")
+# 更新時刻が読み込んだ時刻からこの秒数以内のディレクトリは、同じ時刻のうちにまた変更される可能性があるため次回も読み直す
+RACY_SECONDS = 2.0
+
+
+def index_path(model_name: str, directory: str) -> str:
+    """
+    データセットのメタデータインデックスのパスを返します。
+    """
+    return f"./data/{model_name}/metadata/{directory}.sqlite3"
+
+
+def probe_audio(path: str) -> tuple[Optional[float], Optional[int], Optional[int]]:
+    """
+    音声ファイルの (再生時間, サンプリングレート, チャンネル数) を返します。
+    ヘッダだけを読む soundfile を優先し、読めない形式の場合は ffprobe を使います。
+    """
+    try:
+        import soundfile as sf
+
+        info = sf.info(path)
+        if info.frames > 0:
+            return info.frames / info.samplerate, info.samplerate, info.channels
+    except Exception:
+        pass
+    result = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "a:0",
+            "-show_entries",
+            "stream=sample_rate,channels:format=duration",
+            "-of",
+            "json",
+            path,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        return None, None, None
+    data = json.loads(result.stdout)
+    stream = (data.get("streams") or [{}])[0]
+    duration = data.get("format", {}).get("duration")
+    return (
+        float(duration) if duration is not None else None,
+        int(stream["sample_rate"]) if "sample_rate" in stream else None,
+        stream.get("channels"),
+    )
+
+
+def list_audio_files(
+    directory: str,
+    extensions: tuple[str, ...] = AUDIO_EXTENSIONS,
+    recursive: bool = False,
+    exclude: tuple[str, ...] = (),
+) -> list[str]:
+    """
+    ディレクトリの音声ファイルを名前順に返します。インデックスを使わずに一覧だけが必要な場合に使います。
+    recursive が True の場合はサブディレクトリ（exclude の名前のものを除く）も対象にします。
+    """
+    directory = os.path.normpath(directory)
+    if not os.path.isdir(directory):
+        return []
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [name for name in dirs if recursive and name not in exclude]
+        files.extend(
+            os.path.join(root, name) for name in names if name.endswith(extensions)
+        )
+    return sorted(files)
+
+
+class MetadataIndex:
+    """
+    データセットの音声ファイルのメタデータ（パス・ハッシュ・再生時間・サンプリングレート・
+    チャンネル数・生成したステージと元ファイル）を保存する SQLite のインデックス。
+    サイズと更新時刻が変わったファイルだけを読み直し、更新時刻が変わっていないディレクトリは一覧も読み直しません。
+    """
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, directory TEXT NOT NULL, "
+            "size INTEGER, mtime_ns INTEGER, sha256 TEXT, duration REAL, "
+            "sample_rate INTEGER, channels INTEGER, stage TEXT, source TEXT)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS files_directory ON files (directory)"
+        )
+        # 前回読み込んだときのディレクトリの更新時刻と、その直下のサブディレクトリの名前
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS directories ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, subdirs TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def _scope(self, table: str, column: str, directory: str, recursive: bool):
+        """
+        ディレクトリ（recursive の場合はその下のディレクトリも含む）の行を返します。
+        """
+        if not recursive:
+            return self._conn.execute(
+                f"SELECT * FROM {table} WHERE {column} = ?", (directory,)
+            ).fetchall()
+        prefix = os.path.join(directory, "")
+        return self._conn.execute(
+            f"SELECT * FROM {table} WHERE {column} = ? "
+            f"OR substr({column}, 1, ?) = ?",
+            (directory, len(prefix), prefix),
+        ).fetchall()
+
+    def refresh(
+        self,
+        directory: str,
+        stage: Optional[str] = None,
+        extensions: tuple[str, ...] = AUDIO_EXTENSIONS,
+        jobs: int = 8,
+        recursive: bool = False,
+        exclude: tuple[str, ...] = (),
+        rescan: bool = False,
+    ) -> list[str]:
+        """
+        ディレクトリの音声ファイルをインデックスに反映し、パスを名前順に返します。
+        recursive が True の場合はサブディレクトリ（exclude の名前のものを除く）も対象にします。
+        更新時刻が前回と同じディレクトリは一覧を読み直さず、インデックスに登録されているファイルを使います。
+        ファイルをその場で上書きした場合はディレクトリの更新時刻が変わらないため、rescan を指定して読み直します。
+        新しいファイルと変更されたファイルは音声の情報だけをまとめて並列に読み込み、
+        ハッシュは sha256 で必要になったときに計算します。
+        """
+        directory = os.path.normpath(directory)
+
+        def scanned(path: str) -> bool:
+            # exclude の名前のディレクトリの下は別のステージとして読み込むため、ここでは触らない
+            parts = os.path.relpath(path, directory).split(os.sep)
+            return not any(part in exclude for part in parts)
+
+        with self._lock:
+            rows = [
+                row
+                for row in self._scope("files", "directory", directory, recursive)
+                if row["path"].endswith(extensions) and scanned(row["directory"])
+            ]
+            known_dirs = {
+                row["path"]: (row["mtime_ns"], json.loads(row["subdirs"]))
+                for row in self._scope("directories", "path", directory, recursive)
+                if scanned(row["path"])
+            }
+        listed: dict[str, list[sqlite3.Row]] = {}
+        for row in rows:
+            listed.setdefault(row["directory"], []).append(row)
+
+        current: dict[str, tuple[int, int]] = {}
+        visited: dict[str, tuple[Optional[int], list[str]]] = {}
+        racy_after = time.time_ns() - int(RACY_SECONDS * 1e9)
+        pending = [directory] if os.path.isdir(directory) else []
+        while pending:
+            path = pending.pop()
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            known = known_dirs.get(path)
+            if known is not None and known[0] == mtime_ns and not rescan:
+                subdirs = known[1]
+                for row in listed.get(path, []):
+                    if row["size"] is not None:
+                        current[row["path"]] = (row["size"], row["mtime_ns"])
+                        continue
+                    # set_sources で登録しただけのファイルは音声の情報をまだ読んでいない
+                    try:
+                        stat = os.stat(row["path"])
+                    except OSError:
+                        continue
+                    current[row["path"]] = (stat.st_size, stat.st_mtime_ns)
+            else:
+                subdirs = []
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        elif entry.is_file() and entry.name.endswith(extensions):
+                            stat = entry.stat()
+                            current[os.path.join(path, entry.name)] = (
+                                stat.st_size,
+                                stat.st_mtime_ns,
+                            )
+            visited[path] = (mtime_ns if mtime_ns < racy_after else None, subdirs)
+            if recursive:
+                pending.extend(
+                    os.path.join(path, name) for name in subdirs if name not in exclude
+                )
+
+        known_files = {row["path"]: (row["size"], row["mtime_ns"]) for row in rows}
+        # 変わっていないファイルのハッシュは、後続のキャッシュが再計算しないように登録する
+        for row in rows:
+            if row["sha256"] and current.get(row["path"]) == known_files[row["path"]]:
+                remember_content_hash(
+                    row["path"], row["size"], row["mtime_ns"], row["sha256"]
+                )
+        changed = [
+            path for path, stat in current.items() if known_files.get(path) != stat
+        ]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            described = list(executor.map(probe_audio, changed))
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO files (path, directory, size, mtime_ns, sha256, duration, "
+                "sample_rate, channels, stage) VALUES (?, ?, ?, ?, NULL, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET directory = excluded.directory, "
+                "size = excluded.size, mtime_ns = excluded.mtime_ns, sha256 = NULL, "
+                "duration = excluded.duration, sample_rate = excluded.sample_rate, "
+                "channels = excluded.channels, "
+                "stage = COALESCE(excluded.stage, files.stage)",
+                [
+                    (path, os.path.dirname(path), *current[path], *values, stage)
+                    for path, values in zip(changed, described)
+                ],
+            )
+            self._conn.executemany(
+                "DELETE FROM files WHERE path = ?",
+                [(path,) for path in known_files if path not in current],
+            )
+            # 更新時刻が新しすぎるディレクトリと、なくなったディレクトリは記録しない
+            self._conn.executemany(
+                "DELETE FROM directories WHERE path = ?",
+                [
+                    (path,)
+                    for path in set(known_dirs) | set(visited)
+                    if visited.get(path, (None,))[0] is None
+                ],
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO directories (path, mtime_ns, subdirs) "
+                "VALUES (?, ?, ?)",
+                [
+                    (path, mtime_ns, json.dumps(subdirs, ensure_ascii=False))
+                    for path, (mtime_ns, subdirs) in visited.items()
+                    if mtime_ns is not None
+                ],
+            )
+            self._conn.commit()
+        return sorted(current)
+
+    def sha256(self, path: str) -> str:
+        """
+        ファイルの内容のハッシュを返します。
+        インデックスにサイズと更新時刻が同じときのハッシュがあればそれを使い、なければ計算して記録します。
+        """
+        path = os.path.normpath(path)
+        stat = os.stat(path)
+        row = self.get(path)
+        if (
+            row is not None
+            and row["sha256"]
+            and (row["size"], row["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns)
+        ):
+            remember_content_hash(path, stat.st_size, stat.st_mtime_ns, row["sha256"])
+            return row["sha256"]
+        digest = content_hash(path)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE files SET sha256 = ? WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (digest, path, stat.st_size, stat.st_mtime_ns),
+            )
+            self._conn.commit()
+        return digest
+
+    def files(self, directory: str) -> list[str]:
+        """
+        インデックスに登録されているディレクトリ直下のファイルを名前順に返します。
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path FROM files WHERE directory = ? AND size IS NOT NULL "
+                "ORDER BY path",
+                (os.path.normpath(directory),),
+            ).fetchall()
+        return [row["path"] for row in rows]
+
+    def get(self, path: str) -> Optional[dict]:
+        """
+        ファイルのメタデータを返します。登録されていない場合は None を返します。
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM files WHERE path = ?", (os.path.normpath(path),)
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def duration(self, path: str) -> Optional[float]:
+        """
+        ファイルの再生時間（秒）を返します。不明な場合は None を返します。
+        """
+        row = self.get(path)
+        return row["duration"] if row is not None else None
+
+    def set_sources(self, items: list[tuple[str, str]], stage: str) -> None:
+        """
+        (出力ファイル, 元ファイル) の組を、出力を生成したステージと合わせて記録します。
+        出力ファイルの音声の情報は次の refresh で読み込まれます。
+        """
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO files (path, directory, stage, source) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET stage = excluded.stage, "
+                "source = excluded.source",
+                [
+                    (
+                        os.path.normpath(path),
+                        os.path.dirname(os.path.normpath(path)),
+                        stage,
+                        os.path.normpath(source),
+                    )
+                    for path, source in items
+                ],
+            )
+            self._conn.commit()
+
+    def lineage(self, path: str) -> list[str]:
+        """
+        ファイルから元をたどったパスの一覧を返します。先頭がこのファイル自身です。
+        """
+        chain = [os.path.normpath(path)]
+        while len(chain) < 16:
+            row = self.get(chain[-1])
+            if row is None or not row["source"] or row["source"] in chain:
+                break
+            chain.append(row["source"])
+        return chain
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def parse_arguments() -> Namespace:
+    """
+    コマンドライン引数を解析します。
+    """
+    parser = argparse.ArgumentParser(
+        description="データセットの音声ファイルのメタデータインデックスを作成・表示します。"
+    )
+    parser.add_argument(
+        "--model-name",
+        "-M",
+        help="[OPTION] モデル名（環境変数 MODEL_NAME が優先されます）",
+    )
+    parser.add_argument(
+        "--directory",
+        "-D",
+        help="[OPTION] YYMMDD_HHMMSS フォーマットのディレクトリ名（環境変数 FS_DATA_TS が優先されます）",
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=8, help="[OPTION] 並列に読み込むファイル数"
+    )
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="[OPTION] 更新時刻が変わっていないディレクトリも読み直します。",
+    )
+    parser.add_argument(
+        "--show",
+        help="[OPTION] 指定したファイルのメタデータと元ファイルをたどって表示します。",
+    )
+    return parser.parse_args()
+
+
+def main(args: Optional[Namespace] = None) -> None:
+    """
+    メイン関数。raw とその下の各ステージのディレクトリをインデックスに反映します。
+    """
+    if args is None:
+        args = parse_arguments()
+
+    model_name = os.getenv("MODEL_NAME") or args.model_name
+    if not model_name:
+        print("モデル名が指定されていません。")
+        return
+
+    directory = os.getenv("FS_DATA_TS") or args.directory
+    if not directory:
+        print("ディレクトリが指定されていません。")
+        return
+
+    index = MetadataIndex(index_path(model_name, directory))
+    if args.show:
+        for path in index.lineage(args.show):
+            print(json.dumps(index.get(path), ensure_ascii=False))
+        index.close()
+        return
+
+    raw_dir = f"./data/{model_name}/raw/{directory}"
+    for stage in ["raw", "separate", "normalize_loudness", "dataset"]:
+        if stage == "raw":
+            files = index.refresh(
+                raw_dir,
+                stage,
+                jobs=args.jobs,
+                recursive=True,
+                exclude=STAGE_DIRS,
+                rescan=args.rescan,
+            )
+        else:
+            files = index.refresh(
+                os.path.join(raw_dir, stage),
+                stage,
+                jobs=args.jobs,
+                recursive=True,
+                rescan=args.rescan,
+            )
+        total = sum(index.duration(path) or 0 for path in files)
+        print(f"{stage}: {len(files)} ファイル / {total:.1f} 秒")
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,661 @@
+import io
+import os
+import glob
+import json
+import shutil
+import argparse
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional
+
+import numpy as np
+
+import audio_utils
+import instrumentation
+from cache_utils import BlobCache, content_hash, remember_content_hash
+
+AUDIO_EXTENSIONS = (".mp3", ".wav")
+DUPLICATES_DIR = "duplicates"
+DUPLICATES_FILE = "duplicates.txt"
+DEFAULT_FINGERPRINT_CACHE_PATH = "./data/cache/fingerprints.sqlite3"
+DEFAULT_FINGERPRINT_CACHE_MB = 1024
+# クリップの長さのこの割合以上が残すクリップと重なっていれば重複とする
+DEFAULT_MIN_COVERAGE = 0.8
+# フィンガープリントの計算方法を変えた場合は上げて、キャッシュを使わないようにする
+FINGERPRINT_VERSION = 2
+SAMPLE_RATE = 8000
+N_FFT = 512
+HOP_LENGTH = 256
+# 前後 PEAK_NEIGHBOR_BINS ビンの中で最大のものをスペクトルのピークとする
+PEAK_NEIGHBOR_BINS = 4
+PEAKS_PER_FRAME = 2
+FRAME_RANGE_DB = 30.0
+# 1 つのピークと組にする後続のフレームのピークの数と、組にする最大のフレーム差
+FAN_OUT = 10
+MAX_DELTA_FRAMES = 63
+# クリップを CHUNK_HOP_SECONDS ずつずらした CHUNK_SECONDS のチャンクに分け、チャンクごとにシグネチャを作る
+CHUNK_SECONDS = 4.0
+CHUNK_HOP_SECONDS = 1.0
+# チャンクのシグネチャの一致する割合がこの値以上なら、同じ音声のチャンクとみなす
+CHUNK_MATCH = 0.4
+# 5 行 x 24 バンド: 類似度 0.4 のチャンクの組は 22%、0.1 の組は 0.02% の確率で候補になる
+# （重複したクリップは多くのチャンクが一致するため、いずれかのチャンクの組が候補になればよい）
+NUM_PERM = 120
+NUM_BANDS = 24
+# 同じバケットのチャンクがこの数より多い場合は、多くのクリップに共通する音として候補にしない
+MAX_BUCKET = 200
+# 計算できなかったチャンクのシグネチャ
+EMPTY = np.iinfo(np.uint32).max
+# ハッシュ値を 2^31 - 1 を法として扱い、uint64 の乗算があふれないようにする
+PRIME = (1 << 31) - 1
+SEED = 20241018
+
+
+def parse_arguments() -> Namespace:
+    """
+    コマンドライン引数を解析します。
+    """
+    parser = argparse.ArgumentParser(
+        description="data/<モデル名> のすべての dataset から音響的にほぼ同じクリップを探し、"
+        "残すクリップとほぼ全体が重なっているクリップを duplicates に移動します。"
+    )
+    parser.add_argument(
+        "--model-name",
+        "-M",
+        help="[OPTION] モデル名（環境変数 MODEL_NAME が優先されます）",
+    )
+    parser.add_argument(
+        "--directory",
+        "-D",
+        help="[OPTION] 実行レポートに使う YYMMDD_HHMMSS フォーマットのディレクトリ名（環境変数 FS_DATA_TS が優先されます）。"
+        "重複はモデルのすべてのディレクトリから探します。",
+    )
+    parser.add_argument(
+        "--min-coverage",
+        type=float,
+        default=DEFAULT_MIN_COVERAGE,
+        help="[OPTION] 重複とみなす、残すクリップと重なっている部分のクリップの長さに対する割合の下限。"
+        f"デフォルトは {DEFAULT_MIN_COVERAGE} です。",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count(),
+        help="[OPTION] 並列にフィンガープリントを計算するファイル数。デフォルトは CPU コア数です。",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="[OPTION] ファイルを移動せずに、重複のクラスタを表示します。",
+    )
+    parser.add_argument(
+        "--restore",
+        action="store_true",
+        help="[OPTION] duplicates に移動したクリップを dataset に戻します。",
+    )
+    parser.add_argument(
+        "--fingerprint-cache-path",
+        default=DEFAULT_FINGERPRINT_CACHE_PATH,
+        help=f"[OPTION] フィンガープリントのキャッシュのパス。デフォルトは {DEFAULT_FINGERPRINT_CACHE_PATH} です。",
+    )
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def spectral_peaks(samples: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    対数振幅スペクトログラムの局所的な最大値のうち、フレームごとに強いものを最大 PEAKS_PER_FRAME 個選び、
+    (フレーム番号, 周波数ビン) の配列を返します。
+    """
+    if len(samples) < N_FFT:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, N_FFT)[::HOP_LENGTH]
+    spectrum = np.log(np.abs(np.fft.rfft(frames * np.hanning(N_FFT), axis=1)) + 1e-6)
+    # 時間方向の最大値は使わない（持続する母音ではピークの時刻が定まらず、切り出す位置で変わるため）
+    padded = np.pad(
+        spectrum,
+        ((0, 0), (PEAK_NEIGHBOR_BINS, PEAK_NEIGHBOR_BINS)),
+        constant_values=-np.inf,
+    )
+    local_max = np.lib.stride_tricks.sliding_window_view(
+        padded, 2 * PEAK_NEIGHBOR_BINS + 1, axis=1
+    ).max(axis=2)
+    # 平坦なスペクトルのピークを拾わないよう、フレームの中央値より十分大きいものだけを使い、
+    # 無音や雑音だけのフレームは、大きいフレームから FRAME_RANGE_DB 以上小さければ使わない
+    floor = np.median(spectrum, axis=1, keepdims=True) + 2.0
+    energy_db = 10.0 * np.log10(np.sum(np.exp(2.0 * spectrum), axis=1))
+    loud = energy_db >= np.percentile(energy_db, 95) - FRAME_RANGE_DB
+    candidates = np.where(
+        (spectrum == local_max) & (spectrum > floor) & loud[:, None], spectrum, -np.inf
+    )
+    top = np.argsort(candidates, axis=1)[:, -PEAKS_PER_FRAME:]
+    rows = np.repeat(np.arange(len(spectrum)), top.shape[1])
+    cols = top.ravel()
+    keep = np.isfinite(candidates[rows, cols])
+    return rows[keep], cols[keep]
+
+
+def landmark_hashes(
+    times: np.ndarray, bins: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    ピークを後続のフレームの FAN_OUT 個のピークと組にし、(周波数ビン 1, 周波数ビン 2, フレーム差) を
+    1 つの整数にまとめたハッシュと、組の最初のピークのフレーム番号を返します。
+    ハッシュは絶対時刻を含まないため、切り出す位置がずれても同じ値になります。
+    """
+    order = np.lexsort((bins, times))
+    times, bins = times[order], bins[order]
+    # 同じフレームのピークとは組にしない
+    starts = np.searchsorted(times, times + 1)
+    hashes = [np.zeros(0, dtype=np.int64)]
+    anchor_times = [np.zeros(0, dtype=np.int64)]
+    for k in range(FAN_OUT):
+        anchors = np.nonzero(starts + k < len(times))[0]
+        targets = starts[anchors] + k
+        delta = times[targets] - times[anchors]
+        valid = delta <= MAX_DELTA_FRAMES
+        hashes.append(
+            (bins[anchors[valid]] << 15) | (bins[targets[valid]] << 6) | delta[valid]
+        )
+        anchor_times.append(times[anchors[valid]])
+    return np.concatenate(hashes).astype(np.uint64), np.concatenate(anchor_times)
+
+
+def permutations() -> tuple[np.ndarray, np.ndarray]:
+    """
+    MinHash の NUM_PERM 個のハッシュ関数 (a * x + b) mod PRIME の係数を返します。
+    """
+    rng = np.random.default_rng(SEED)
+    a = rng.integers(1, PRIME, NUM_PERM, dtype=np.uint64)
+    b = rng.integers(0, PRIME, NUM_PERM, dtype=np.uint64)
+    return a, b
+
+
+def minhash(hashes: np.ndarray) -> np.ndarray:
+    """
+    ハッシュの集合の MinHash シグネチャ（NUM_PERM 個の uint32）を返します。
+    2 つのシグネチャで値が一致する割合は、元の集合の Jaccard 類似度の推定値になります。
+    """
+    a, b = permutations()
+    values = np.unique(hashes) % np.uint64(PRIME)
+    signature = np.full(NUM_PERM, PRIME, dtype=np.uint64)
+    # 長いクリップでも (NUM_PERM, ハッシュの数) の配列が大きくなりすぎないように分割する
+    for start in range(0, len(values), 4096):
+        chunk = values[start : start + 4096]
+        signature = np.minimum(
+            signature,
+            ((a[:, None] * chunk[None, :] + b[:, None]) % np.uint64(PRIME)).min(axis=1),
+        )
+    return signature.astype(np.uint32)
+
+
+def chunk_signatures(hashes: np.ndarray, anchor_times: np.ndarray) -> np.ndarray:
+    """
+    ハッシュを最初のピークの時刻で CHUNK_HOP_SECONDS ずつずらした CHUNK_SECONDS のチャンクに分け、
+    (チャンク数, NUM_PERM) の MinHash シグネチャを返します。ハッシュがないチャンクの値は EMPTY です。
+    CHUNK_SECONDS より短いクリップは全体を 1 つのチャンクとします。
+    """
+    frames_per_second = SAMPLE_RATE / HOP_LENGTH
+    chunk_frames = CHUNK_SECONDS * frames_per_second
+    end = anchor_times.max() + 1
+    count = max(
+        1,
+        int(np.ceil((end - chunk_frames) / (CHUNK_HOP_SECONDS * frames_per_second)))
+        + 1,
+    )
+    signatures = np.full((count, NUM_PERM), EMPTY, dtype=np.uint32)
+    for k in range(count):
+        start = round(k * CHUNK_HOP_SECONDS * frames_per_second)
+        selected = hashes[
+            (anchor_times >= start) & (anchor_times < start + chunk_frames)
+        ]
+        if len(selected):
+            signatures[k] = minhash(selected)
+    return signatures
+
+
+def fingerprint_clip(input_file: str) -> tuple[float, Optional[np.ndarray]]:
+    """
+    クリップの (長さ（秒）, チャンクごとの MinHash シグネチャ) を返します。
+    ピークがない（無音などの）場合、シグネチャは None です。
+    """
+    blocks = list(audio_utils.decode_pcm_blocks(input_file, SAMPLE_RATE))
+    samples = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.float32)
+    hashes, anchor_times = landmark_hashes(*spectral_peaks(samples))
+    duration = round(len(samples) / SAMPLE_RATE, 3)
+    if len(hashes) == 0:
+        return duration, None
+    return duration, chunk_signatures(hashes, anchor_times)
+
+
+class FingerprintCache:
+    """
+    クリップの長さとチャンクごとの MinHash シグネチャを、音声ファイルの内容のハッシュをキーとして保存するキャッシュ。
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_FINGERPRINT_CACHE_PATH,
+        max_bytes: int = DEFAULT_FINGERPRINT_CACHE_MB * 1024 * 1024,
+    ) -> None:
+        self.cache = BlobCache(path, max_bytes)
+
+    def key(self, audio_file: str) -> str:
+        # 実行のたびに全クリップを読み直さないよう、変わっていないファイルの内容のハッシュも記録しておく
+        stat = os.stat(audio_file)
+        source_key = (
+            f"source:{os.path.abspath(audio_file)}:{stat.st_size}:{stat.st_mtime_ns}"
+        )
+        value = self.cache.get(source_key)
+        if value is not None:
+            digest = value.decode("ascii")
+            remember_content_hash(audio_file, stat.st_size, stat.st_mtime_ns, digest)
+        else:
+            digest = content_hash(audio_file)
+            self.cache.put(source_key, digest.encode("ascii"))
+        return f"{FINGERPRINT_VERSION}:{NUM_PERM}:{digest}"
+
+    def get(self, audio_file: str) -> Optional[tuple[float, Optional[np.ndarray]]]:
+        value = self.cache.get(self.key(audio_file))
+        if value is None:
+            return None
+        data = np.load(io.BytesIO(value))
+        signature = data["signature"]
+        return float(data["duration"]), signature if len(signature) else None
+
+    def put(
+        self, audio_file: str, duration: float, signature: Optional[np.ndarray]
+    ) -> None:
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            duration=np.float64(duration),
+            signature=(
+                signature
+                if signature is not None
+                else np.zeros((0, NUM_PERM), dtype=np.uint32)
+            ),
+        )
+        self.cache.put(self.key(audio_file), buffer.getvalue())
+
+    def close(self) -> None:
+        self.cache.close()
+
+
+def band_keys(signatures: np.ndarray) -> np.ndarray:
+    """
+    (チャンク数, NUM_PERM) のシグネチャを NUM_BANDS 個のバンドに分け、バンドごとの値を 1 つの整数にまとめた
+    (チャンク数, NUM_BANDS) の配列を返します。
+    """
+    rows = NUM_PERM // NUM_BANDS
+    bands = signatures.reshape(len(signatures), NUM_BANDS, rows).astype(np.uint64)
+    weights = np.uint64(1000003) ** np.arange(rows, dtype=np.uint64)
+    return (bands * weights).sum(axis=2)
+
+
+def candidate_pairs(signatures: list[np.ndarray]) -> set[tuple[int, int]]:
+    """
+    チャンクのシグネチャを LSH のバケットに分け、同じバケットに入ったチャンクを持つクリップの組を返します。
+    バンドごとにキーを並べ替えて同じ値の連続を探すため、全ての組を比較することはありません。
+    rows 行のバンドが b 個ある場合、類似度 s のチャンクの組が候補になる確率は 1 - (1 - s^rows)^b です。
+    MAX_BUCKET より大きいバケット（多くのクリップに共通する音）は候補にしません。
+    """
+    owners = np.concatenate(
+        [np.full(len(signature), i) for i, signature in enumerate(signatures)]
+        or [np.zeros(0, dtype=np.int64)]
+    )
+    if len(owners) == 0:
+        return set()
+    stacked = np.concatenate(signatures)
+    valid = stacked[:, 0] != EMPTY
+    keys = band_keys(stacked[valid])
+    owners = owners[valid]
+    pairs: set[tuple[int, int]] = set()
+    for band in range(NUM_BANDS):
+        order = np.argsort(keys[:, band], kind="stable")
+        sorted_keys = keys[order, band]
+        boundaries = np.flatnonzero(np.diff(sorted_keys)) + 1
+        for group in np.split(order, boundaries):
+            if len(group) < 2 or len(group) > MAX_BUCKET:
+                continue
+            members = np.unique(owners[group]).tolist()
+            for k, first in enumerate(members):
+                for second in members[k + 1 :]:
+                    pairs.add((first, second))
+    return pairs
+
+
+def align(first: np.ndarray, second: np.ndarray) -> tuple[int, float]:
+    """
+    2 つのクリップのチャンクのシグネチャを総当たりで比べ、同じ時間差で一致するチャンクが最も多い
+    (一致したチャンク数, 時間差（秒）) を返します。時間差は first の中での second の開始位置です。
+    同じ音声でない組は、一致するチャンクがあっても時間差がそろわないため、数は増えません。
+    """
+    similarity = (first[:, None, :] == second[None, :, :]).mean(axis=2)
+    similarity[first[:, 0] == EMPTY, :] = 0
+    similarity[:, second[:, 0] == EMPTY] = 0
+    rows, cols = np.nonzero(similarity >= CHUNK_MATCH)
+    if len(rows) == 0:
+        return 0, 0.0
+    # チャンクは間隔より長いため、隣の時間差のチャンクも一致する。一致の強さの合計が最大の時間差を選び、
+    # 前後の時間差の合計から放物線で補間して、間隔より細かい時間差を求める
+    offsets = rows - cols + len(second)
+    mass = np.bincount(
+        offsets, weights=similarity[rows, cols], minlength=len(first) + len(second) + 1
+    )
+    peak = int(np.argmax(mass))
+    before = mass[peak - 1] if peak > 0 else 0.0
+    after = mass[peak + 1] if peak + 1 < len(mass) else 0.0
+    curvature = before - 2 * mass[peak] + after
+    shift = 0.5 * (before - after) / curvature if curvature < 0 else 0.0
+    matched = len(np.unique(rows[np.abs(offsets - peak) <= 1]))
+    offset = (peak - len(second) + float(np.clip(shift, -0.5, 0.5))) * CHUNK_HOP_SECONDS
+    return matched, offset
+
+
+def overlap_seconds(
+    matched: int, offset: float, first_duration: float, second_duration: float
+) -> float:
+    """
+    align の結果から、2 つのクリップが重なっている秒数を返します。
+    一致したチャンクの範囲は重なりの端に一部だけかかるチャンクも含むため、
+    時間差から求めた 2 つのクリップの重なりを上限とします。
+    """
+    start = max(0.0, offset)
+    end = min(first_duration, offset + second_duration)
+    matched_seconds = (matched - 1) * CHUNK_HOP_SECONDS + CHUNK_SECONDS
+    return max(0.0, min(end - start, matched_seconds))
+
+
+def find_duplicates(
+    durations: list[float], signatures: list[np.ndarray], min_coverage: float
+) -> tuple[dict[int, tuple[int, float, float]], list[tuple[int, int, float]]]:
+    """
+    重複したクリップと、重なっているクリップの組を返します。
+    残すクリップを長い順（同じ長さの場合はインデックス順）に決め、残すクリップと重なっている部分が
+    クリップの長さの min_coverage 以上のクリップだけを重複とします。重複の判定は残すクリップとの間でだけ行うため、
+    少しずつ重なったクリップが連鎖して、残すクリップと重ならないクリップが取り除かれることはありません。
+    重複は {インデックス: (残すクリップのインデックス, 重なりの割合, 時間差（秒）)}、
+    重なりは重複とはしなかった (インデックス, インデックス, 重なりの秒数) の一覧です。
+    """
+    overlap: dict[int, dict[int, tuple[float, float]]] = {}
+    for first, second in candidate_pairs(signatures):
+        matched, offset = align(signatures[first], signatures[second])
+        if matched == 0:
+            continue
+        seconds = overlap_seconds(matched, offset, durations[first], durations[second])
+        if seconds <= 0:
+            continue
+        overlap.setdefault(first, {})[second] = (seconds, offset)
+        overlap.setdefault(second, {})[first] = (seconds, -offset)
+
+    duplicates: dict[int, tuple[int, float, float]] = {}
+    kept: set[int] = set()
+    for i in sorted(range(len(signatures)), key=lambda i: (-durations[i], i)):
+        matches = [
+            (seconds / durations[i], keep, offset)
+            for keep, (seconds, offset) in overlap.get(i, {}).items()
+            if keep in kept and durations[i] > 0
+        ]
+        coverage, keep, offset = max(matches, default=(0.0, -1, 0.0))
+        if coverage >= min_coverage:
+            # offset は重複したクリップの中での残すクリップの開始位置なので、符号を変える
+            duplicates[i] = (keep, round(coverage, 3), round(-offset, 1) + 0.0)
+        else:
+            kept.add(i)
+
+    overlaps = [
+        (first, second, round(seconds, 1))
+        for first, others in overlap.items()
+        for second, (seconds, _) in others.items()
+        if first < second and first not in duplicates and second not in duplicates
+    ]
+    return duplicates, overlaps
+
+
+def list_dataset_files(model_name: str) -> list[str]:
+    """
+    モデルのすべてのディレクトリの dataset（話者ごとのサブディレクトリも含む）にある音声ファイルを、
+    ディレクトリ名（取り込んだ順）とパスの順に返します。
+    """
+    files = []
+    for dataset_dir in sorted(glob.glob(f"./data/{model_name}/raw/*/dataset")):
+        for root, dirs, names in os.walk(dataset_dir):
+            dirs.sort()
+            files.extend(
+                os.path.join(root, file)
+                for file in sorted(names)
+                if file.endswith(AUDIO_EXTENSIONS)
+            )
+    return files
+
+
+def split_dataset_dir(directory: str) -> tuple[str, str]:
+    """
+    dataset の下のディレクトリを (raw/<ディレクトリ名>, dataset からの相対パス) に分けます。
+    """
+    relative: list[str] = []
+    while os.path.basename(directory) != "dataset":
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            raise ValueError(f"dataset の下のディレクトリではありません: {directory}")
+        relative.insert(0, os.path.basename(directory))
+        directory = parent
+    return os.path.dirname(directory), os.path.join("", *relative)
+
+
+def clusters_path(model_name: str) -> str:
+    """
+    重複のクラスタの一覧を保存するパスを返します。
+    """
+    return f"./data/{model_name}/dedup/clusters.json"
+
+
+def load_duplicates(raw_dir: str) -> set[str]:
+    """
+    重複として移動したクリップの名前（拡張子なし）を返します。
+    """
+    path = os.path.join(raw_dir, DUPLICATES_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def write_duplicates(raw_dir: str, names: set[str]) -> None:
+    path = os.path.join(raw_dir, DUPLICATES_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("".join(f"{name}\n" for name in sorted(names)))
+    os.replace(tmp_path, path)
+
+
+def move_aside(audio_files: list[str]) -> None:
+    """
+    クリップと同じ名前の lab・npy などを dataset と同じ階層の duplicates に移動し、duplicates.txt に記録します。
+    話者ごとのサブディレクトリは duplicates の下にも同じ構成で作ります。
+    ディレクトリごとに一覧を 1 回だけ取得し、duplicates.txt も 1 回だけ書き込みます。
+    """
+    names_by_dir: dict[str, set[str]] = {}
+    for audio_file in audio_files:
+        names_by_dir.setdefault(os.path.dirname(audio_file), set()).add(
+            os.path.splitext(os.path.basename(audio_file))[0]
+        )
+    for dataset_dir, names in names_by_dir.items():
+        raw_dir, relative = split_dataset_dir(dataset_dir)
+        duplicates_dir = os.path.join(raw_dir, DUPLICATES_DIR, relative)
+        os.makedirs(duplicates_dir, exist_ok=True)
+        for file in os.listdir(dataset_dir):
+            if os.path.splitext(file)[0] in names:
+                shutil.move(
+                    os.path.join(dataset_dir, file), os.path.join(duplicates_dir, file)
+                )
+        write_duplicates(raw_dir, load_duplicates(raw_dir) | names)
+
+
+def restore_duplicates(model_name: str) -> int:
+    """
+    duplicates に移動したファイルを dataset に戻し、duplicates.txt を削除します。戻したファイル数を返します。
+    """
+    restored = 0
+    for raw_dir in sorted(glob.glob(f"./data/{model_name}/raw/*")):
+        duplicates_dir = os.path.join(raw_dir, DUPLICATES_DIR)
+        if os.path.isdir(duplicates_dir):
+            # サブディレクトリから先に戻し、空になったディレクトリを削除する
+            for root, _, files in os.walk(duplicates_dir, topdown=False):
+                dataset_dir = os.path.join(
+                    raw_dir, "dataset", os.path.relpath(root, duplicates_dir)
+                )
+                os.makedirs(dataset_dir, exist_ok=True)
+                for file in sorted(files):
+                    shutil.move(
+                        os.path.join(root, file), os.path.join(dataset_dir, file)
+                    )
+                    restored += 1
+                os.rmdir(root)
+        if os.path.exists(os.path.join(raw_dir, DUPLICATES_FILE)):
+            os.remove(os.path.join(raw_dir, DUPLICATES_FILE))
+    print(f"dataset に戻したファイル: {restored} 件")
+    return restored
+
+
+def fingerprint_files(
+    input_files: list[str], cache: Optional[FingerprintCache], jobs: Optional[int]
+) -> dict[str, tuple[float, Optional[np.ndarray]]]:
+    """
+    クリップの (長さ, シグネチャ) を返します。キャッシュにないクリップだけをプロセスプールで計算します。
+    """
+    results: dict[str, tuple[float, Optional[np.ndarray]]] = {}
+    pending = []
+    for path in input_files:
+        cached = cache.get(path) if cache is not None else None
+        if cached is None:
+            pending.append(path)
+        else:
+            results[path] = cached
+
+    print(
+        f"フィンガープリントを計算するクリップ: {len(pending)} / {len(input_files)} 件"
+    )
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(instrumentation.timed_call, fingerprint_clip, path): path
+            for path in pending
+        }
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                elapsed, (duration, signature) = future.result()
+            except Exception as e:
+                print(f"エラー: {path} のフィンガープリントの計算に失敗しました: {e}")
+                continue
+            instrumentation.record(elapsed)
+            results[path] = (duration, signature)
+            if cache is not None:
+                cache.put(path, duration, signature)
+    return results
+
+
+def dedup(
+    model_name: str,
+    min_coverage: float = DEFAULT_MIN_COVERAGE,
+    jobs: Optional[int] = None,
+    dry_run: bool = False,
+    cache: Optional[FingerprintCache] = None,
+) -> list[dict]:
+    """
+    モデルのすべての dataset から重複したクリップを探し、残すクリップ（長いものから、同じ長さの場合は先に取り込んだもの）と
+    クリップの長さの min_coverage 以上が重なっているクリップを duplicates に移動します。
+    重なっている部分が短い組は移動せずに表示します。
+    残すクリップごとの重複の一覧と重なっている組を clusters_path(model_name) に保存し、重複の一覧を返します。
+    """
+    input_files = list_dataset_files(model_name)
+    fingerprints = fingerprint_files(input_files, cache, jobs)
+    # ピークがないクリップは比較できないため対象にしない
+    paths = [
+        path for path in input_files if fingerprints.get(path, (0, None))[1] is not None
+    ]
+    matches, overlapping = find_duplicates(
+        [fingerprints[path][0] for path in paths],
+        [fingerprints[path][1] for path in paths],
+        min_coverage,
+    )
+    groups: dict[int, list[dict]] = {}
+    for i, (keep, coverage, offset) in sorted(matches.items()):
+        groups.setdefault(keep, []).append(
+            {"path": paths[i], "coverage": coverage, "offset_seconds": offset}
+        )
+    clusters = sorted(
+        ({"keep": paths[keep], "duplicates": items} for keep, items in groups.items()),
+        key=lambda cluster: cluster["keep"],
+    )
+    overlaps = sorted(
+        (
+            {"paths": sorted([paths[first], paths[second]]), "seconds": seconds}
+            for first, second, seconds in overlapping
+        ),
+        key=lambda overlap: overlap["paths"],
+    )
+
+    duplicates = [
+        item["path"] for cluster in clusters for item in cluster["duplicates"]
+    ]
+    print(
+        f"重複したクリップ: {len(duplicates)} / {len(paths)} 件 / 一部だけ重なっている組: {len(overlaps)} 件"
+    )
+    for cluster in clusters:
+        print(f"  残す: {cluster['keep']}")
+        for item in cluster["duplicates"]:
+            print(
+                f"    重複: {item['path']}（{item['coverage']:.0%} が残すクリップの {item['offset_seconds']} 秒の位置から重なっています）"
+            )
+    for overlap in overlaps:
+        print(
+            f"  一部だけ重なっています（{overlap['seconds']} 秒）: {' と '.join(overlap['paths'])}"
+        )
+    if dry_run:
+        return clusters
+
+    move_aside(duplicates)
+    report_file = clusters_path(model_name)
+    os.makedirs(os.path.dirname(report_file), exist_ok=True)
+    tmp_path = report_file + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {"min_coverage": min_coverage, "clusters": clusters, "overlaps": overlaps},
+            f,
+            ensure_ascii=False,
+            indent=2,
+        )
+    os.replace(tmp_path, report_file)
+    print(f"duplicates に移動したクリップ: {len(duplicates)} 件")
+    return clusters
+
+
+def main(args: Optional[Namespace] = None) -> None:
+    """
+    メイン関数。重複したクリップを duplicates に移動します。
+    """
+    if args is None:
+        args = parse_arguments()
+
+    model_name = os.getenv("MODEL_NAME") or args.model_name
+    if not model_name:
+        print("モデル名が指定されていません。")
+        return
+
+    if args.restore:
+        restore_duplicates(model_name)
+        return
+
+    directory = os.getenv("FS_DATA_TS") or args.directory
+    report_file = instrumentation.report_path(model_name, directory)
+    with instrumentation.Recorder("near_dedup", report_file, args.profile):
+        cache = FingerprintCache(args.fingerprint_cache_path)
+        dedup(model_name, args.min_coverage, args.jobs, args.dry_run, cache)
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
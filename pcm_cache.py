@@ -0,0 +1,170 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+import audio_utils
+from cache_utils import content_hash, remember_content_hash
+
+DEFAULT_PCM_CACHE_DIR = "./data/cache/pcm"
+DEFAULT_PCM_CACHE_MB = 4096
+
+
+class PCMCache:
+    """
+    デコード済みのモノラル float32 の音声を、元のファイルの内容とサンプリングレートごとに
+    npy ファイルとして保存するキャッシュ。読み込みはメモリマップで行うため、配列はコピーされません。
+    合計サイズが max_bytes を超えると、最後に参照された時刻が古いものから削除します。
+    """
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_PCM_CACHE_DIR,
+        max_bytes: int = DEFAULT_PCM_CACHE_MB * 1024 * 1024,
+    ) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(directory, "index.sqlite3"),
+            check_same_thread=False,
+            timeout=60,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)"
+        )
+        # 変更されていないファイルのハッシュを再計算しないための記録
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sources ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+            "sha256 TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".npy")
+
+    def content_hash(self, input_file: str) -> str:
+        """
+        ファイルの内容のハッシュを返します。サイズと更新時刻が同じ間は記録したハッシュを使います。
+        """
+        path = os.path.abspath(input_file)
+        stat = os.stat(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sha256 FROM sources WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+        if row is not None:
+            remember_content_hash(path, stat.st_size, stat.st_mtime_ns, row[0])
+            return row[0]
+        digest = content_hash(path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sources (path, size, mtime_ns, sha256) "
+                "VALUES (?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, digest),
+            )
+            self._conn.commit()
+        return digest
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        キーに対応する音声配列を読み取り専用のメモリマップで返します。存在しない場合は None を返します。
+        """
+        entry_path = self._entry_path(key)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or not os.path.exists(entry_path):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+        return np.load(entry_path, mmap_mode="r")
+
+    def put(self, key: str, audio: np.ndarray) -> np.ndarray:
+        """
+        音声配列を保存し、上限を超えた分を古いものから削除します。保存した配列のメモリマップを返します。
+        """
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.part"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(audio, dtype=np.float32))
+        os.replace(tmp_path, entry_path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, size, last_access) VALUES (?, ?, ?)",
+                (key, os.path.getsize(entry_path), time.time()),
+            )
+            self._evict(keep=key)
+            self._conn.commit()
+        return np.load(entry_path, mmap_mode="r")
+
+    def _evict(self, keep: str) -> None:
+        (total,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM entries WHERE key != ? ORDER BY last_access", (keep,)
+        ).fetchall():
+            try:
+                os.remove(self._entry_path(key))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Windows では他のプロセスがメモリマップ中のファイルを削除できない
+                continue
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def load(self, input_file: str, sample_rate: int) -> np.ndarray:
+        """
+        音声ファイルを指定のサンプリングレートのモノラル float32 配列として返します。
+        キャッシュにない場合は ffmpeg でデコードして保存します。
+        """
+        key = f"{self.content_hash(input_file)}_{sample_rate}"
+        audio = self.get(key)
+        if audio is not None:
+            return audio
+        blocks = list(audio_utils.decode_pcm_blocks(input_file, sample_rate))
+        decoded = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.float32)
+        return self.put(key, decoded)
+
+    def stats(self) -> dict:
+        """
+        ヒット数・ミス数と、保存されている件数・合計サイズを返します。
+        """
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": count,
+            "bytes": total,
+        }
+
+    def close(self) -> None:
+        self._conn.close()
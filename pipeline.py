@@ -0,0 +1,1037 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import importlib
+import tempfile
+import time
+from argparse import Namespace
+from dataclasses import dataclass
+from functools import cached_property, partial
+from types import ModuleType
+from typing import Callable, Optional
+
+import numpy as np
+
+import audio_utils
+import instrumentation
+import near_dedup
+import quality_filter
+from cache_utils import content_hash, remember_content_hash
+from file_utils import link_or_copy, save_npy
+from metadata_index import STAGE_DIRS, MetadataIndex, index_path
+from pcm_cache import PCMCache
+from vq_cache import VQTokenCache
+
+AUDIO_EXTENSIONS = (".mp3", ".wav")
+DEFAULT_STAGES = "02,03,05,06,07"
+
+
+@dataclass
+class Context:
+    """
+    パイプラインの 1 回の実行で共有する引数とディレクトリ。
+    """
+
+    args: Namespace
+    model_name: str
+    directory: str
+
+    @property
+    def raw_dir(self) -> str:
+        return f"./data/{self.model_name}/raw/{self.directory}"
+
+    @property
+    def separate_dir(self) -> str:
+        return os.path.join(self.raw_dir, "separate")
+
+    @property
+    def normalize_dir(self) -> str:
+        return os.path.join(self.raw_dir, "normalize_loudness")
+
+    @property
+    def npy_dir(self) -> str:
+        return os.path.join(self.raw_dir, "npy")
+
+    @property
+    def dataset_dir(self) -> str:
+        return os.path.join(self.raw_dir, "dataset")
+
+    @property
+    def protos_dir(self) -> str:
+        return "./data/protos"
+
+    @property
+    def state_file(self) -> str:
+        return f"./data/{self.model_name}/pipeline/{self.directory}.json"
+
+    @property
+    def report_file(self) -> str:
+        return instrumentation.report_path(self.model_name, self.directory)
+
+    @cached_property
+    def index(self) -> MetadataIndex:
+        return MetadataIndex(index_path(self.model_name, self.directory))
+
+    @cached_property
+    def pcm_cache(self) -> Optional[PCMCache]:
+        if getattr(self.args, "no_pcm_cache", False):
+            return None
+        return PCMCache()
+
+    @cached_property
+    def vq_cache(self) -> Optional[VQTokenCache]:
+        if getattr(self.args, "no_vq_cache", False):
+            return None
+        return VQTokenCache(self.args.checkpoint_path, self.args.config_name)
+
+
+@dataclass
+class Stage:
+    """
+    パイプラインの 1 段階。
+    units は処理単位のキーとその入力ファイルの一覧、params は出力に影響する設定、
+    run は指定した処理単位を実行して、それぞれの出力ファイルの一覧を返します。
+    prune が True の場合、入力がなくなった処理単位の出力を削除します。
+    """
+
+    name: str
+    units: Callable[[Context], dict[str, list[str]]]
+    params: Callable[[Context], dict]
+    run: Callable[[Context, list[str]], dict[str, list[str]]]
+    prune: bool = True
+
+
+def add_target_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    対象のモデル名とディレクトリの引数を追加します。
+    """
+    parser.add_argument(
+        "--model-name",
+        "-M",
+        help="[OPTION] モデル名（環境変数 MODEL_NAME からも読み取ります）",
+    )
+    parser.add_argument(
+        "--directory",
+        "-D",
+        help="[OPTION] YYMMDD_HHMMSS フォーマットのディレクトリ名（環境変数 FS_DATA_TS からも読み取ります）",
+    )
+    parser.add_argument(
+        "--force",
+        "-F",
+        action="store_true",
+        help="[OPTION] 既存の出力や記録を無視してすべて再計算します。",
+    )
+    instrumentation.add_arguments(parser)
+
+
+def add_separate_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    02 の分割と 03 の正規化に関する引数を追加します。
+    """
+    parser.add_argument(
+        "--start", type=int, default=0, help="[OPTION] 02: 分割開始時間（秒）"
+    )
+    parser.add_argument(
+        "--interval", type=int, default=30, help="[OPTION] 02: 分割間隔（秒）"
+    )
+    parser.add_argument(
+        "--overlay", type=int, default=5, help="[OPTION] 02: 分割の重なり（秒）"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["fixed", "vad"],
+        default="fixed",
+        help="[OPTION] 02: 分割方法",
+    )
+    parser.add_argument(
+        "--min-length", type=float, default=5.0, help="[OPTION] 02: vad の最小長（秒）"
+    )
+    parser.add_argument(
+        "--max-length", type=float, default=30.0, help="[OPTION] 02: vad の最大長（秒）"
+    )
+    parser.add_argument(
+        "--silence-threshold",
+        type=float,
+        default=-40.0,
+        help="[OPTION] 02: vad の無音の音量（dBFS）",
+    )
+    parser.add_argument(
+        "--min-silence",
+        type=float,
+        default=0.3,
+        help="[OPTION] 02: vad の無音の最小長（秒）",
+    )
+    parser.add_argument(
+        "--loudness-target",
+        type=float,
+        default=-23.0,
+        help="[OPTION] 03: ラウドネス正規化のターゲット値（dB LUFS）",
+    )
+
+
+def add_model_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    04 / 05 / 06 で使うモデルに関する引数を追加します。
+    """
+    parser.add_argument(
+        "--checkpoint-path",
+        default=os.getenv(
+            "FS_CHECKPOINT_PATH",
+            "checkpoints/fish-speech-1.5/firefly-gan-vq-fsq-8x1024-21hz-generator.pth",
+        ),
+        help="[OPTION] 04 / 06: チェックポイントファイルのパス",
+    )
+    parser.add_argument(
+        "--config-name",
+        default="firefly_gan_vq",
+        help="[OPTION] 04 / 06: 設定ファイルの名前",
+    )
+    parser.add_argument("--device", help="[OPTION] 04: --in-process で使うデバイス")
+    parser.add_argument(
+        "--vq-batch-size",
+        type=int,
+        default=16,
+        help="[OPTION] 04 / 06: バッチサイズ（06 は extract_vq.py を使う場合だけ）",
+    )
+    parser.add_argument(
+        "--whisper-model",
+        "-W",
+        default=os.getenv("WHISPER_MODEL"),
+        help="[OPTION] 05: Whisper モデル名",
+    )
+    parser.add_argument(
+        "--whisper-batch-size", type=int, default=8, help="[OPTION] 05: バッチサイズ"
+    )
+    parser.add_argument(
+        "--no-pcm-cache",
+        action="store_true",
+        help="[OPTION] 04 / 05: デコード済み音声のキャッシュを使用しません。",
+    )
+    parser.add_argument(
+        "--no-vq-cache",
+        action="store_true",
+        help="[OPTION] 04 / 06: VQ トークンのキャッシュを使用しません。",
+    )
+
+
+def parse_arguments() -> Namespace:
+    """
+    コマンドライン引数を解析します。
+    """
+    parser = argparse.ArgumentParser(
+        description="01〜08 のスクリプトを 1 つのパイプラインとして実行し、"
+        "入力や設定が変わったファイルだけを再計算します。"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="パイプラインを実行します。")
+    add_target_arguments(run)
+    run.add_argument(
+        "--stages",
+        default=DEFAULT_STAGES,
+        help=f"[OPTION] 実行するステージ番号をカンマ区切りで指定します。デフォルトは {DEFAULT_STAGES} です。"
+        "--source を指定した場合は 01 も実行します。",
+    )
+    run.add_argument(
+        "--source", help="[OPTION] 01 で取り込む元の音声ファイルのディレクトリ"
+    )
+    run.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="[OPTION] 実行せずに、再計算が必要なファイルを表示します。",
+    )
+    add_separate_arguments(run)
+    add_model_arguments(run)
+    run.add_argument(
+        "--min-duration",
+        type=float,
+        default=quality_filter.DEFAULT_THRESHOLDS["min_duration"],
+        help="[OPTION] 03q: クリップの最小の長さ（秒）",
+    )
+    run.add_argument(
+        "--max-duration",
+        type=float,
+        default=quality_filter.DEFAULT_THRESHOLDS["max_duration"],
+        help="[OPTION] 03q: クリップの最大の長さ（秒）",
+    )
+    run.add_argument(
+        "--max-silence-ratio",
+        type=float,
+        default=quality_filter.DEFAULT_THRESHOLDS["max_silence_ratio"],
+        help="[OPTION] 03q: 無音のフレームの割合の上限",
+    )
+    run.add_argument(
+        "--max-clipping-rate",
+        type=float,
+        default=quality_filter.DEFAULT_THRESHOLDS["max_clipping_rate"],
+        help="[OPTION] 03q: クリッピングしたサンプルの割合の上限",
+    )
+    run.add_argument(
+        "--min-snr-db",
+        type=float,
+        default=quality_filter.DEFAULT_THRESHOLDS["min_snr_db"],
+        help="[OPTION] 03q: 推定 SNR（dB）の下限",
+    )
+    run.add_argument(
+        "--silence-db",
+        type=float,
+        default=quality_filter.DEFAULT_SILENCE_DB,
+        help="[OPTION] 03q: 無音とみなすフレームの RMS（dBFS）",
+    )
+    run.add_argument(
+        "--in-process",
+        action="store_true",
+        help="[OPTION] 04 / 06: プロセス内でまとめてエンコードします。",
+    )
+    run.add_argument(
+        "--vq-num-workers", type=int, default=1, help="[OPTION] 06: ワーカーの数"
+    )
+    run.add_argument(
+        "--vq-max-batch-seconds",
+        type=float,
+        default=240.0,
+        help="[OPTION] 06: --in-process で 1 バッチにまとめる音声の長さの合計（秒）",
+    )
+    run.add_argument(
+        "--vq-max-batch-items",
+        type=int,
+        help="[OPTION] 06: --in-process で 1 バッチにまとめるクリップ数の上限。デフォルトは制限なしです。",
+    )
+    run.add_argument(
+        "--dedup-min-coverage",
+        type=float,
+        default=near_dedup.DEFAULT_MIN_COVERAGE,
+        help="[OPTION] 06d: 重複とみなす、残すクリップと重なっている部分の割合の下限",
+    )
+    run.add_argument(
+        "--pretokenize",
+        metavar="TOKENIZER",
+        help="[OPTION] 07: 指定したトークナイザーで lab のテキストを事前にトークン化します。",
+    )
+    run.add_argument(
+        "--training-config-name",
+        default="text2semantic_finetune_customize",
+        help="[OPTION] 08: 学習の設定ファイルの名前",
+    )
+
+    stream = subparsers.add_parser(
+        "stream",
+        help="元の音声ファイルを一度だけデコードし、分割・正規化・文字起こし・VQ をメモリ上で続けて行います。",
+    )
+    add_target_arguments(stream)
+    add_separate_arguments(stream)
+    add_model_arguments(stream)
+    stream.add_argument(
+        "--output-dir",
+        help="[OPTION] 正規化済みの wav と lab（と npy）の出力先。デフォルトは normalize_loudness です。",
+    )
+    stream.add_argument(
+        "--sample-rate",
+        type=int,
+        default=44100,
+        help="[OPTION] デコードと出力する wav のサンプリングレート。--vq の場合はモデルのレートを使います。",
+    )
+    stream.add_argument(
+        "--vq",
+        action="store_true",
+        help="[OPTION] VQ トークンも生成し、wav と同じディレクトリに npy として保存します。",
+    )
+    return parser.parse_args()
+
+
+def import_stage(module_name: str) -> ModuleType:
+    """
+    番号付きのスクリプトをモジュールとして読み込みます。
+    """
+    return importlib.import_module(module_name)
+
+
+def list_audio_files(directory: str) -> list[str]:
+    """
+    ディレクトリ直下の音声ファイルを名前順に返します。
+    """
+    if not os.path.isdir(directory):
+        return []
+    return [
+        os.path.join(directory, file)
+        for file in sorted(os.listdir(directory))
+        if file.endswith(AUDIO_EXTENSIONS)
+    ]
+
+
+def list_raw_files(directory: str) -> list[str]:
+    """
+    raw の下のフォルダも含めた元の音声ファイルを名前順に返します。各ステージの出力ディレクトリは除きます。
+    """
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [name for name in dirs if name not in STAGE_DIRS]
+        files.extend(
+            os.path.join(root, name)
+            for name in names
+            if name.endswith(AUDIO_EXTENSIONS)
+        )
+    return sorted(files)
+
+
+# 01 ファイルコピー
+def units_file_copy(ctx: Context) -> dict[str, list[str]]:
+    if not ctx.args.source:
+        return {}
+    return {path: [path] for path in list_audio_files(ctx.args.source)}
+
+
+def run_file_copy(ctx: Context, keys: list[str]) -> dict[str, list[str]]:
+    os.makedirs(ctx.raw_dir, exist_ok=True)
+    outputs = {}
+    for key in keys:
+        dest_file = os.path.join(ctx.raw_dir, os.path.basename(key))
+        shutil.copy(key, dest_file)
+        print(f"コピーされたファイル: {dest_file}")
+        outputs[key] = [dest_file]
+    return outputs
+
+
+# 02 分割
+def params_separate(ctx: Context) -> dict:
+    args = ctx.args
+    params = {"mode": args.mode, "start": args.start}
+    if args.mode == "vad":
+        params.update(
+            min_length=args.min_length,
+            max_length=args.max_length,
+            silence_threshold=args.silence_threshold,
+            min_silence=args.min_silence,
+        )
+    else:
+        params.update(interval=args.interval, overlay=args.overlay)
+    return params
+
+
+def run_separate(ctx: Context, keys: list[str]) -> dict[str, list[str]]:
+    separate = import_stage("02_separate")
+    args = ctx.args
+    planner = None
+    if args.mode == "vad":
+        planner = partial(
+            separate.plan_vad_segments,
+            start_time=args.start,
+            min_length=args.min_length,
+            max_length=args.max_length,
+            silence_threshold=args.silence_threshold,
+            min_silence=args.min_silence,
+        )
+    ctx.index.refresh(ctx.raw_dir, "raw", recursive=True, exclude=STAGE_DIRS)
+    outputs = {}
+    for key in keys:
+        pending = separate.prepare_segments(
+            key,
+            ctx.separate_dir,
+            args.start,
+            args.interval,
+            args.overlay,
+            True,
+            planner,
+            ctx.index.duration(key),
+        )
+        for group in separate.group_segments(pending):
+            if not separate.write_segments(key, group):
+                raise RuntimeError(f"分割に失敗しました: {key}")
+        ctx.index.set_sources([(path, key) for path, _, _ in pending], "separate")
+        outputs[key] = [output_filepath for output_filepath, _, _ in pending]
+    return outputs
+
+
+# 03 正規化
+def run_normalize(ctx: Context, keys: list[str]) -> dict[str, list[str]]:
+    normalize = import_stage("03_normalize")
+    os.makedirs(ctx.normalize_dir, exist_ok=True)
+    outputs = {}
+    # 対象のファイルだけを一時ディレクトリに集めて正規化する
+    with tempfile.TemporaryDirectory(dir=ctx.raw_dir) as tmp:
+        input_dir = os.path.join(tmp, "input")
+        output_dir = os.path.join(tmp, "output")
+        os.makedirs(input_dir)
+        for key in keys:
+            link_or_copy(key, os.path.join(input_dir, os.path.basename(key)))
+        normalize.normalize_loudness(input_dir, output_dir, ctx.args.loudness_target)
+        for key in keys:
+            dest_file = os.path.join(ctx.normalize_dir, os.path.basename(key))
+            os.replace(os.path.join(output_dir, os.path.basename(key)), dest_file)
+            outputs[key] = [dest_file]
+    return outputs
+
+
+# 03q 品質フィルタ
+def params_quality(ctx: Context) -> dict:
+    args = ctx.args
+    return {
+        "min_duration": args.min_duration,
+        "max_duration": args.max_duration,
+        "max_silence_ratio": args.max_silence_ratio,
+        "max_clipping_rate": args.max_clipping_rate,
+        "min_snr_db": args.min_snr_db,
+        "silence_db": args.silence_db,
+    }
+
+
+def run_quality_filter(ctx: Context, keys: list[str]) -> dict[str, list[str]]:
+    params = params_quality(ctx)
+    silence_db = params.pop("silence_db")
+    # rejected.txt はディレクトリ全体の判定結果なので、変わっていないクリップも含めて判定し直す
+    # （解析結果は再利用されるため、解析するのは keys のクリップだけです）
+    quality_filter.filter_clips(
+        list_audio_files(ctx.normalize_dir),
+        ctx.raw_dir,
+        params,
+        silence_db=silence_db,
+    )
+    quality_file = os.path.join(ctx.raw_dir, quality_filter.QUALITY_FILE)
+    return {key: [quality_file] for key in keys}
+
+
+def list_accepted_files(ctx: Context) -> list[str]:
+    """
+    正規化済みの音声ファイルのうち、品質フィルタで除外していないものを返します。
+    """
+    rejected = quality_filter.load_rejected(ctx.raw_dir)
+    return [
+        path
+        for path in list_audio_files(ctx.normalize_dir)
+        if os.path.splitext(os.path.basename(path))[0] not in rejected
+    ]
+
+
+# 04 npy 生成
+def run_generate_npy(ctx: Context, keys: list[str]) -> dict[str, list[str]]:
+    generate = import_stage("04_generate_wav_to_npy")
+    args = ctx.args
+    os.makedirs(ctx.npy_dir, exist_ok=True)
+    if args.in_process:
+        generate.generate_npy_in_process(
+            keys,
+            ctx.npy_dir,
+            args.checkpoint_path,
+            args.config_name,
+            args.device,
+            args.vq_batch_size,
+            ctx.pcm_cache,
+            ctx.vq_cache,
+        )
+    else:
+        pending = keys
+        if ctx.vq_cache is not None:
+            missing = ctx.vq_cache.restore(
+                keys, [generate.npy_output_path(key, ctx.npy_dir) for key in keys]
+            )
+            pending = [key for key, _ in missing]
+        for key in pending:
+            generate.generate_npy(key, ctx.npy_dir, args.checkpoint_path)
+        if ctx.vq_cache is not None:
+            ctx.vq_cache.store(
+                pending, [generate.npy_output_path(key, ctx.npy_dir) for key in pending]
+            )
+    return {key: [generate.npy_output_path(key, ctx.npy_dir)] for key in keys}
+
+
+# 05 文字起こし
+def run_speech_to_text(ctx: Context, keys: list[str]) -> dict[str, list[str]]:
+    speech = import_stage("05_speech_to_text")
+    if not ctx.args.whisper_model:
+        raise RuntimeError(
+            "Whisper モデル名が指定されていません。--whisper-model オプションまたは WHISPER_MODEL 環境変数を設定してください。"
+        )
+    speech.transcribe_files(
+        keys,
+        ctx.args.whisper_model,
+        "lab",
+        ctx.args.whisper_batch_size,
+        pcm_cache=ctx.pcm_cache,
+    )
+    return {key: [os.path.splitext(key)[0] + ".lab"] for key in keys}
+
+
+# 06 データセットの作成と VQ
+def units_dataset(ctx: Context) -> dict[str, list[str]]:
+    units = {}
+    # 06d で重複として移動したクリップは作り直さない
+    duplicates = near_dedup.load_duplicates(ctx.raw_dir)
+    for path in list_accepted_files(ctx):
+        if os.path.splitext(os.path.basename(path))[0] in duplicates:
+            continue
+        lab_file = os.path.splitext(path)[0] + ".lab"
+        if os.path.exists(lab_file):
+            units[path] = [path, lab_file]
+    return units
+
+
+def run_dataset(ctx: Context, keys: list[str]) -> dict[str, list[str]]:
+    extract = import_stage("06_generate_wav_and_lab_to_npy")
+    args = ctx.args
+    os.makedirs(ctx.dataset_dir, exist_ok=True)
+    outputs = {}
+    for key in keys:
+        base = os.path.join(ctx.dataset_dir, os.path.splitext(os.path.basename(key))[0])
+        audio_file = base + os.path.splitext(key)[1]
+        link_or_copy(key, audio_file)
+        link_or_copy(os.path.splitext(key)[0] + ".lab", base + ".lab")
+        # extract_vq.py は npy が存在しないファイルだけをエンコードする
+        if os.path.exists(base + ".npy"):
+            os.remove(base + ".npy")
+        outputs[key] = [audio_file, base + ".lab", base + ".npy"]
+    extract_args = Namespace(
+        num_workers=args.vq_num_workers,
+        # --in-process のバッチは音声の長さの合計で区切り、件数は上限を指定した場合だけ制限する
+        batch_size=args.vq_max_batch_items if args.in_process else args.vq_batch_size,
+        config_name=args.config_name,
+        checkpoint_path=args.checkpoint_path,
+        max_batch_seconds=args.vq_max_batch_seconds,
+        device=args.device,
+    )
+    if args.in_process:
+        extract.encode_in_process(
+            ctx.dataset_dir, extract_args, ctx.vq_cache, pcm_cache=ctx.pcm_cache
+        )
+    elif ctx.vq_cache is not None:
+        extract.run_extract_vq_cached(ctx.dataset_dir, extract_args, ctx.vq_cache)
+    else:
+        extract.run_extract_vq(ctx.dataset_dir, extract_args)
+    return outputs
+
+
+# 06d 重複の除去
+def units_near_dedup(ctx: Context) -> dict[str, list[str]]:
+    # モデルのすべてのディレクトリの dataset をまとめて 1 つの処理単位にする
+    files = near_dedup.list_dataset_files(ctx.model_name)
+    return {"near_dedup": files} if files else {}
+
+
+def run_near_dedup(ctx: Context, keys: list[str]) -> dict[str, list[str]]:
+    cache = near_dedup.FingerprintCache()
+    near_dedup.dedup(ctx.model_name, ctx.args.dedup_min_coverage, cache=cache)
+    cache.close()
+    return {key: [near_dedup.clusters_path(ctx.model_name)] for key in keys}
+
+
+# 07 protobuf
+def units_protobuf(ctx: Context) -> dict[str, list[str]]:
+    if not os.path.isdir(ctx.dataset_dir):
+        return {}
+    files = sorted(
+        os.path.join(root, file)
+        for root, _, names in os.walk(ctx.dataset_dir)
+        for file in names
+        if file.endswith((".npy", ".lab"))
+    )
+    return {ctx.dataset_dir: files} if files else {}
+
+
+def list_protos(directory: str) -> list[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(root, file)
+        for root, _, files in os.walk(directory)
+        for file in files
+        if file.endswith(".protos")
+    )
+
+
+def run_protobuf(ctx: Context, keys: list[str]) -> dict[str, list[str]]:
+    protobuf = import_stage("07_create_protobuf")
+    os.makedirs(ctx.protos_dir, exist_ok=True)
+    # 共有の ./data/protos は消さず、このバッチのシャードだけを作り直す
+    batch_name = f"{ctx.model_name}_{ctx.directory}"
+    outputs = {}
+    for key in keys:
+        protobuf.create_protobuf_incremental(
+            key,
+            ctx.protos_dir,
+            batch_name,
+            True,
+            tokenizer_path=ctx.args.pretokenize,
+        )
+        outputs[key] = list_protos(os.path.join(ctx.protos_dir, batch_name))
+    return outputs
+
+
+# 08 学習
+def units_training(ctx: Context) -> dict[str, list[str]]:
+    protos = list_protos(ctx.protos_dir)
+    return {"training": protos} if protos else {}
+
+
+def run_training(ctx: Context, keys: list[str]) -> dict[str, list[str]]:
+    training = import_stage("08_training")
+    training.training(ctx.model_name, ctx.args.training_config_name)
+    return {key: [] for key in keys}
+
+
+STAGES: dict[str, Stage] = {
+    "01": Stage(
+        "01_file_copy", units_file_copy, lambda ctx: {}, run_file_copy, prune=False
+    ),
+    "02": Stage(
+        "02_separate",
+        lambda ctx: {path: [path] for path in list_raw_files(ctx.raw_dir)},
+        params_separate,
+        run_separate,
+    ),
+    "03": Stage(
+        "03_normalize",
+        lambda ctx: {path: [path] for path in list_audio_files(ctx.separate_dir)},
+        lambda ctx: {"loudness_target": ctx.args.loudness_target},
+        run_normalize,
+    ),
+    "03q": Stage(
+        "03q_quality_filter",
+        lambda ctx: {path: [path] for path in list_audio_files(ctx.normalize_dir)},
+        params_quality,
+        run_quality_filter,
+        prune=False,
+    ),
+    "04": Stage(
+        "04_generate_wav_to_npy",
+        lambda ctx: {path: [path] for path in list_accepted_files(ctx)},
+        lambda ctx: {
+            "checkpoint_path": ctx.args.checkpoint_path,
+            "config_name": ctx.args.config_name,
+        },
+        run_generate_npy,
+    ),
+    "05": Stage(
+        "05_speech_to_text",
+        lambda ctx: {path: [path] for path in list_accepted_files(ctx)},
+        lambda ctx: {"whisper_model": ctx.args.whisper_model, "language": "ja"},
+        run_speech_to_text,
+    ),
+    "06": Stage(
+        "06_generate_wav_and_lab_to_npy",
+        units_dataset,
+        lambda ctx: {
+            "checkpoint_path": ctx.args.checkpoint_path,
+            "config_name": ctx.args.config_name,
+        },
+        run_dataset,
+    ),
+    "06d": Stage(
+        "06d_near_dedup",
+        units_near_dedup,
+        lambda ctx: {"min_coverage": ctx.args.dedup_min_coverage},
+        run_near_dedup,
+        prune=False,
+    ),
+    "07": Stage(
+        "07_create_protobuf",
+        units_protobuf,
+        # 指定しない場合は以前と同じ設定として扱う
+        lambda ctx: (
+            {"pretokenize": ctx.args.pretokenize} if ctx.args.pretokenize else {}
+        ),
+        run_protobuf,
+    ),
+    "08": Stage(
+        "08_training",
+        units_training,
+        lambda ctx: {"config_name": ctx.args.training_config_name},
+        run_training,
+        prune=False,
+    ),
+}
+
+
+def params_hash(params: dict) -> str:
+    """
+    ステージの設定のハッシュを返します。
+    """
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class StateStore:
+    """
+    各ステージの処理単位ごとに、入力ファイルのフィンガープリントと設定、出力ファイルを記録します。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.state: dict = {"fingerprints": {}, "stages": {}}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.state = json.load(f)
+
+    def fingerprint(self, path: str) -> Optional[str]:
+        """
+        ファイルの内容のハッシュを返します。サイズと更新時刻が同じ場合は前回の値を再利用します。
+        """
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        cached = self.state["fingerprints"].get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            remember_content_hash(path, *cached)
+            return cached[2]
+        digest = content_hash(path)
+        self.state["fingerprints"][path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def records(self, stage: str) -> dict:
+        return self.state["stages"].setdefault(stage, {})
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def is_dirty(
+    store: StateStore, record: Optional[dict], inputs: dict, params: str
+) -> bool:
+    """
+    処理単位の再計算が必要かどうかを判定します。
+    """
+    if record is None or record["params"] != params or record["inputs"] != inputs:
+        return True
+    return not all(os.path.exists(path) for path in record["outputs"])
+
+
+def run_stage(ctx: Context, store: StateStore, number: str) -> int:
+    """
+    ステージのうち、入力か設定が変わった処理単位だけを実行します。
+    実行した処理単位の数を返します。
+    """
+    stage = STAGES[number]
+    records = store.records(stage.name)
+    params = params_hash(stage.params(ctx))
+    units = stage.units(ctx)
+
+    fingerprints = {
+        key: {path: store.fingerprint(path) for path in inputs}
+        for key, inputs in units.items()
+    }
+    dirty = [
+        key
+        for key in units
+        if ctx.args.force
+        or is_dirty(store, records.get(key), fingerprints[key], params)
+    ]
+
+    # 入力がなくなった処理単位の出力を削除する
+    stale = [key for key in records if key not in units]
+    if stage.prune and not ctx.args.dry_run:
+        for key in stale:
+            for path in records.pop(key)["outputs"]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    print(f"[{stage.name}] {len(dirty)} / {len(units)} 件を再計算します。")
+    if ctx.args.dry_run:
+        for key in dirty:
+            print(f"  {key}")
+        return len(dirty)
+    if not dirty:
+        # 削除した処理単位と、計算したフィンガープリントを記録する
+        store.save()
+        return 0
+
+    with instrumentation.Recorder(stage.name, ctx.report_file, ctx.args.profile):
+        outputs = stage.run(ctx, dirty)
+    for key, paths in outputs.items():
+        previous = records.get(key, {}).get("outputs", [])
+        for path in set(previous) - set(paths):
+            if os.path.exists(path):
+                os.remove(path)
+        records[key] = {"params": params, "inputs": fingerprints[key], "outputs": paths}
+    store.save()
+    return len(dirty)
+
+
+def flush_stream_batch(
+    batch: list[tuple[str, np.ndarray]],
+    sample_rate: int,
+    whisper_model,
+    vq_model,
+) -> None:
+    """
+    正規化済みのセグメントをまとめて文字起こし（と VQ）し、最終的な成果物だけを書き出します。
+    """
+    speech = import_stage("05_speech_to_text")
+    for output_file, audio in batch:
+        audio_utils.write_audio(output_file, audio, sample_rate)
+    texts = speech.transcribe_batch(
+        whisper_model,
+        [
+            audio_utils.resample(audio, sample_rate, speech.WHISPER_SAMPLE_RATE)
+            for _, audio in batch
+        ],
+    )
+    for (output_file, _), text in zip(batch, texts):
+        speech.write_text(os.path.splitext(output_file)[0] + ".lab", text)
+    if vq_model is not None:
+        import vq_encoder
+
+        codes = vq_encoder.encode_batch(vq_model, [audio for _, audio in batch])
+        for (output_file, _), code in zip(batch, codes):
+            save_npy(os.path.splitext(output_file)[0] + ".npy", code)
+
+
+def stream_source(
+    ctx: Context, input_file: str, output_dir: str, whisper_model, vq_model
+) -> int:
+    """
+    元の音声ファイルを一度だけデコードし、分割・正規化・リサンプリングをメモリ上で行います。
+    書き出したセグメント数を返します。
+    """
+    separate = import_stage("02_separate")
+    args = ctx.args
+    sample_rate = args.sample_rate
+    if vq_model is not None:
+        import vq_encoder
+
+        sample_rate = vq_encoder.sample_rate_of(vq_model)
+
+    blocks = audio_utils.decode_pcm_blocks(
+        input_file, sample_rate, start_time=args.start
+    )
+    if args.mode == "vad":
+        windows = separate.iter_vad_windows(
+            blocks,
+            sample_rate,
+            args.min_length,
+            args.max_length,
+            args.silence_threshold,
+            args.min_silence,
+        )
+    else:
+        windows = separate.iter_fixed_windows(
+            blocks, sample_rate, args.interval, args.overlay
+        )
+
+    base_filename = os.path.splitext(os.path.basename(input_file))[0]
+    suffixes = [".wav", ".lab"] + ([".npy"] if vq_model is not None else [])
+    batch: list[tuple[str, np.ndarray]] = []
+    written = 0
+    for segment_number, begin, end, audio in windows:
+        output_file = os.path.join(
+            output_dir,
+            separate.generate_output_filename(
+                base_filename,
+                segment_number,
+                args.start + begin // sample_rate,
+                args.start + end // sample_rate,
+                ".wav",
+            ),
+        )
+        base = os.path.splitext(output_file)[0]
+        if not args.force and all(os.path.exists(base + s) for s in suffixes):
+            print(f"スキップされたファイル: {output_file}（既に存在します）")
+            continue
+        batch.append(
+            (
+                output_file,
+                audio_utils.loudness_normalize(
+                    audio, sample_rate, args.loudness_target
+                ),
+            )
+        )
+        if len(batch) >= args.whisper_batch_size:
+            flush_stream_batch(batch, sample_rate, whisper_model, vq_model)
+            written += len(batch)
+            batch = []
+    if batch:
+        flush_stream_batch(batch, sample_rate, whisper_model, vq_model)
+        written += len(batch)
+    return written
+
+
+def run_stream(ctx: Context) -> None:
+    """
+    raw ディレクトリ直下の音声ファイルをストリーミングで処理します。
+    """
+    args = ctx.args
+    if not args.whisper_model:
+        print(
+            "Whisper モデル名が指定されていません。--whisper-model オプションまたは WHISPER_MODEL 環境変数を設定してください。"
+        )
+        sys.exit(1)
+
+    speech = import_stage("05_speech_to_text")
+    whisper_model = speech.load_whisper_model(args.whisper_model)
+    vq_model = None
+    if args.vq:
+        import vq_encoder
+
+        vq_model = vq_encoder.load_vq_model(
+            args.checkpoint_path,
+            args.config_name,
+            args.device or vq_encoder.default_device(),
+        )
+
+    output_dir = args.output_dir or ctx.normalize_dir
+    os.makedirs(output_dir, exist_ok=True)
+    started_at = time.perf_counter()
+    total = 0
+    with instrumentation.Recorder("stream", ctx.report_file, args.profile):
+        for input_file in list_raw_files(ctx.raw_dir):
+            with instrumentation.measure("source"):
+                total += stream_source(
+                    ctx, input_file, output_dir, whisper_model, vq_model
+                )
+    elapsed = time.perf_counter() - started_at
+    print(f"ストリーミング処理が完了しました: {total} セグメント / {elapsed:.1f} 秒")
+
+
+def main(args: Optional[Namespace] = None) -> None:
+    """
+    メイン関数。コマンドライン引数を解析し、パイプラインを実行します。
+    """
+    if args is None:
+        args = parse_arguments()
+
+    model_name = os.getenv("MODEL_NAME") or args.model_name
+    if not model_name:
+        print("モデル名が指定されていません。")
+        sys.exit(1)
+
+    directory = os.getenv("FS_DATA_TS") or args.directory
+    if not directory:
+        print("ディレクトリが指定されていません。")
+        sys.exit(1)
+
+    error = import_stage("02_separate").split_options_error(
+        args.mode, args.interval, args.overlay, args.min_length, args.max_length
+    )
+    if error:
+        print(error)
+        sys.exit(1)
+
+    ctx = Context(args, model_name, directory)
+    if args.command == "stream":
+        run_stream(ctx)
+        return
+
+    numbers = [number.strip() for number in args.stages.split(",") if number.strip()]
+    if args.source and "01" not in numbers:
+        numbers.insert(0, "01")
+    unknown = [number for number in numbers if number not in STAGES]
+    if unknown:
+        print(f"不明なステージです: {', '.join(unknown)}")
+        sys.exit(1)
+
+    store = StateStore(ctx.state_file)
+    for number in sorted(numbers):
+        run_stage(ctx, store, number)
+    if args.dry_run:
+        print(
+            "※ 上流のステージの出力が変わると、下流のステージの再計算はさらに増えます。"
+        )
+
+
+if __name__ == "__main__":
+    main()
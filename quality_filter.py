@@ -0,0 +1,348 @@
+import os
+import json
+import argparse
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional
+
+import numpy as np
+
+import audio_utils
+import instrumentation
+from metadata_index import MetadataIndex, index_path
+
+QUALITY_FILE = "quality.json"
+REJECTED_FILE = "rejected.txt"
+DEFAULT_SAMPLE_RATE = 44100
+DEFAULT_SILENCE_DB = -50.0
+FRAME_SECONDS = 0.02
+# クリップ自身のピークとの差が int16 の 1.5 段階以内のサンプルが MIN_CLIP_RUN 個以上続く区間をクリッピングとみなす。
+# ラウドネス正規化で音量が変わってもクリッピングした区間は同じ値のまま平らに残る
+CLIP_TOLERANCE = 1.5 / 32768
+MIN_CLIP_RUN = 3
+# デジタル無音のフレームで SNR が発散しないようにする
+FLOOR_DB = -100.0
+DEFAULT_THRESHOLDS = {
+    "min_duration": 1.0,
+    "max_duration": None,
+    "max_silence_ratio": 0.5,
+    "max_clipping_rate": 0.001,
+    "min_snr_db": 15.0,
+}
+
+
+def parse_arguments() -> Namespace:
+    """
+    コマンドライン引数を解析します。
+    """
+    parser = argparse.ArgumentParser(
+        description="クリップの無音の割合・クリッピング率・推定 SNR・長さを計算し、"
+        "しきい値を満たさないクリップを以降のステージから除外します。"
+    )
+    parser.add_argument(
+        "--model-name",
+        "-M",
+        help="[OPTION] モデル名（環境変数 MODEL_NAME が優先されます）",
+    )
+    parser.add_argument(
+        "--directory",
+        "-D",
+        help="[OPTION] YYMMDD_HHMMSS フォーマットのディレクトリ名（環境変数 FS_DATA_TS が優先されます）",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count(),
+        help="[OPTION] 並列に解析するファイル数。デフォルトは CPU コア数です。",
+    )
+    parser.add_argument(
+        "--min-duration",
+        type=float,
+        default=DEFAULT_THRESHOLDS["min_duration"],
+        help=f"[OPTION] クリップの最小の長さ（秒）。デフォルトは {DEFAULT_THRESHOLDS['min_duration']} です。",
+    )
+    parser.add_argument(
+        "--max-duration",
+        type=float,
+        default=DEFAULT_THRESHOLDS["max_duration"],
+        help="[OPTION] クリップの最大の長さ（秒）。デフォルトは制限なしです。",
+    )
+    parser.add_argument(
+        "--max-silence-ratio",
+        type=float,
+        default=DEFAULT_THRESHOLDS["max_silence_ratio"],
+        help=f"[OPTION] 無音のフレームの割合の上限。デフォルトは {DEFAULT_THRESHOLDS['max_silence_ratio']} です。",
+    )
+    parser.add_argument(
+        "--max-clipping-rate",
+        type=float,
+        default=DEFAULT_THRESHOLDS["max_clipping_rate"],
+        help=f"[OPTION] クリッピングしたサンプルの割合の上限。デフォルトは {DEFAULT_THRESHOLDS['max_clipping_rate']} です。",
+    )
+    parser.add_argument(
+        "--min-snr-db",
+        type=float,
+        default=DEFAULT_THRESHOLDS["min_snr_db"],
+        help=f"[OPTION] 推定 SNR（dB）の下限。BGM や雑音が大きいクリップを除外します。デフォルトは {DEFAULT_THRESHOLDS['min_snr_db']} です。",
+    )
+    parser.add_argument(
+        "--silence-db",
+        type=float,
+        default=DEFAULT_SILENCE_DB,
+        help=f"[OPTION] 無音とみなすフレームの RMS（dBFS）。デフォルトは {DEFAULT_SILENCE_DB} です。",
+    )
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def load_rejected(raw_dir: str) -> set[str]:
+    """
+    品質フィルタで除外したクリップの名前（拡張子なし）を返します。フィルタを実行していない場合は空です。
+    """
+    path = os.path.join(raw_dir, REJECTED_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def skip_rejected(input_files: list[str], raw_dir: str) -> list[str]:
+    """
+    品質フィルタで除外したクリップを取り除いたファイルの一覧を返します。
+    クリップはディレクトリをまたいで名前（拡張子なし）で照合します。
+    """
+    rejected = load_rejected(raw_dir)
+    if not rejected:
+        return input_files
+    kept = [
+        path
+        for path in input_files
+        if os.path.splitext(os.path.basename(path))[0] not in rejected
+    ]
+    if len(kept) < len(input_files):
+        print(
+            f"品質フィルタで除外したクリップをスキップします: {len(input_files) - len(kept)} 件"
+        )
+    return kept
+
+
+def clipping_rate(samples: np.ndarray) -> float:
+    """
+    クリップのピークに張り付いて平らになったサンプルの割合を返します。
+    ピークに達するサンプルが MIN_CLIP_RUN 個未満しか続かない場合は通常の波形の頂点として数えません。
+    """
+    if len(samples) == 0:
+        return 0.0
+    magnitude = np.abs(samples)
+    peak = float(magnitude.max())
+    if peak <= 0:
+        return 0.0
+    starts, ends = audio_utils.silence_runs(magnitude >= peak - CLIP_TOLERANCE)
+    lengths = ends - starts
+    return float(lengths[lengths >= MIN_CLIP_RUN].sum() / len(samples))
+
+
+def analyze_clip(
+    input_file: str,
+    sample_rate: int = DEFAULT_SAMPLE_RATE,
+    silence_db: float = DEFAULT_SILENCE_DB,
+) -> dict:
+    """
+    クリップの長さ（秒）・無音のフレームの割合・クリッピングしたサンプルの割合・推定 SNR（dB）を返します。
+    SNR は 20ms ごとのフレームの RMS の上位 5% を信号、下位 10% を雑音の水準として推定します。
+    """
+    blocks = list(audio_utils.decode_pcm_blocks(input_file, sample_rate))
+    samples = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.float32)
+    metrics = {
+        "duration": round(len(samples) / sample_rate, 3),
+        "silence_ratio": 1.0,
+        "clipping_rate": 0.0,
+        "snr_db": 0.0,
+    }
+    rms_db, _ = audio_utils.frame_features(samples, int(sample_rate * FRAME_SECONDS))
+    if len(rms_db) == 0:
+        return metrics
+    rms_db = np.maximum(rms_db, FLOOR_DB)
+    noise_db, signal_db = np.percentile(rms_db, [10, 95])
+    metrics["silence_ratio"] = round(float(np.mean(rms_db < silence_db)), 4)
+    metrics["clipping_rate"] = round(clipping_rate(samples), 6)
+    metrics["snr_db"] = round(float(signal_db - noise_db), 2)
+    return metrics
+
+
+def rejection_reasons(metrics: dict, thresholds: dict) -> list[str]:
+    """
+    しきい値を満たさない項目の一覧を返します。None のしきい値は判定しません。
+    """
+    checks = [
+        (
+            "min_duration",
+            thresholds["min_duration"] is not None
+            and metrics["duration"] < thresholds["min_duration"],
+        ),
+        (
+            "max_duration",
+            thresholds["max_duration"] is not None
+            and metrics["duration"] > thresholds["max_duration"],
+        ),
+        (
+            "max_silence_ratio",
+            thresholds["max_silence_ratio"] is not None
+            and metrics["silence_ratio"] > thresholds["max_silence_ratio"],
+        ),
+        (
+            "max_clipping_rate",
+            thresholds["max_clipping_rate"] is not None
+            and metrics["clipping_rate"] > thresholds["max_clipping_rate"],
+        ),
+        (
+            "min_snr_db",
+            thresholds["min_snr_db"] is not None
+            and metrics["snr_db"] < thresholds["min_snr_db"],
+        ),
+    ]
+    return [name for name, failed in checks if failed]
+
+
+def write_atomic(path: str, text: str) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def filter_clips(
+    input_files: list[str],
+    raw_dir: str,
+    thresholds: dict,
+    jobs: Optional[int] = None,
+    sample_rate: int = DEFAULT_SAMPLE_RATE,
+    silence_db: float = DEFAULT_SILENCE_DB,
+) -> list[str]:
+    """
+    クリップをプロセスプールで解析してしきい値で判定し、raw_dir に解析結果（quality.json）と
+    除外したクリップの名前の一覧（rejected.txt）を保存します。
+    サイズと更新時刻が変わっていないクリップは前回の解析結果を使い、しきい値の判定だけをやり直します。
+    除外したクリップのパスを返します。
+    """
+    quality_file = os.path.join(raw_dir, QUALITY_FILE)
+    analysis = {"sample_rate": sample_rate, "silence_db": silence_db}
+    clips: dict = {}
+    if os.path.exists(quality_file):
+        with open(quality_file, encoding="utf-8") as f:
+            previous = json.load(f)
+        if previous.get("analysis") == analysis:
+            clips = previous["clips"]
+
+    current: dict[str, dict] = {}
+    pending: list[str] = []
+    for path in input_files:
+        stat = os.stat(path)
+        name = os.path.basename(path)
+        entry = clips.get(name)
+        if (
+            entry
+            and entry["size"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+        ):
+            current[name] = entry
+        else:
+            current[name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            pending.append(path)
+
+    print(f"解析するクリップ: {len(pending)} / {len(input_files)} 件")
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                instrumentation.timed_call, analyze_clip, path, sample_rate, silence_db
+            ): path
+            for path in pending
+        }
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                elapsed, metrics = future.result()
+            except Exception as e:
+                print(f"エラー: {path} の解析に失敗しました: {e}")
+                current.pop(os.path.basename(path))
+                continue
+            instrumentation.record(elapsed)
+            current[os.path.basename(path)].update(metrics)
+
+    rejected: list[str] = []
+    counts: dict[str, int] = {}
+    for path in input_files:
+        entry = current.get(os.path.basename(path))
+        if entry is None:
+            continue
+        entry["rejected"] = rejection_reasons(entry, thresholds)
+        if entry["rejected"]:
+            rejected.append(path)
+            for reason in entry["rejected"]:
+                counts[reason] = counts.get(reason, 0) + 1
+
+    write_atomic(
+        quality_file,
+        json.dumps(
+            {"analysis": analysis, "thresholds": thresholds, "clips": current},
+            ensure_ascii=False,
+            indent=2,
+        ),
+    )
+    write_atomic(
+        os.path.join(raw_dir, REJECTED_FILE),
+        "".join(
+            os.path.splitext(os.path.basename(path))[0] + "\n" for path in rejected
+        ),
+    )
+    print(f"除外したクリップ: {len(rejected)} / {len(input_files)} 件")
+    for reason, count in sorted(counts.items()):
+        print(f"  {reason}: {count} 件")
+    return rejected
+
+
+def main(args: Optional[Namespace] = None) -> None:
+    """
+    メイン関数。normalize_loudness のクリップを判定し、除外したクリップの一覧を保存します。
+    """
+    if args is None:
+        args = parse_arguments()
+
+    model_name = os.getenv("MODEL_NAME") or args.model_name
+    if not model_name:
+        print("モデル名が指定されていません。")
+        return
+
+    directory = os.getenv("FS_DATA_TS") or args.directory
+    if not directory:
+        print("ディレクトリが指定されていません。")
+        return
+
+    raw_dir = f"./data/{model_name}/raw/{directory}"
+    index = MetadataIndex(index_path(model_name, directory))
+    input_files = index.refresh(
+        os.path.join(raw_dir, "normalize_loudness"), "normalize_loudness"
+    )
+    index.close()
+
+    thresholds = {
+        "min_duration": args.min_duration,
+        "max_duration": args.max_duration,
+        "max_silence_ratio": args.max_silence_ratio,
+        "max_clipping_rate": args.max_clipping_rate,
+        "min_snr_db": args.min_snr_db,
+    }
+    report_file = instrumentation.report_path(model_name, directory)
+    with instrumentation.Recorder("quality_filter", report_file, args.profile):
+        filter_clips(
+            input_files,
+            raw_dir,
+            thresholds,
+            args.jobs,
+            silence_db=args.silence_db,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import importlib
+import json
+import os
+
+import numpy as np
+import pytest
+
+sf = pytest.importorskip("soundfile")
+pytest.importorskip("pyloudnorm")
+
+normalize = importlib.import_module("03_normalize")
+
+RATE = 16000
+
+
+def write_tone(path, amplitude=0.1):
+    t = np.arange(RATE) / RATE
+    sf.write(path, amplitude * np.sin(2 * np.pi * 440 * t), RATE)
+
+
+def run(input_dir, output_dir, force=False):
+    return normalize.normalize_loudness_incremental(
+        str(input_dir), str(output_dir), -23.0, force, jobs=1
+    )
+
+
+def read_manifest(output_dir):
+    with open(output_dir / normalize.MANIFEST_NAME, encoding="utf-8") as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    input_dir, output_dir = tmp_path / "separate", tmp_path / "normalize_loudness"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    for name in ["a.wav", "b.wav", "c.wav"]:
+        write_tone(input_dir / name)
+    return input_dir, output_dir
+
+
+def test_second_run_skips_normalized_files(dirs):
+    input_dir, output_dir = dirs
+    assert run(input_dir, output_dir) == 3
+    assert sorted(read_manifest(output_dir)) == ["a.wav", "b.wav", "c.wav"]
+    assert run(input_dir, output_dir) == 0
+    assert run(input_dir, output_dir, force=True) == 3
+
+
+def test_changed_and_missing_outputs_are_normalized_again(dirs):
+    input_dir, output_dir = dirs
+    run(input_dir, output_dir)
+    write_tone(input_dir / "a.wav", amplitude=0.2)
+    os.remove(output_dir / "b.wav")
+    assert run(input_dir, output_dir) == 2
+
+
+def test_resumes_after_a_failed_file(dirs):
+    input_dir, output_dir = dirs
+    (input_dir / "b.wav").write_bytes(b"not audio")
+    run(input_dir, output_dir)
+    # 失敗したファイルは記録せず、次の実行でそのファイルだけを処理する
+    assert sorted(read_manifest(output_dir)) == ["a.wav", "c.wav"]
+
+    write_tone(input_dir / "b.wav")
+    assert run(input_dir, output_dir) == 1
+    assert sorted(read_manifest(output_dir)) == ["a.wav", "b.wav", "c.wav"]
+
+
+def test_manifest_is_saved_while_running(dirs, monkeypatch):
+    input_dir, output_dir = dirs
+    saved = []
+    save_manifest = normalize.save_manifest
+
+    def record(path, manifest):
+        saved.append(sorted(manifest))
+        save_manifest(path, manifest)
+
+    monkeypatch.setattr(normalize, "MANIFEST_SAVE_FILES", 1)
+    monkeypatch.setattr(normalize, "save_manifest", record)
+    run(input_dir, output_dir)
+    assert [len(names) for names in saved] == [1, 2, 3, 3]
+    assert not os.path.exists(output_dir / (normalize.MANIFEST_NAME + ".tmp"))
+
+
+def test_removed_sources_are_dropped_from_the_manifest(dirs):
+    input_dir, output_dir = dirs
+    run(input_dir, output_dir)
+    os.remove(input_dir / "c.wav")
+    assert run(input_dir, output_dir) == 0
+    assert sorted(read_manifest(output_dir)) == ["a.wav", "b.wav"]
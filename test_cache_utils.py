@@ -0,0 +1,86 @@
+import sqlite3
+
+import pytest
+
+import cache_utils
+from cache_utils import BlobCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # 同じ時刻にならないように、参照時刻を 1 秒ずつ進める
+    now = [1000.0]
+
+    def time():
+        now[0] += 1
+        return now[0]
+
+    monkeypatch.setattr(cache_utils.time, "time", time)
+
+
+def stored_bytes(path):
+    with sqlite3.connect(path) as conn:
+        (total,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+    return total
+
+
+def test_put_evicts_least_recently_used(tmp_path, clock):
+    cache = BlobCache(str(tmp_path / "cache.sqlite3"), max_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"
+    cache.put("c", b"cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa"
+    assert cache.get("c") == b"cccc"
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["bytes"] == 8
+    cache.close()
+
+
+def test_replacing_a_key_counts_only_the_new_value(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = BlobCache(path, max_bytes=100)
+    cache.put("a", b"x" * 40)
+    cache.put("a", b"x" * 10)
+    cache.put("b", b"x" * 30)
+    assert cache.stats()["bytes"] == 40 == stored_bytes(path)
+    cache.close()
+
+
+def test_value_larger_than_limit_is_not_kept(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = BlobCache(path, max_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("big", b"x" * 20)
+    assert cache.stats() == {"hits": 0, "misses": 0, "entries": 0, "bytes": 0}
+    assert stored_bytes(path) == 0
+    cache.close()
+
+
+def test_total_is_recounted_when_opened(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = BlobCache(path, max_bytes=100)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbbbb")
+    cache.close()
+    # 合計サイズを記録していなかった以前のキャッシュや、ずれた値から始めない
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE meta SET value = 0 WHERE name = 'total_bytes'")
+
+    cache = BlobCache(path, max_bytes=100)
+    assert cache.stats()["bytes"] == 10
+    cache.close()
+
+
+def test_two_connections_share_the_total(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite3")
+    first = BlobCache(path, max_bytes=10)
+    second = BlobCache(path, max_bytes=10)
+    first.put("a", b"aaaa")
+    second.put("b", b"bbbb")
+    first.put("c", b"cccc")
+    assert first.stats()["bytes"] == second.stats()["bytes"] == stored_bytes(path) == 8
+    assert second.get("a") is None
+    first.close()
+    second.close()
@@ -0,0 +1,66 @@
+import sys
+import importlib
+
+import numpy as np
+import pytest
+
+import fst
+
+
+@pytest.mark.parametrize("name", list(fst.COMMANDS))
+def test_import_time_within_budget(name):
+    module, _ = fst.COMMANDS[name]
+    elapsed = min(fst.import_time(module)[0] for _ in range(3))
+    assert elapsed <= fst.DEFAULT_BUDGET_MS, f"{module}: {elapsed:.1f} ms"
+
+
+@pytest.mark.parametrize("name", list(fst.COMMANDS))
+def test_import_loads_no_heavy_modules(name):
+    module, _ = fst.COMMANDS[name]
+    _, heavy = fst.import_time(module)
+    assert heavy == []
+
+
+@pytest.mark.parametrize("command", ["normalize", "03"])
+def test_dispatch_normalize(command, tmp_path, monkeypatch):
+    sf = pytest.importorskip("soundfile")
+    pytest.importorskip("pyloudnorm")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("MODEL_NAME", "model")
+    monkeypatch.setenv("FS_DATA_TS", "000000_000000")
+    monkeypatch.setattr(sys, "argv", sys.argv)
+    separate_dir = tmp_path / "data/model/raw/000000_000000/separate"
+    separate_dir.mkdir(parents=True)
+    sf.write(separate_dir / "clip.wav", np.full(16000, 0.1), 16000)
+
+    fst.main([command, "--engine", "native", "--jobs", "1"])
+
+    assert (
+        tmp_path / "data/model/raw/000000_000000/normalize_loudness/clip.wav"
+    ).exists()
+    assert sys.argv == ["fst normalize", "--engine", "native", "--jobs", "1"]
+
+
+def test_dispatch_normalize_without_arguments(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "argv", sys.argv)
+    # fst が設定する環境変数をテストの後に元に戻す
+    monkeypatch.delenv("MODEL_NAME", raising=False)
+    monkeypatch.delenv("FS_DATA_TS", raising=False)
+    normalize = importlib.import_module("03_normalize")
+    calls = []
+    monkeypatch.setattr(
+        normalize, "normalize_loudness", lambda *args: calls.append(args)
+    )
+    (tmp_path / "data/model/raw/000000_000000/separate").mkdir(parents=True)
+
+    # 引数がなくてもヘルプを表示して終了せず、-M と -D の値で実行する
+    fst.main(["-M", "model", "-D", "000000_000000", "normalize"])
+
+    assert calls == [
+        (
+            "./data/model/raw/000000_000000/separate",
+            "./data/model/raw/000000_000000/normalize_loudness",
+            -23.0,
+        )
+    ]
@@ -0,0 +1,34 @@
+import numpy as np
+
+from quality_filter import CLIP_TOLERANCE, MIN_CLIP_RUN, clipping_rate
+
+RATE = 16000
+
+
+def tone(amplitude, seconds=1.0, frequency=440):
+    t = np.arange(int(RATE * seconds)) / RATE
+    return (amplitude * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+
+
+def test_clean_tone_is_not_clipped():
+    assert clipping_rate(tone(0.5)) == 0.0
+    assert clipping_rate(tone(1.0)) == 0.0
+
+
+def test_clipped_tone_is_detected_after_gain_change():
+    clipped = np.clip(tone(2.0), -1.0, 1.0)
+    assert clipping_rate(clipped) > 0.3
+    # ラウドネス正規化で音量を下げても、平らになった区間はピークのまま残る
+    assert clipping_rate(clipped * 0.5) > 0.3
+
+
+def test_short_runs_at_the_peak_are_ignored():
+    samples = tone(0.3)
+    samples[100 : 100 + MIN_CLIP_RUN - 1] = 0.9
+    samples[5000 : 5000 + MIN_CLIP_RUN] = -0.9 + CLIP_TOLERANCE / 2
+    assert clipping_rate(samples) == MIN_CLIP_RUN / len(samples)
+
+
+def test_silence_is_not_clipped():
+    assert clipping_rate(np.zeros(RATE, dtype=np.float32)) == 0.0
+    assert clipping_rate(np.zeros(0, dtype=np.float32)) == 0.0
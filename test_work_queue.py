@@ -0,0 +1,90 @@
+import os
+import time
+
+import pytest
+
+from work_queue import LeaseQueue
+
+
+@pytest.fixture
+def items(tmp_path):
+    paths = []
+    for name in ["a.wav", "b.wav", "c.wav"]:
+        path = tmp_path / name
+        path.write_bytes(b"audio")
+        paths.append(str(path))
+    return paths
+
+
+def expire(queue, item):
+    old = time.time() - queue.lease_seconds - 10
+    os.utime(queue._lease_path(item), (old, old))
+
+
+def test_claim_skips_items_leased_by_another_worker(tmp_path, items):
+    first = LeaseQueue(str(tmp_path / "leases"), "first", lease_seconds=60)
+    second = LeaseQueue(str(tmp_path / "leases"), "second", lease_seconds=60)
+    remaining = list(items)
+    assert first.claim(remaining, 2) == items[:2]
+    assert remaining == items[2:]
+
+    others = list(items)
+    assert second.claim(others, 3) == items[2:]
+    assert others == items[:2]
+    assert first.owner(items[0]) == "first"
+
+
+def test_complete_marks_done_until_the_input_changes(tmp_path, items):
+    queue = LeaseQueue(str(tmp_path / "leases"), "worker", lease_seconds=60)
+    remaining = list(items)
+    claimed = queue.claim(remaining, 1)
+    queue.complete(claimed)
+    assert queue.is_done(items[0])
+    assert queue.owner(items[0]) is None
+    assert queue.held == set()
+
+    remaining = list(items)
+    assert queue.claim(remaining, 3) == items[1:]
+    queue.release(items[1:])
+
+    with open(items[0], "ab") as f:
+        f.write(b"changed")
+    assert not queue.is_done(items[0])
+
+
+def test_expired_lease_is_stolen(tmp_path, items):
+    first = LeaseQueue(str(tmp_path / "leases"), "first", lease_seconds=60)
+    second = LeaseQueue(str(tmp_path / "leases"), "second", lease_seconds=60)
+    first.claim(list(items), 1)
+    assert second.claim([items[0]], 1) == []
+
+    expire(first, items[0])
+    assert second.claim([items[0]], 1) == [items[0]]
+    assert second.owner(items[0]) == "second"
+
+    # 引き継がれたリースは元のワーカーが更新せず、手放しても削除しない
+    first.renew()
+    assert items[0] not in first.held
+    first.release([items[0]])
+    assert second.owner(items[0]) == "second"
+
+
+def test_renew_keeps_the_lease_from_expiring(tmp_path, items):
+    first = LeaseQueue(str(tmp_path / "leases"), "first", lease_seconds=60)
+    second = LeaseQueue(str(tmp_path / "leases"), "second", lease_seconds=60)
+    first.claim(list(items), 1)
+    expire(first, items[0])
+    first.renew()
+    assert second.claim([items[0]], 1) == []
+    assert first.owner(items[0]) == "first"
+
+
+def test_run_completes_only_succeeded_items(tmp_path, items):
+    queue = LeaseQueue(str(tmp_path / "leases"), "worker", lease_seconds=60)
+
+    def process(batch):
+        return [item for item in batch if not item.endswith("b.wav")]
+
+    assert queue.run(items, process, claim_size=2) == 2
+    assert [queue.is_done(item) for item in items] == [True, False, True]
+    assert [queue.owner(item) for item in items] == [None, None, None]
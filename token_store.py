@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import argparse
+from argparse import Namespace
+from typing import Optional
+
+import numpy as np
+
+TOKENS_FILE = "tokens.npy"
+INDEX_FILE = "index.npy"
+ENTRIES_FILE = "entries.jsonl"
+INDEX_DTYPE = np.dtype([("offset", np.int64), ("length", np.int32)])
+
+
+def parse_arguments() -> Namespace:
+    """
+    コマンドライン引数を解析します。
+    """
+    parser = argparse.ArgumentParser(
+        description="npy / lab ファイルを 1 つのメモリマップ可能なトークンストアにまとめます。"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack = subparsers.add_parser(
+        "pack", help="ディレクトリ内の npy / lab ファイルをトークンストアに変換します。"
+    )
+    pack.add_argument(
+        "--input", "-i", required=True, help="[REQUIRED] npy ファイルのディレクトリ"
+    )
+    pack.add_argument(
+        "--output", "-o", required=True, help="[REQUIRED] トークンストアの出力先"
+    )
+    pack.add_argument(
+        "--text-extension",
+        default=".lab",
+        help="[OPTION] テキストファイルの拡張子。デフォルトは .lab です。",
+    )
+    info = subparsers.add_parser("info", help="トークンストアの概要を表示します。")
+    info.add_argument("path", help="トークンストアのディレクトリ")
+    return parser.parse_args()
+
+
+def list_token_files(input_dir: str) -> list[str]:
+    """
+    ディレクトリ以下の npy ファイルを名前順に返します。
+    """
+    files = []
+    for root, _, names in os.walk(input_dir):
+        for name in names:
+            if name.endswith(".npy"):
+                files.append(os.path.join(root, name))
+    return sorted(files)
+
+
+def pack_directory(
+    input_dir: str, output_dir: str, text_extension: str = ".lab"
+) -> int:
+    """
+    ディレクトリ内の npy ファイルを 1 つのトークン配列に連結し、
+    各ファイルのオフセットと長さのインデックス、対応するテキストと合わせて保存します。
+    保存した件数を返します。
+    """
+    files = list_token_files(input_dir)
+    # ヘッダだけを読んで全体の大きさを求める
+    shapes = [np.load(path, mmap_mode="r").shape for path in files]
+    codebooks = {shape[0] for shape in shapes}
+    if len(codebooks) > 1:
+        raise ValueError(f"コードブック数が一致しません: {sorted(codebooks)}")
+    num_codebooks = codebooks.pop() if codebooks else 0
+    total = sum(shape[1] for shape in shapes)
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokens = np.lib.format.open_memmap(
+        os.path.join(output_dir, TOKENS_FILE + ".part"),
+        mode="w+",
+        dtype=np.uint16,
+        shape=(num_codebooks, total),
+    )
+    index = np.zeros(len(files), dtype=INDEX_DTYPE)
+    offset = 0
+    entries_path = os.path.join(output_dir, ENTRIES_FILE)
+    with open(entries_path + ".part", "w", encoding="utf-8") as entries:
+        for i, (path, shape) in enumerate(zip(files, shapes)):
+            length = shape[1]
+            tokens[:, offset : offset + length] = np.load(path)
+            index[i] = (offset, length)
+            offset += length
+
+            relpath = os.path.relpath(path, input_dir)
+            text_file = os.path.splitext(path)[0] + text_extension
+            text = None
+            if os.path.exists(text_file):
+                with open(text_file, encoding="utf-8") as f:
+                    text = f.read()
+            entry = {
+                "name": os.path.splitext(relpath)[0].replace(os.sep, "/"),
+                "speaker": os.path.basename(os.path.dirname(path)),
+                "text": text,
+            }
+            entries.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    tokens.flush()
+    del tokens
+
+    np.save(os.path.join(output_dir, INDEX_FILE), index)
+    os.replace(entries_path + ".part", entries_path)
+    os.replace(
+        os.path.join(output_dir, TOKENS_FILE + ".part"),
+        os.path.join(output_dir, TOKENS_FILE),
+    )
+    return len(files)
+
+
+class PackedTokenStore:
+    """
+    pack_directory で作成したトークンストアを読み込みます。
+    トークンはメモリマップされ、各サンプルのトークンはコピーせずにスライスとして返します。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.tokens = np.load(os.path.join(path, TOKENS_FILE), mmap_mode="r")
+        self.index = np.load(os.path.join(path, INDEX_FILE))
+        with open(os.path.join(path, ENTRIES_FILE), encoding="utf-8") as f:
+            self.entries = [json.loads(line) for line in f]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def codes(self, i: int) -> np.ndarray:
+        """
+        i 番目のサンプルの (コードブック数, フレーム数) のトークンを返します。
+        """
+        offset, length = self.index[i]
+        return self.tokens[:, offset : offset + length]
+
+    def text(self, i: int) -> Optional[str]:
+        return self.entries[i]["text"]
+
+    def name(self, i: int) -> str:
+        return self.entries[i]["name"]
+
+    def speaker(self, i: int) -> str:
+        return self.entries[i]["speaker"]
+
+
+def main(args: Optional[Namespace] = None) -> None:
+    """
+    メイン関数。トークンストアの作成と確認を行います。
+    """
+    if args is None:
+        args = parse_arguments()
+
+    if args.command == "pack":
+        if not os.path.isdir(args.input):
+            print(f"入力ディレクトリが見つかりません: {args.input}")
+            sys.exit(1)
+        count = pack_directory(args.input, args.output, args.text_extension)
+        print(f"トークンストアを作成しました: {args.output}（{count} 件）")
+    elif args.command == "info":
+        store = PackedTokenStore(args.path)
+        missing = sum(1 for entry in store.entries if entry["text"] is None)
+        print(f"件数: {len(store)}")
+        print(f"トークン: {store.tokens.shape}（{store.tokens.dtype}）")
+        print(f"テキストがないサンプル: {missing} 件")
+
+
+if __name__ == "__main__":
+    main()
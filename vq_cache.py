@@ -0,0 +1,131 @@
+import io
+import os
+import argparse
+from typing import Optional
+
+import numpy as np
+
+from cache_utils import BlobCache, content_hash
+from file_utils import save_npy
+
+DEFAULT_VQ_CACHE_PATH = "./data/cache/vq_tokens.sqlite3"
+DEFAULT_VQ_CACHE_MB = 2048
+
+
+def add_vq_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    04 と 06 で共有する VQ トークンのキャッシュの引数を追加します。
+    """
+    parser.add_argument(
+        "--vq-cache-path",
+        default=DEFAULT_VQ_CACHE_PATH,
+        help=f"[OPTION] VQ トークンのキャッシュのパス。デフォルトは {DEFAULT_VQ_CACHE_PATH} です。",
+    )
+    parser.add_argument(
+        "--vq-cache-max-mb",
+        type=int,
+        default=DEFAULT_VQ_CACHE_MB,
+        help=f"[OPTION] VQ トークンのキャッシュの最大サイズ（MB）。デフォルトは {DEFAULT_VQ_CACHE_MB} です。",
+    )
+    parser.add_argument(
+        "--no-vq-cache",
+        action="store_true",
+        help="[OPTION] VQ トークンのキャッシュを使用しません。",
+    )
+
+
+def open_vq_cache(
+    args: argparse.Namespace, checkpoint_path: str, config_name: str
+) -> Optional["VQTokenCache"]:
+    """
+    引数に従って VQ トークンのキャッシュを開きます。使用しない場合は None を返します。
+    """
+    if args.no_vq_cache:
+        return None
+    return VQTokenCache(
+        checkpoint_path,
+        config_name,
+        args.vq_cache_path,
+        args.vq_cache_max_mb * 1024 * 1024,
+    )
+
+
+class VQTokenCache:
+    """
+    VQ エンコードの結果（コードブック数, フレーム数）のトークン配列を、
+    音声ファイルの内容のハッシュ・チェックポイントの内容のハッシュ・設定ファイルの名前をキーとして保存するキャッシュ。
+    04 と 06 で共有し、同じ音声を同じモデルで二度エンコードしないために使います。
+    """
+
+    def __init__(
+        self,
+        checkpoint_path: str,
+        config_name: str,
+        path: str = DEFAULT_VQ_CACHE_PATH,
+        max_bytes: int = DEFAULT_VQ_CACHE_MB * 1024 * 1024,
+    ) -> None:
+        self.model_key = f"{content_hash(checkpoint_path)}:{config_name}"
+        self.cache = BlobCache(path, max_bytes)
+
+    def key(self, audio_file: str) -> str:
+        return f"{self.model_key}:{content_hash(audio_file)}"
+
+    def get(self, audio_file: str) -> Optional[np.ndarray]:
+        """
+        音声ファイルのトークン配列を返します。存在しない場合は None を返します。
+        """
+        value = self.cache.get(self.key(audio_file))
+        if value is None:
+            return None
+        return np.load(io.BytesIO(value))
+
+    def put(self, audio_file: str, codes: np.ndarray) -> None:
+        """
+        音声ファイルのトークン配列を保存します。
+        """
+        buffer = io.BytesIO()
+        np.save(buffer, codes)
+        self.cache.put(self.key(audio_file), buffer.getvalue())
+
+    def restore(
+        self, input_files: list[str], output_files: list[str]
+    ) -> list[tuple[str, str]]:
+        """
+        キャッシュにある音声ファイルのトークン配列を対応する npy ファイルに書き出し、
+        キャッシュになかった (入力ファイル, 出力ファイル) の組を返します。
+        """
+        missing = []
+        for input_file, output_file in zip(input_files, output_files):
+            codes = self.get(input_file)
+            if codes is None:
+                missing.append((input_file, output_file))
+                continue
+            save_npy(output_file, codes)
+        return missing
+
+    def store(self, input_files: list[str], output_files: list[str]) -> int:
+        """
+        生成された npy ファイルをキャッシュに保存します。保存した件数を返します。
+        """
+        stored = 0
+        for input_file, output_file in zip(input_files, output_files):
+            if os.path.exists(output_file):
+                self.put(input_file, np.load(output_file))
+                stored += 1
+        return stored
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+    def print_stats(self) -> None:
+        """
+        ヒット数・ミス数と、保存されている件数・合計サイズを表示します。
+        """
+        stats = self.stats()
+        print(
+            f"VQ トークンのキャッシュ: ヒット {stats['hits']} 件 / ミス {stats['misses']} 件 / "
+            f"保存 {stats['entries']} 件（{stats['bytes'] / 1024 / 1024:.1f} MB）"
+        )
+
+    def close(self) -> None:
+        self.cache.close()
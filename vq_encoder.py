@@ -0,0 +1,189 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+import torch
+import torchaudio
+
+import instrumentation
+from file_utils import save_npy
+from metadata_index import probe_audio
+from pcm_cache import PCMCache
+from vq_cache import VQTokenCache
+
+DEFAULT_CONFIG_NAME = "firefly_gan_vq"
+
+
+def default_device() -> str:
+    """
+    GPU が使える場合は cuda、使えない場合は cpu を返します。
+    """
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+@lru_cache(maxsize=None)
+def load_vq_model(
+    checkpoint_path: str, config_name: str = DEFAULT_CONFIG_NAME, device: str = "cpu"
+) -> torch.nn.Module:
+    """
+    firefly VQ モデルを読み込みます。同じプロセス内では一度だけ読み込まれます。
+    """
+    # fish-speech のリポジトリのルートで実行されることを前提とする
+    from tools.vqgan.inference import load_model
+
+    return load_model(config_name, checkpoint_path, device=device)
+
+
+def sample_rate_of(model: torch.nn.Module) -> int:
+    """
+    モデルが想定するサンプリングレートを返します。
+    """
+    return model.spec_transform.sample_rate
+
+
+def load_audio(
+    input_file: str, sample_rate: int, pcm_cache: Optional[PCMCache] = None
+) -> np.ndarray:
+    """
+    音声ファイルをモノラルの float32 配列として読み込み、指定のサンプリングレートに変換します。
+    pcm_cache を指定した場合はデコード済みの配列をキャッシュから読み込みます。
+    """
+    if pcm_cache is not None:
+        return pcm_cache.load(input_file, sample_rate)
+    audio, sr = torchaudio.load(input_file)
+    if audio.shape[0] > 1:
+        audio = audio.mean(0, keepdim=True)
+    audio = torchaudio.functional.resample(audio, sr, sample_rate)
+    return audio[0].numpy()
+
+
+@torch.no_grad()
+def encode_batch(model: torch.nn.Module, audios: list[np.ndarray]) -> list[np.ndarray]:
+    """
+    長さの異なる音声配列をパディングしてまとめてエンコードし、
+    それぞれの音声の (コードブック数, フレーム数) のトークン配列を返します。
+    """
+    device = next(model.parameters()).device
+    lengths = [len(audio) for audio in audios]
+    batch = torch.zeros((len(audios), 1, max(lengths)), dtype=torch.float32)
+    # キャッシュの読み取り専用のメモリマップからも直接パディング済みのバッチにコピーする
+    padded = batch.numpy()
+    for i, audio in enumerate(audios):
+        padded[i, 0, : len(audio)] = audio
+    audio_lengths = torch.tensor(lengths, device=device, dtype=torch.long)
+    indices, feature_lengths = model.encode(batch.to(device), audio_lengths)
+    return [
+        indices[i, :, : int(n_frames)].cpu().numpy()
+        for i, n_frames in enumerate(feature_lengths)
+    ]
+
+
+def plan_batches(
+    lengths: list[int], batch_size: Optional[int], max_samples: Optional[int] = None
+) -> list[list[int]]:
+    """
+    長さの近いものが同じバッチになるように並べ替え、インデックスのバッチを作成します。
+    max_samples を指定した場合は、パディング後のサンプル数（件数 × バッチ内の最大の長さ）が
+    max_samples を超えないようにバッチを区切るため、短いクリップほど多くまとめられます。
+    このとき batch_size は件数の上限で、None の場合は件数を制限しません。
+    1 件で max_samples を超えるクリップは単独のバッチになります。
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    if max_samples is None:
+        size = batch_size or max(len(order), 1)
+        return [order[i : i + size] for i in range(0, len(order), size)]
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    for i in order:
+        # 昇順に並んでいるため、追加するクリップがバッチ内の最大の長さになる
+        if batch and (
+            (batch_size is not None and len(batch) >= batch_size)
+            or (len(batch) + 1) * lengths[i] > max_samples
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def padding_efficiency(lengths: list[int], batches: list[list[int]]) -> float:
+    """
+    バッチのサンプル数のうち、パディングではない実際の音声の割合を返します。
+    """
+    padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    return sum(lengths) / padded if padded else 1.0
+
+
+def audio_length(input_file: str, sample_rate: int) -> int:
+    """
+    デコードせずに、指定のサンプリングレートに変換した後のサンプル数を求めます。
+    """
+    duration, _, _ = probe_audio(input_file)
+    return int((duration or 0) * sample_rate)
+
+
+def load_audios(
+    input_files: list[str], sample_rate: int, pcm_cache: Optional[PCMCache] = None
+) -> list[np.ndarray]:
+    """
+    複数の音声ファイルを読み込みます。
+    """
+    return [
+        load_audio(input_file, sample_rate, pcm_cache) for input_file in input_files
+    ]
+
+
+def encode_files(
+    model: torch.nn.Module,
+    input_files: list[str],
+    output_files: list[str],
+    batch_size: Optional[int] = 8,
+    pcm_cache: Optional[PCMCache] = None,
+    max_seconds: Optional[float] = None,
+    vq_cache: Optional[VQTokenCache] = None,
+) -> int:
+    """
+    音声ファイルを長さの近いものでバッチにまとめてエンコードし、トークンを npy ファイルに保存します。
+    max_seconds を指定した場合は、1 バッチのパディング後の長さの合計がその秒数以内になるようにまとめ、
+    batch_size は件数の上限になります（None の場合は制限しません）。
+    pcm_cache を指定した場合、デコード済みの音声をキャッシュから読み込みます。
+    vq_cache を指定した場合、エンコード結果をキャッシュにも保存します。
+    保存したファイル数を返します。
+    """
+    sample_rate = sample_rate_of(model)
+    lengths = [audio_length(input_file, sample_rate) for input_file in input_files]
+    max_samples = int(max_seconds * sample_rate) if max_seconds else None
+    planned = plan_batches(lengths, batch_size, max_samples)
+    if planned:
+        print(
+            f"バッチ数: {len(planned)} / 音声の割合: "
+            f"{padding_efficiency(lengths, planned):.1%}（残りはパディング）"
+        )
+    batches = [[input_files[i] for i in batch] for batch in planned]
+    outputs = dict(zip(input_files, output_files))
+    written = 0
+    # 次のバッチの読み込みはエンコードと並行して行う
+    with ThreadPoolExecutor(max_workers=1) as loader:
+        next_audios = (
+            loader.submit(load_audios, batches[0], sample_rate, pcm_cache)
+            if batches
+            else None
+        )
+        for index, batch in enumerate(batches):
+            audios = next_audios.result()
+            if index + 1 < len(batches):
+                next_audios = loader.submit(
+                    load_audios, batches[index + 1], sample_rate, pcm_cache
+                )
+            with instrumentation.measure("batch", len(batch)):
+                encoded = encode_batch(model, audios)
+            for input_file, codes in zip(batch, encoded):
+                save_npy(outputs[input_file], codes)
+                if vq_cache is not None:
+                    vq_cache.put(input_file, codes)
+                print(f"Generated npy file: {outputs[input_file]}")
+                written += 1
+    return written
@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import socket
+import hashlib
+import argparse
+import threading
+from typing import Callable, Optional
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_CLAIM_SIZE = 16
+POLL_SECONDS = 10
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    複数のマシンで処理を分担するための引数を追加します。
+    """
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        help="[OPTION] data ディレクトリを共有する複数のワーカーで処理を分担します。"
+        "各ワーカーはリースファイルでクリップをまとめて取得し、処理中はリースを更新します。",
+    )
+    parser.add_argument(
+        "--worker-id",
+        help="[OPTION] --distributed: ワーカーの名前。省略時は <ホスト名>-<プロセス ID> です。",
+    )
+    parser.add_argument(
+        "--lease-seconds",
+        type=int,
+        default=DEFAULT_LEASE_SECONDS,
+        help=f"[OPTION] --distributed: 更新されないリースを他のワーカーが引き継ぐまでの秒数。デフォルトは {DEFAULT_LEASE_SECONDS} です。",
+    )
+    parser.add_argument(
+        "--claim-size",
+        type=int,
+        default=DEFAULT_CLAIM_SIZE,
+        help=f"[OPTION] --distributed: 1 回に取得するクリップ数。デフォルトは {DEFAULT_CLAIM_SIZE} です。",
+    )
+
+
+def check_local_caches(caches: dict[str, Optional[str]]) -> bool:
+    """
+    --distributed で使うキャッシュ（引数名とパスの組。使用しないものは None）が、
+    共有の data ディレクトリの外にあることを確認します。中にある場合はエラーを表示して False を返します。
+    SQLite のキャッシュは複数のマシンから同時に書き込むと壊れるため、マシンごとにローカルのディスクを使います。
+    """
+    data_dir = os.path.realpath("./data")
+    shared = [
+        option
+        for option, path in caches.items()
+        if path is not None
+        and os.path.commonpath([data_dir, os.path.realpath(path)]) == data_dir
+    ]
+    if shared:
+        print(
+            f"エラー: --distributed では {'・'.join(shared)} に共有の data ディレクトリの外の"
+            "ローカルのパスを指定するか、キャッシュを無効にしてください。"
+        )
+        return False
+    return True
+
+
+def lease_dir(model_name: str, directory: str, stage: str) -> str:
+    """
+    ステージのリースファイルを置くディレクトリのパスを返します。
+    """
+    return f"./data/{model_name}/leases/{directory}/{stage}"
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseQueue:
+    """
+    共有ファイルシステムだけで動く、リースファイルによる作業の分担。
+    処理単位（入力ファイルのパス）ごとに O_EXCL でリースファイルを作成して取得し、
+    処理中は別スレッドで更新時刻を更新します。lease_seconds の間更新されないリースは期限切れとみなし、
+    他のワーカーがリネームで奪い取ってから取得し直します（リネームは 1 つのワーカーだけが成功します）。
+    完了した処理単位には入力ファイルのサイズと更新時刻を記録した完了ファイルを作成し、入力が変わるまで再処理しません。
+    期限の判定にはファイルの更新時刻を使うため、各マシンの時計は NTP などで合わせておく必要があります。
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        worker_id: Optional[str] = None,
+        lease_seconds: int = DEFAULT_LEASE_SECONDS,
+    ) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.held: set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._renewer: Optional[threading.Thread] = None
+
+    def _name(self, item: str) -> str:
+        return hashlib.sha1(os.path.normpath(item).encode("utf-8")).hexdigest()
+
+    def _lease_path(self, item: str) -> str:
+        return os.path.join(self.directory, self._name(item) + ".lease")
+
+    def _done_path(self, item: str) -> str:
+        return os.path.join(self.directory, self._name(item) + ".done")
+
+    def _signature(self, item: str) -> str:
+        stat = os.stat(item)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def is_done(self, item: str) -> bool:
+        """
+        処理単位が完了していて、その後に入力ファイルが変わっていない場合に True を返します。
+        """
+        try:
+            with open(self._done_path(item), encoding="utf-8") as f:
+                return f.read() == self._signature(item)
+        except OSError:
+            return False
+
+    def owner(self, item: str) -> Optional[str]:
+        """
+        処理単位のリースを持っているワーカーの名前を返します。リースがない場合は None を返します。
+        """
+        try:
+            with open(self._lease_path(item), encoding="utf-8") as f:
+                return json.load(f)["worker"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _expired(self, path: str) -> bool:
+        try:
+            return time.time() - os.path.getmtime(path) > self.lease_seconds
+        except OSError:
+            return False
+
+    def _try_acquire(self, item: str) -> bool:
+        path = self._lease_path(item)
+        if os.path.exists(path):
+            if not self._expired(path):
+                return False
+            # 期限切れのリースはリネームに成功したワーカーだけが引き継ぐ
+            stale = f"{path}.{self.worker_id}.stale"
+            try:
+                os.rename(path, stale)
+            except OSError:
+                return False
+            if not self._expired(stale):
+                # 判定の後に他のワーカーが取得し直したリースだった場合は元に戻す
+                try:
+                    os.link(stale, path)
+                except OSError:
+                    pass
+                os.remove(stale)
+                return False
+            previous = None
+            try:
+                with open(stale, encoding="utf-8") as f:
+                    previous = json.load(f).get("worker")
+            except (OSError, ValueError):
+                pass
+            os.remove(stale)
+            print(f"期限切れのリースを引き継ぎます: {item}（{previous}）")
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"worker": self.worker_id, "item": item}, f, ensure_ascii=False)
+        with self._lock:
+            self.held.add(item)
+        return True
+
+    def claim(self, items: list[str], count: int) -> list[str]:
+        """
+        未完了の処理単位から最大 count 件のリースを取得して返します。
+        items からは完了済みの処理単位と取得した処理単位を取り除き、他のワーカーが処理中のものだけを残します。
+        """
+        claimed: list[str] = []
+        kept: list[str] = []
+        for i, item in enumerate(items):
+            if len(claimed) >= count:
+                kept.extend(items[i:])
+                break
+            if self.is_done(item):
+                continue
+            if not self._try_acquire(item):
+                kept.append(item)
+                continue
+            # リースを取得する間に他のワーカーが完了させている場合がある
+            if self.is_done(item):
+                self.release([item])
+                continue
+            claimed.append(item)
+        items[:] = kept
+        return claimed
+
+    def renew(self) -> None:
+        """
+        保持しているリースの更新時刻を更新します。他のワーカーに引き継がれたリースは手放します。
+        """
+        with self._lock:
+            held = list(self.held)
+        for item in held:
+            if self.owner(item) != self.worker_id:
+                print(f"リースが他のワーカーに引き継がれました: {item}")
+                with self._lock:
+                    self.held.discard(item)
+                continue
+            try:
+                os.utime(self._lease_path(item))
+            except OSError:
+                pass
+
+    def complete(self, items: list[str]) -> None:
+        """
+        処理単位を完了として記録し、リースを削除します。
+        """
+        for item in items:
+            tmp_path = f"{self._done_path(item)}.{self.worker_id}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self._signature(item))
+            os.replace(tmp_path, self._done_path(item))
+        self.release(items)
+
+    def release(self, items: list[str]) -> None:
+        """
+        処理単位のリースを手放します。他のワーカーのリースは削除しません。
+        """
+        for item in items:
+            with self._lock:
+                self.held.discard(item)
+            if self.owner(item) == self.worker_id:
+                try:
+                    os.remove(self._lease_path(item))
+                except OSError:
+                    pass
+
+    def _renew_loop(self) -> None:
+        while not self._stop.wait(max(1.0, self.lease_seconds / 3)):
+            self.renew()
+
+    def __enter__(self) -> "LeaseQueue":
+        self._stop.clear()
+        self._renewer = threading.Thread(target=self._renew_loop, daemon=True)
+        self._renewer.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+        with self._lock:
+            held = list(self.held)
+        self.release(held)
+
+    def run(
+        self,
+        items: list[str],
+        process: Callable[[list[str]], Optional[list[str]]],
+        claim_size: int = DEFAULT_CLAIM_SIZE,
+    ) -> int:
+        """
+        すべての処理単位が完了するまで、リースを取得した処理単位を process に渡して処理します。
+        process は成功した処理単位の一覧を返します（None を返した場合はすべて成功とみなします）。
+        完了ファイルは成功した処理単位にだけ作成し、失敗したもののリースは手放し、次の実行か他のワーカーが処理し直します。
+        他のワーカーがリースを持つ処理単位しか残っていない場合は、完了するか期限が切れるまで待ちます。
+        処理中に例外が発生した場合はリースを手放して例外を送出します。このワーカーが処理した件数を返します。
+        """
+        remaining = list(items)
+        processed = 0
+        with self:
+            while remaining:
+                batch = self.claim(remaining, claim_size)
+                if not batch:
+                    if remaining:
+                        time.sleep(min(POLL_SECONDS, self.lease_seconds))
+                    continue
+                try:
+                    succeeded = process(batch)
+                except BaseException:
+                    self.release(batch)
+                    raise
+                if succeeded is None:
+                    succeeded = batch
+                succeeded_set = set(succeeded)
+                failed = [item for item in batch if item not in succeeded_set]
+                self.complete([item for item in batch if item in succeeded_set])
+                if failed:
+                    self.release(failed)
+                    print(
+                        f"[{self.worker_id}] {len(failed)} 件の処理に失敗しました。完了として記録しません。"
+                    )
+                processed += len(batch) - len(failed)
+                print(
+                    f"[{self.worker_id}] {processed} 件を処理しました（残り {len(remaining)} 件）"
+                )
+        return processed